@@ -5,6 +5,7 @@
 use App\Http\Controllers\Controller;
 use App\Models\RadiusServer;
 use App\Models\Voucher;
+use App\Models\VoucherTombstone;
 use Illuminate\Http\JsonResponse;
 use Illuminate\Http\Request;
 use Illuminate\Support\Facades\Log;
@@ -118,4 +119,235 @@ public function verify(Request $request): JsonResponse
             ], 500);
         }
     }
+
+    /**
+     * Per-bucket digests of the vouchers linked to a RADIUS server
+     * Used by the RADIUS cleanup script to find which buckets of usernames
+     * differ before sending any username lists
+     *
+     * Each username is hashed with md5: the first 8 hex digits (mod buckets)
+     * select the bucket, the next 8 are summed (mod 2^32) and the following 8
+     * are XORed into the bucket digest "count:sumxor". The root digest is the
+     * md5 of all bucket digests joined by newlines. Must match
+     * radtik-radius/scripts/voucher_digest.py.
+     *
+     * @param Request $request
+     * @return JsonResponse
+     */
+    public function digests(Request $request): JsonResponse
+    {
+        try {
+            $radiusServer = $this->authenticatedServer($request);
+            
+            if (!$radiusServer instanceof RadiusServer) {
+                return $radiusServer;
+            }
+            
+            $validated = $request->validate([
+                'buckets' => 'required|integer|min:1|max:65536',
+                'root' => 'nullable|string|max:64',
+            ]);
+            
+            $buckets = (int) $validated['buckets'];
+            $counts = array_fill(0, $buckets, 0);
+            $sums = array_fill(0, $buckets, 0);
+            $xors = array_fill(0, $buckets, 0);
+            
+            $linkedRouterIds = \App\Models\Router::where('radius_server_id', $radiusServer->id)
+                ->pluck('id')
+                ->toArray();
+            
+            // Stream usernames so memory stays flat for large voucher tables
+            $usernames = Voucher::whereIn('router_id', $linkedRouterIds)
+                ->select('username')
+                ->distinct()
+                ->toBase()
+                ->cursor();
+            
+            foreach ($usernames as $row) {
+                $hash = md5((string) $row->username);
+                $bucket = hexdec(substr($hash, 0, 8)) % $buckets;
+                
+                $counts[$bucket]++;
+                $sums[$bucket] = ($sums[$bucket] + hexdec(substr($hash, 8, 8))) % 4294967296;
+                $xors[$bucket] ^= hexdec(substr($hash, 16, 8));
+            }
+            
+            $digests = [];
+            for ($bucket = 0; $bucket < $buckets; $bucket++) {
+                $digests[] = sprintf('%d:%08x%08x', $counts[$bucket], $sums[$bucket], $xors[$bucket]);
+            }
+            
+            $root = md5(implode("\n", $digests));
+            $match = isset($validated['root']) && hash_equals($root, $validated['root']);
+            
+            Log::info('Voucher digests computed', [
+                'radius_server_id' => $radiusServer->id,
+                'buckets' => $buckets,
+                'vouchers' => array_sum($counts),
+                'match' => $match,
+            ]);
+            
+            // Steady state: the RADIUS side already has the same root digest
+            $response = [
+                'success' => true,
+                'buckets' => $buckets,
+                'root' => $root,
+                'match' => $match,
+                'vouchers' => array_sum($counts),
+            ];
+            
+            if (!$match) {
+                $response['digests'] = $digests;
+            }
+            
+            return response()->json($response, 200);
+        
+        } catch (\Illuminate\Validation\ValidationException $e) {
+            return response()->json([
+                'error' => 'Validation failed',
+                'details' => $e->errors()
+            ], 422);
+        
+        } catch (\Exception $e) {
+            Log::error('Failed to compute voucher digests', [
+                'error' => $e->getMessage(),
+                'ip' => $request->ip(),
+            ]);
+            
+            return response()->json([
+                'error' => 'Internal server error',
+                'message' => config('app.debug') ? $e->getMessage() : 'An error occurred'
+            ], 500);
+        }
+    }
+
+    /**
+     * Usernames deleted in RADTik since a cursor
+     * Used by the RADIUS cleanup script to remove deleted vouchers without
+     * a full orphan scan
+     *
+     * Tombstones are returned in id order; the response cursor is the id of
+     * the last tombstone returned and is sent back as `since` on the next
+     * call. Usernames that exist again as vouchers of this server (deleted
+     * and re-created) are left out. `reset` is true when tombstones of this
+     * server after the cursor were already pruned (the cursor is below the
+     * server's `tombstones_pruned_id`), in which case the caller has to
+     * reconcile the full voucher set; the returned cursor then starts past
+     * the pruned ids, so the reset is reported once.
+     *
+     * @param Request $request
+     * @return JsonResponse
+     */
+    public function tombstones(Request $request): JsonResponse
+    {
+        try {
+            $radiusServer = $this->authenticatedServer($request);
+            
+            if (!$radiusServer instanceof RadiusServer) {
+                return $radiusServer;
+            }
+            
+            $validated = $request->validate([
+                'since' => 'required|integer|min:0',
+                'limit' => 'nullable|integer|min:1|max:5000',
+            ]);
+            
+            $since = (int) $validated['since'];
+            $limit = (int) ($validated['limit'] ?? 1000);
+            
+            $pruned = (int) $radiusServer->tombstones_pruned_id;
+            $reset = $since < $pruned;
+            $from = max($since, $pruned);
+            
+            $tombstones = VoucherTombstone::where('radius_server_id', $radiusServer->id)
+                ->where('id', '>', $from)
+                ->orderBy('id')
+                ->limit($limit + 1)
+                ->get(['id', 'username']);
+            
+            $hasMore = $tombstones->count() > $limit;
+            $tombstones = $tombstones->take($limit);
+            $cursor = $tombstones->isEmpty() ? $from : $tombstones->last()->id;
+            
+            $usernames = $tombstones->pluck('username')->unique()->values();
+            
+            // Skip vouchers that were deleted and then created again
+            if ($usernames->isNotEmpty()) {
+                $linkedRouterIds = \App\Models\Router::where('radius_server_id', $radiusServer->id)
+                    ->pluck('id')
+                    ->toArray();
+                
+                $existing = Voucher::whereIn('router_id', $linkedRouterIds)
+                    ->whereIn('username', $usernames)
+                    ->pluck('username')
+                    ->toArray();
+                
+                $usernames = $usernames->diff($existing)->values();
+            }
+            
+            return response()->json([
+                'success' => true,
+                'usernames' => $usernames,
+                'cursor' => $cursor,
+                'has_more' => $hasMore,
+                'reset' => $reset,
+            ], 200);
+        
+        } catch (\Illuminate\Validation\ValidationException $e) {
+            return response()->json([
+                'error' => 'Validation failed',
+                'details' => $e->errors()
+            ], 422);
+        
+        } catch (\Exception $e) {
+            Log::error('Failed to read voucher tombstones', [
+                'error' => $e->getMessage(),
+                'ip' => $request->ip(),
+            ]);
+            
+            return response()->json([
+                'error' => 'Internal server error',
+                'message' => config('app.debug') ? $e->getMessage() : 'An error occurred'
+            ], 500);
+        }
+    }
+
+    /**
+     * Resolve the active RADIUS server from the Bearer token
+     * Tokens are encrypted in the database, so decrypted values are compared
+     *
+     * @param Request $request
+     * @return RadiusServer|JsonResponse The server, or a 401 response
+     */
+    private function authenticatedServer(Request $request): RadiusServer|JsonResponse
+    {
+        $providedToken = $request->bearerToken();
+        
+        if (!$providedToken) {
+            return response()->json([
+                'error' => 'Missing Authorization header'
+            ], 401);
+        }
+        
+        $radiusServer = RadiusServer::where('is_active', true)
+            ->get()
+            ->first(function ($server) use ($providedToken) {
+                return hash_equals((string) $server->auth_token, $providedToken);
+            });
+        
+        if (!$radiusServer) {
+            Log::warning('Invalid RADIUS server token', [
+                'ip' => $request->ip(),
+                'path' => $request->path(),
+                'token_preview' => substr($providedToken, 0, 10) . '...'
+            ]);
+            
+            return response()->json([
+                'error' => 'Invalid or inactive RADIUS server token'
+            ], 401);
+        }
+        
+        return $radiusServer;
+    }
 }
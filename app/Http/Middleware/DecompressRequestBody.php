@@ -0,0 +1,52 @@
+<?php
+
+namespace App\Http\Middleware;
+
+use Closure;
+use Illuminate\Http\Request;
+use Symfony\Component\HttpFoundation\InputBag;
+use Symfony\Component\HttpFoundation\Response;
+
+class DecompressRequestBody
+{
+    /**
+     * Maximum size of an inflated request body (protects against gzip bombs).
+     */
+    private const MAX_INFLATED_BYTES = 64 * 1024 * 1024;
+
+    /**
+     * Set on every response to a gzip body, so the client can tell this
+     * middleware's responses (including validation errors) from those of a
+     * server that does not inflate request bodies.
+     */
+    public const INFLATED_HEADER = 'X-Request-Body-Inflated';
+
+    /**
+     * Inflate gzip-compressed JSON bodies sent by the RADIUS server scripts.
+     */
+    public function handle(Request $request, Closure $next): Response
+    {
+        if (strtolower((string) $request->header('Content-Encoding')) !== 'gzip') {
+            return $next($request);
+        }
+
+        $content = @gzdecode($request->getContent(), self::MAX_INFLATED_BYTES);
+
+        if ($content === false) {
+            return response()->json([
+                'error' => 'Invalid gzip request body'
+            ], 400)->header(self::INFLATED_HEADER, 'gzip');
+        }
+
+        $json = new InputBag((array) json_decode($content ?: '[]', true));
+
+        $request->headers->remove('Content-Encoding');
+        $request->setJson($json);
+        $request->request = $json;
+
+        $response = $next($request);
+        $response->headers->set(self::INFLATED_HEADER, 'gzip');
+
+        return $response;
+    }
+}
@@ -51,6 +51,7 @@ class RadiusServer extends Model
         'retries' => 'integer',
         'ssh_port' => 'integer',
         'installed_at' => 'datetime',
+        'tombstones_pruned_id' => 'integer',
     ];
 
     /**
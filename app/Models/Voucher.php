@@ -36,6 +36,14 @@ class Voucher extends Model
         'radius_sync_status' => 'string',
     ];
 
+    protected static function booted(): void
+    {
+        // Feed for the RADIUS cleanup script (POST /api/radius/voucher-tombstones)
+        static::deleted(function (Voucher $voucher) {
+            VoucherTombstone::record($voucher);
+        });
+    }
+
     public function user()
     {
         return $this->belongsTo(User::class);
@@ -0,0 +1,64 @@
+<?php
+
+namespace App\Models;
+
+use Illuminate\Database\Eloquent\Model;
+use Illuminate\Database\Eloquent\Prunable;
+
+class VoucherTombstone extends Model
+{
+    use Prunable;
+
+    const UPDATED_AT = null;
+
+    protected $fillable = [
+        'radius_server_id',
+        'username',
+        'reason',
+    ];
+
+    /**
+     * Get the prunable model query.
+     * Tombstones older than 30 days are deleted; a RADIUS server whose
+     * cursor is older than that falls back to a full reconciliation.
+     */
+    public function prunable()
+    {
+        return static::where('created_at', '<', now()->subDays(30));
+    }
+
+    /**
+     * Record the pruned id on the tombstone's RADIUS server, so its feed
+     * only reports a reset when its own tombstones were pruned past the
+     * cursor.
+     */
+    protected function pruning()
+    {
+        RadiusServer::whereKey($this->radius_server_id)
+            ->where('tombstones_pruned_id', '<', $this->id)
+            ->update(['tombstones_pruned_id' => $this->id]);
+    }
+
+    public function radiusServer()
+    {
+        return $this->belongsTo(RadiusServer::class);
+    }
+
+    /**
+     * Record a deleted voucher for the RADIUS server of its router.
+     */
+    public static function record(Voucher $voucher, string $reason = 'deleted'): ?self
+    {
+        $radiusServerId = Router::whereKey($voucher->router_id)->value('radius_server_id');
+
+        if (!$radiusServerId) {
+            return null;
+        }
+
+        return static::create([
+            'radius_server_id' => $radiusServerId,
+            'username' => $voucher->username,
+            'reason' => $reason,
+        ]);
+    }
+}
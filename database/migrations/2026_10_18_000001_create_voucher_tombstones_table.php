@@ -0,0 +1,38 @@
+<?php
+
+use Illuminate\Database\Migrations\Migration;
+use Illuminate\Database\Schema\Blueprint;
+use Illuminate\Support\Facades\Schema;
+
+return new class extends Migration
+{
+    /**
+     * Run the migrations.
+     */
+    public function up(): void
+    {
+        Schema::create('voucher_tombstones', function (Blueprint $table) {
+            $table->id();
+
+            // RADIUS server the voucher was synced to (snapshot at deletion time)
+            $table->foreignId('radius_server_id')->constrained('radius_servers')->cascadeOnDelete();
+            $table->string('username');
+            $table->string('reason')->nullable();
+
+            $table->timestamp('created_at')->nullable();
+
+            // Cursor reads: WHERE radius_server_id = ? AND id > ? ORDER BY id
+            $table->index(['radius_server_id', 'id']);
+            // Index for pruning queries
+            $table->index('created_at');
+        });
+    }
+
+    /**
+     * Reverse the migrations.
+     */
+    public function down(): void
+    {
+        Schema::dropIfExists('voucher_tombstones');
+    }
+};
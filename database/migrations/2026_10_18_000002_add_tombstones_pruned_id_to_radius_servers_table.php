@@ -0,0 +1,30 @@
+<?php
+
+use Illuminate\Database\Migrations\Migration;
+use Illuminate\Database\Schema\Blueprint;
+use Illuminate\Support\Facades\Schema;
+
+return new class extends Migration
+{
+    /**
+     * Run the migrations.
+     */
+    public function up(): void
+    {
+        Schema::table('radius_servers', function (Blueprint $table) {
+            // Highest voucher_tombstones id of this server removed by model:prune;
+            // a feed cursor below it may have missed deletions
+            $table->unsignedBigInteger('tombstones_pruned_id')->default(0);
+        });
+    }
+
+    /**
+     * Reverse the migrations.
+     */
+    public function down(): void
+    {
+        Schema::table('radius_servers', function (Blueprint $table) {
+            $table->dropColumn('tombstones_pruned_id');
+        });
+    }
+};
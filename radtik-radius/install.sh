@@ -7,7 +7,7 @@
 # This script installs:
 # 1. FreeRADIUS with SQLite backend
 # 2. Flask API Server for push-based Laravel integration (Laravel → RADIUS)
-# 3. Activation sync cron job (RADIUS → Laravel)
+# 3. Activation sync service (RADIUS → Laravel)
 ###############################################################################
 
 set -e  # Exit on any error
@@ -35,6 +35,8 @@ FREERADIUS_DIR="/etc/freeradius/3.0"
 SCRIPTS_DIR="$INSTALL_DIR/scripts"
 API_SERVICE_NAME="radtik-radius-api"
 API_SERVICE_FILE="/etc/systemd/system/${API_SERVICE_NAME}.service"
+SYNC_SERVICE_NAME="radtik-activation-sync"
+SYNC_SERVICE_FILE="/etc/systemd/system/${SYNC_SERVICE_NAME}.service"
 
 ###############################################################################
 # Helper Functions
@@ -79,8 +81,8 @@ echo ""
 echo "This installer will set up:"
 echo "  ${GREEN}✓${NC} FreeRADIUS 3.0 with SQLite backend"
 echo "  ${GREEN}✓${NC} Flask API Server for push-based voucher sync"
-echo "  ${GREEN}✓${NC} Activation sync cron job (RADIUS → Laravel)"
-echo "  ${GREEN}✓${NC} Cleanup orphaned vouchers cron job (runs every 6 hours)"
+echo "  ${GREEN}✓${NC} Activation sync service (RADIUS → Laravel)"
+echo "  ${GREEN}✓${NC} Cleanup orphaned vouchers cron job (runs every minute)"
 echo "  ${GREEN}✓${NC} Optimized database with indexes"
 echo "  ${GREEN}✓${NC} Firewall configuration (port 5000)"
 echo ""
@@ -165,6 +167,7 @@ safe_copy() {
 # Copy configuration files
 safe_copy "$INSTALL_DIR/clients.conf" "$FREERADIUS_DIR/clients.conf"
 safe_copy "$INSTALL_DIR/mods-available/sql" "$FREERADIUS_DIR/mods-available/sql"
+safe_copy "$INSTALL_DIR/mods-available/radtik_authorize" "$FREERADIUS_DIR/mods-available/radtik_authorize"
 safe_copy "$INSTALL_DIR/mods-config/sql/main/sqlite/queries.conf" "$FREERADIUS_DIR/mods-config/sql/main/sqlite/queries.conf"
 safe_copy "$INSTALL_DIR/sites-enabled/default" "$FREERADIUS_DIR/sites-enabled/default"
 
@@ -237,9 +240,12 @@ sqlite3 "$FREERADIUS_DIR/sqlite/radius.db" "ALTER TABLE radpostauth ADD COLUMN p
 
 echo "  → Creating indexes for performance"
 sqlite3 "$FREERADIUS_DIR/sqlite/radius.db" "CREATE INDEX IF NOT EXISTS idx_radpostauth_processed ON radpostauth(processed, authdate);" > /dev/null
-sqlite3 "$FREERADIUS_DIR/sqlite/radius.db" "CREATE INDEX IF NOT EXISTS idx_radpostauth_username ON radpostauth(username);" > /dev/null
-sqlite3 "$FREERADIUS_DIR/sqlite/radius.db" "CREATE INDEX IF NOT EXISTS idx_radcheck_username ON radcheck(username);" > /dev/null
-sqlite3 "$FREERADIUS_DIR/sqlite/radius.db" "CREATE INDEX IF NOT EXISTS idx_radreply_username ON radreply(username);" > /dev/null
+
+echo "  → Applying schema migrations (composite/covering indexes)"
+python3 "$SCRIPT_DIR/scripts/migrate.py" --db "$FREERADIUS_DIR/sqlite/radius.db" > /dev/null || {
+    print_error "Schema migration failed (run scripts/migrate.py manually for details)"
+    exit 1
+}
 
 # Fix permissions on WAL files if they exist
 chown freerad:freerad "$FREERADIUS_DIR/sqlite"/* 2>/dev/null || true
@@ -344,6 +350,11 @@ API_TOKEN=$(openssl rand -hex 32)
 # Update config.ini with token
 sed -i "s/auth_token = your-secure-token-here/auth_token = $API_TOKEN/" config.ini
 
+# Same token for the optional rlm_rest authorize module (not enabled by default)
+if [ -f "$FREERADIUS_DIR/mods-available/radtik_authorize" ]; then
+    sed -i "s/YOUR_AUTH_TOKEN/$API_TOKEN/" "$FREERADIUS_DIR/mods-available/radtik_authorize"
+fi
+
 # Update database path
 sed -i "s|db_path = /var/lib/freeradius/radius.db|db_path = $FREERADIUS_DIR/sqlite/radius.db|" config.ini
 
@@ -489,40 +500,77 @@ fi
 # Make scripts executable
 chmod +x "$SCRIPTS_DIR/activation-sync.py"
 chmod +x "$SCRIPTS_DIR/cleanup-orphaned.py"
+chmod +x "$SCRIPTS_DIR/follow-changes.py"
+chmod +x "$SCRIPTS_DIR/archive-postauth.py"
+chmod +x "$SCRIPTS_DIR/rollup-usage.py"
 
-# Create log files
+# Create log files (activation sync runs as freerad)
 touch /var/log/radtik-activation-sync.log
 touch /var/log/radtik-cleanup-orphaned.log
+chown freerad:freerad /var/log/radtik-activation-sync.log
 chmod 644 /var/log/radtik-activation-sync.log
 chmod 644 /var/log/radtik-cleanup-orphaned.log
+touch /var/log/radtik-replication-follower.log
+chown freerad:freerad /var/log/radtik-replication-follower.log
+touch /var/log/radtik-archive-postauth.log
+chown freerad:freerad /var/log/radtik-archive-postauth.log
+touch /var/log/radtik-rollup-usage.log
+chown freerad:freerad /var/log/radtik-rollup-usage.log
+
+# Archive database directory (also created by the services' StateDirectory)
+install -d -o freerad -g freerad -m 0750 /var/lib/radtik-radius
 
 print_info "Python scripts verified and configured"
 echo ""
 
 ###############################################################################
-# Step 2: Setup activation sync cron job
+# Step 2: Setup activation sync service and cleanup cron job
 ###############################################################################
-echo -e "${YELLOW}[Sync 2/3] Setting up cron job for activation sync...${NC}"
+echo -e "${YELLOW}[Sync 2/3] Setting up activation sync service and cleanup cron job...${NC}"
+
+# Activation sync runs as a daemon (sends new activations within ~1 second)
+cp "$INSTALL_DIR/${SYNC_SERVICE_NAME}.service" "$SYNC_SERVICE_FILE"
+systemctl daemon-reload
+systemctl enable $SYNC_SERVICE_NAME > /dev/null 2>&1
+systemctl restart $SYNC_SERVICE_NAME || true
+
+# Replication follower service: installed but only enabled on follower
+# servers ([replication] primary_url, see config.ini)
+cp "$INSTALL_DIR/radtik-replication-follower.service" /etc/systemd/system/radtik-replication-follower.service
+systemctl daemon-reload
 
 CRON_FILE="/etc/cron.d/radtik-sync"
 
 cat > "$CRON_FILE" << 'EOF'
 # RadTik FreeRADIUS Synchronization Jobs
 
-# Sync voucher activations to Laravel every 5 minutes
-# Monitors radpostauth for new authentications and updates Laravel
-*/5 * * * * root /usr/bin/python3 /opt/radtik-radius/scripts/activation-sync.py >> /var/log/radtik-activation-sync.log 2>&1
+# Voucher activations are synced by the radtik-activation-sync service
+# (activation-sync.py --daemon); run it manually as freerad for a one-off sync
+
+# Cleanup orphaned vouchers every minute
+# Applies vouchers deleted in RADTik (tombstone feed); a full reconciliation
+# runs every [cleanup] reconcile_interval_hours. flock skips overlapping runs
+* * * * * root /usr/bin/flock -n /run/radtik-cleanup-orphaned.lock /usr/bin/python3 /opt/radtik-radius/scripts/cleanup-orphaned.py >> /var/log/radtik-cleanup-orphaned.log 2>&1
 
-# Cleanup orphaned vouchers every 6 hours (at minute 15)
-# Removes vouchers from RADIUS that don't exist in RADTik database
-15 */6 * * * root /usr/bin/python3 /opt/radtik-radius/scripts/cleanup-orphaned.py >> /var/log/radtik-cleanup-orphaned.log 2>&1
+# Move radpostauth rows older than [archive] retention_hours to the archive
+# database every 5 minutes (runs as freerad, which also owns the archive)
+*/5 * * * * freerad /usr/bin/flock -n /var/lib/radtik-radius/archive-postauth.lock /usr/bin/python3 /opt/radtik-radius/scripts/archive-postauth.py > /dev/null 2>&1
+
+# Roll up closed radacct sessions into daily usage every minute
+* * * * * freerad /usr/bin/flock -n /var/lib/radtik-radius/rollup-usage.lock /usr/bin/python3 /opt/radtik-radius/scripts/rollup-usage.py > /dev/null 2>&1
 
 EOF
 
 chmod 644 "$CRON_FILE"
 
-print_info "Activation sync cron job installed: runs every 5 minutes"
-print_info "Cleanup orphaned cron job installed: runs every 6 hours"
+if systemctl is-active --quiet $SYNC_SERVICE_NAME; then
+    print_info "Activation sync service installed and running: $SYNC_SERVICE_NAME"
+else
+    print_warning "Activation sync service not running yet (set [laravel] api_url, then: systemctl restart $SYNC_SERVICE_NAME)"
+fi
+print_info "Cleanup orphaned cron job installed: runs every minute (full reconciliation every 6 hours)"
+print_info "Post-auth archive cron job installed: runs every 5 minutes"
+print_info "Usage rollup cron job installed: runs every minute"
 echo ""
 
 ###############################################################################
@@ -616,14 +664,14 @@ echo "  5. Link router to RADIUS server"
 echo "  6. Start queue worker: php artisan queue:work"
 echo ""
 
-echo -e "${GREEN}✓ Synchronization cron jobs installed${NC}"
+echo -e "${GREEN}✓ Synchronization installed${NC}"
 echo "  • Script: $SCRIPTS_DIR/activation-sync.py"
+echo "  • Activation sync: continuous (systemctl status $SYNC_SERVICE_NAME)"
 echo "  • Cron file: /etc/cron.d/radtik-sync"
-echo "  • Activation sync: runs every 5 minutes"
 echo "  • Log: /var/log/radtik-activation-sync.log"
 echo ""
 echo "  • Script: $SCRIPTS_DIR/cleanup-orphaned.py"
-echo "  • Cleanup orphaned: runs every 6 hours"
+echo "  • Cleanup orphaned: runs every minute (full reconciliation every 6 hours)"
 echo "  • Log: /var/log/radtik-cleanup-orphaned.log"
 echo ""
 echo -e "${YELLOW}TODO:${NC} Configure Laravel API URL in config:"
@@ -3,21 +3,47 @@
 RadTik Activation Sync Script
 Polls FreeRADIUS radpostauth table for new authentications and syncs to Laravel.
 
-This script runs via cron and:
-1. Checks radpostauth table for unique Access-Accept entries from last 24 hours
-2. POSTs activation data to Laravel API
-3. Tracks last sync attempt to avoid duplicates
-4. Verifies auth token with Laravel's radius_servers table
+Each sync:
+1. Reads radpostauth rows not yet marked processed (within the last 24 hours)
+2. Stores the unique Access-Accept entries in the durable activation outbox
+   and marks the rows processed = 1
+3. Drains the outbox: POSTs size-capped chunks to Laravel API, applies the
+   MAC bindings returned and records each acknowledgement
+
+While Laravel is unreachable activations wait in the outbox and drain
+attempts back off exponentially (see activation_outbox.py).
+
+Each run only reads rows written since the previous successful run (via the
+idx_radpostauth_processed index), in batches of activation_batch_size rows.
+
+Usage:
+    python3 activation-sync.py            # single run (cron)
+    python3 activation-sync.py --daemon   # long-running (radtik-activation-sync.service)
+
+In daemon mode the database connection and the HTTP keep-alive session to
+Laravel stay open. New authentications are detected by watching the SQLite
+database and WAL file (a stat() call, no query) with an adaptive poll
+interval, and are sent as micro-batches within about a second.
 """
 
+import argparse
 import sqlite3
 import requests
 import configparser
 import logging
+import signal
 import sys
 import os
+import threading
+import time
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+import change_log
+import radius_store
+from activation_outbox import outbox_from_config
+from db_pool import pool_from_config
+from laravel_client import client_from_config
 
 # Configure logging
 logging.basicConfig(
@@ -44,6 +70,18 @@ config.read(config_path)
 RADIUS_DB_PATH = config.get('radius', 'db_path', fallback='/etc/freeradius/3.0/sqlite/radius.db')
 LARAVEL_API_URL = config.get('laravel', 'api_url', fallback='')
 AUTH_TOKEN = config.get('api', 'auth_token', fallback='')
+ACTIVATION_WINDOW_HOURS = config.getfloat('sync', 'activation_window_hours', fallback=24)
+ACTIVATION_BATCH_SIZE = config.getint('sync', 'activation_batch_size', fallback=1000)
+
+# Daemon mode: stat() poll interval range, coalescing delay and safety re-check
+DAEMON_MIN_POLL = config.getfloat('sync', 'daemon_min_poll_ms', fallback=50) / 1000.0
+DAEMON_MAX_POLL = config.getfloat('sync', 'daemon_max_poll_ms', fallback=500) / 1000.0
+DAEMON_BATCH_DELAY = config.getfloat('sync', 'daemon_batch_delay_ms', fallback=200) / 1000.0
+DAEMON_FULL_CHECK = config.getfloat('sync', 'daemon_full_check_seconds', fallback=30)
+DAEMON_MAX_BACKOFF = config.getfloat('sync', 'daemon_max_backoff_seconds', fallback=60)
+
+# MAC bindings written here are logged for replication followers
+CHANGELOG_ENABLED = change_log.changelog_enabled(config)
 
 # Validate configuration
 if not LARAVEL_API_URL:
@@ -59,63 +97,95 @@ if not os.path.exists(RADIUS_DB_PATH):
     sys.exit(1)
 
 
-def get_db_connection():
-    """Get SQLite database connection"""
-    try:
-        conn = sqlite3.connect(RADIUS_DB_PATH, timeout=10)
-        conn.row_factory = sqlite3.Row
-        return conn
-    except sqlite3.Error as e:
-        logger.error(f"Database connection error: {e}")
-        raise
+# Shared connection pool (a single connection is enough for this script)
+db_pool = pool_from_config(config, RADIUS_DB_PATH, size=1)
+
+# Durable outbox of activations not yet acknowledged by Laravel
+try:
+    outbox = outbox_from_config(config)
+except sqlite3.Error as e:
+    logger.error(f"Activation outbox unavailable: {e}")
+    sys.exit(1)
+
+# Pooled keep-alive client for Laravel (reused across batches and daemon cycles)
+laravel = client_from_config(config)
+
+# Acknowledged outbox entries are purged at most once per hour
+_last_purge = 0.0
 
 
-def fetch_unique_activations_last_24h() -> List[Dict]:
+def fetch_unprocessed_activations(limit: int) -> Optional[Tuple[List[int], List[Dict]]]:
     """
-    Fetch unique successful authentications from last 24 hours
-    Returns distinct combinations of username, nas_identifier, and mac address
+    Fetch the next batch of unprocessed radpostauth rows
+    
+    Rows older than the activation window are ignored (as before the
+    processed flag was used), so an upgrade does not replay old history.
+    
+    Returns:
+        (row ids in the batch, unique activations by username + nas + mac
+        with their first authentication time), or None on a database error
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get activations from last 24 hours, distinct by username + nas + mac
-        yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
-        
-        query = """
-            SELECT 
-                username,
-                nas_identifier,
-                calling_station_id,
-                MIN(authdate) as first_auth_date
-            FROM radpostauth
-            WHERE reply = 'Access-Accept'
-              AND authdate > ?
-            GROUP BY username, 
-                     nas_identifier,
-                     calling_station_id
-            ORDER BY first_auth_date ASC
-        """
-        
-        cursor.execute(query, (yesterday,))
-        rows = cursor.fetchall()
-        conn.close()
-        
-        # Convert to list of dicts
-        activations = []
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            since = (datetime.now() - timedelta(hours=ACTIVATION_WINDOW_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+            
+            # Range scan on idx_radpostauth_processed (processed, authdate)
+            query = """
+                SELECT 
+                    id,
+                    reply,
+                    username,
+                    nas_identifier,
+                    calling_station_id,
+                    authdate
+                FROM radpostauth
+                WHERE processed = 0
+                  AND authdate > ?
+                ORDER BY authdate, id
+                LIMIT ?
+            """
+            
+            cursor.execute(query, (since, limit))
+            rows = cursor.fetchall()
+        
+        row_ids = [row['id'] for row in rows]
+        
+        # Distinct by username + nas + mac, keeping the first authentication
+        activations = {}
         for row in rows:
-            activations.append({
-                'username': row['username'],
-                'nas_identifier': row['nas_identifier'],
-                'calling_station_id': row['calling_station_id'],
-                'authenticated_at': row['first_auth_date']
-            })
+            if row['reply'] != 'Access-Accept':
+                continue
+            key = (row['username'], row['nas_identifier'], row['calling_station_id'])
+            if key not in activations:
+                activations[key] = {
+                    'username': row['username'],
+                    'nas_identifier': row['nas_identifier'],
+                    'calling_station_id': row['calling_station_id'],
+                    'authenticated_at': row['authdate']
+                }
         
-        return activations
+        return row_ids, list(activations.values())
         
     except sqlite3.Error as e:
         logger.error(f"Database query error: {e}")
-        return []
+        return None
+
+
+def mark_processed(row_ids: List[int]) -> bool:
+    """Mark radpostauth rows as synced to Laravel"""
+    try:
+        with db_pool.connection() as conn:
+            conn.executemany(
+                "UPDATE radpostauth SET processed = 1 WHERE id = ?",
+                [(row_id,) for row_id in row_ids]
+            )
+            conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Failed to mark {len(row_ids)} row(s) processed: {e}")
+        return False
 
 
 def post_activations_to_laravel(activations: List[Dict]) -> Dict:
@@ -128,24 +198,14 @@ def post_activations_to_laravel(activations: List[Dict]) -> Dict:
         return {'success': True, 'mac_bindings': []}
     
     try:
-        url = f"{LARAVEL_API_URL}/api/radius/activations"
-        headers = {
-            'Authorization': f'Bearer {AUTH_TOKEN}',
-            'Content-Type': 'application/json'
-        }
-        
         payload = {
             'activations': activations
         }
         
         logger.info(f"Posting {len(activations)} unique activations to Laravel...")
         
-        response = requests.post(
-            url,
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        # Pooled connection, gzip body, retries with jitter (laravel_client.py)
+        response = laravel.post('/api/radius/activations', payload)
         
         if response.status_code == 200:
             result = response.json()
@@ -153,81 +213,45 @@ def post_activations_to_laravel(activations: List[Dict]) -> Dict:
             return result
         else:
             logger.error(f"Laravel API error: [{response.status_code}] {response.text}")
-            return {'success': False, 'mac_bindings': []}
+            return {'success': False, 'mac_bindings': [], 'error': f"HTTP {response.status_code}"}
             
     except requests.exceptions.Timeout:
         logger.error("Laravel API request timed out")
-        return {'success': False, 'mac_bindings': []}
+        return {'success': False, 'mac_bindings': [], 'error': 'Timeout'}
     except requests.exceptions.ConnectionError as e:
         logger.error(f"Cannot connect to Laravel API: {e}")
-        return {'success': False, 'mac_bindings': []}
+        return {'success': False, 'mac_bindings': [], 'error': f"Connection error: {e}"}
     except Exception as e:
         logger.error(f"Failed to post activations: {e}")
-        return {'success': False, 'mac_bindings': []}
+        return {'success': False, 'mac_bindings': [], 'error': str(e)}
 
 
 def sync_mac_bindings_to_radius(mac_bindings: List[Dict]) -> bool:
     """
     Sync MAC bindings directly to RADIUS database
     Adds Calling-Station-Id check to radcheck table to lock voucher to MAC
+    (set-based upsert shared with the API, see radius_store.sync_mac_bindings)
     Returns True if successful
     """
     if not mac_bindings:
         return True
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        synced = 0
-        updated = 0
-        
-        logger.info(f"Syncing {len(mac_bindings)} MAC bindings to RADIUS database...")
-        
-        for binding in mac_bindings:
-            try:
-                username = binding['username']
-                mac_address = binding['mac_address']
-                
-                # Check if MAC binding already exists for this user
-                cursor.execute(
-                    "SELECT id, value FROM radcheck WHERE username = ? AND attribute = 'Calling-Station-Id'",
-                    (username,)
-                )
-                existing = cursor.fetchone()
-                
-                if existing:
-                    # Update existing MAC binding (in case MAC changed)
-                    existing_mac = existing['value']
-                    
-                    if existing_mac != mac_address:
-                        cursor.execute(
-                            "UPDATE radcheck SET value = ? WHERE username = ? AND attribute = 'Calling-Station-Id'",
-                            (mac_address, username)
-                        )
-                        updated += 1
-                        logger.info(f"Updated MAC for {username}: {existing_mac} → {mac_address}")
-                    else:
-                        logger.debug(f"MAC binding unchanged for {username}: {mac_address}")
-                        synced += 1
-                else:
-                    # Insert new MAC binding
-                    cursor.execute(
-                        "INSERT INTO radcheck (username, attribute, op, value) VALUES (?, ?, ?, ?)",
-                        (username, 'Calling-Station-Id', '==', mac_address)
-                    )
-                    synced += 1
-                    logger.info(f"Added MAC binding for {username}: {mac_address}")
-                
-            except sqlite3.Error as e:
-                logger.error(f"Database error for {username}: {e}")
-                continue
-        
-        # Commit all changes
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            result = radius_store.sync_mac_bindings(conn, mac_bindings)
+            
+            if 'database_error' in result:
+                conn.rollback()
+                logger.error(f"Failed to sync MAC bindings: {result['database_error']}")
+                return False
+            
+            if CHANGELOG_ENABLED and result['inserted'] + result['updated']:
+                change_log.record(conn, 'sync_mac_bindings', {'bindings': mac_bindings})
+            
+            conn.commit()
         
-        logger.info(f"✓ MAC bindings synced: {synced} added, {updated} updated")
+        logger.info(f"✓ MAC bindings synced: {result['inserted']} added, {result['updated']} updated, "
+                    f"{result['unchanged']} unchanged, {result['failed']} invalid")
         return True
         
     except sqlite3.Error as e:
@@ -238,28 +262,78 @@ def sync_mac_bindings_to_radius(mac_bindings: List[Dict]) -> bool:
         return False
 
 
-def main():
-    """Main function - fetches and posts activations"""
-    try:
-        logger.info("Starting activation sync...")
+def capture_activations() -> Optional[int]:
+    """
+    Move unprocessed radpostauth rows into the outbox, batch by batch
+    
+    Rows are marked processed only after their activations are stored in
+    the outbox, so a crash in between at most enqueues them twice (the
+    outbox skips pending duplicates).
+    
+    Returns:
+        Number of new rows, or None on a database error
+    """
+    total_rows = 0
+    
+    while True:
+        batch = fetch_unprocessed_activations(ACTIVATION_BATCH_SIZE)
+        if batch is None:
+            return None
+        
+        row_ids, activations = batch
+        
+        if not row_ids:
+            break
         
-        # Fetch unique activations from last 24 hours
-        activations = fetch_unique_activations_last_24h()
+        if activations:
+            try:
+                queued = outbox.enqueue(activations)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to store activations in outbox: {e}")
+                return None
+            logger.info(f"Queued {queued} activation(s) from {len(row_ids)} new row(s)")
         
-        if not activations:
-            logger.info("No activations found in last 24 hours")
-            return
+        if not mark_processed(row_ids):
+            return None
         
-        logger.info(f"Found {len(activations)} unique activation(s) from last 24 hours")
+        total_rows += len(row_ids)
+        
+        if len(row_ids) < ACTIVATION_BATCH_SIZE:
+            break
+    
+    return total_rows
+
+
+def drain_outbox() -> Optional[int]:
+    """
+    POST pending outbox entries to Laravel, one size-capped chunk at a time
+    
+    Returns:
+        Activations acknowledged by Laravel, or None if a chunk failed or
+        the outbox is still backing off (entries stay pending)
+    """
+    retry_in = outbox.retry_in()
+    if retry_in > 0:
+        logger.info(f"Laravel retry backoff: {outbox.pending()} activation(s) queued, next attempt in {retry_in:.0f}s")
+        return None
+    
+    sent = 0
+    
+    while True:
+        ids, activations = outbox.next_chunk()
+        
+        if not ids:
+            break
+        
+        started = time.monotonic()
         
         # Post to Laravel
         result = post_activations_to_laravel(activations)
         
         if not result.get('success'):
-            logger.error("Failed to sync activations")
-            sys.exit(1)
-        
-        logger.info("Activation sync completed successfully")
+            backoff = outbox.record_failure(ids, result.get('error', 'Laravel API error'))
+            logger.error(f"Failed to sync activations, {outbox.pending()} queued in outbox, retrying in {backoff:.0f}s")
+            return None
         
         # Check if Laravel returned MAC bindings to sync
         mac_bindings = result.get('mac_bindings', [])
@@ -268,14 +342,151 @@ def main():
             logger.info(f"Received {len(mac_bindings)} MAC binding(s) to sync to RADIUS")
             
             # Sync MAC bindings to RADIUS database
-            binding_success = sync_mac_bindings_to_radius(mac_bindings)
+            if not sync_mac_bindings_to_radius(mac_bindings):
+                # Keep the chunk pending so Laravel returns the bindings again
+                backoff = outbox.record_failure(ids, 'MAC binding sync failed')
+                logger.warning(f"MAC binding sync failed, chunk will be retried in {backoff:.0f}s")
+                return None
             
-            if binding_success:
-                logger.info("MAC binding sync completed successfully")
-            else:
-                logger.warning("MAC binding sync failed, but activations were processed")
+            logger.info("MAC binding sync completed successfully")
+        
+        outbox.ack(ids, time.monotonic() - started, len(mac_bindings))
+        sent += len(ids)
+    
+    return sent
+
+
+def sync_pending() -> Optional[Tuple[int, int]]:
+    """
+    Queue new activations in the outbox and drain it to Laravel
+    
+    Returns:
+        (new rows, activations sent), or None if a step failed (new rows
+        stay unprocessed, queued activations stay in the outbox)
+    """
+    global _last_purge
+    
+    total_rows = capture_activations()
+    total_sent = drain_outbox()
+    
+    if time.monotonic() - _last_purge >= 3600:
+        _last_purge = time.monotonic()
+        try:
+            purged = outbox.purge()
+            if purged:
+                logger.info(f"Purged {purged} acknowledged outbox entr{'y' if purged == 1 else 'ies'}")
+        except sqlite3.Error as e:
+            logger.warning(f"Outbox purge failed: {e}")
+    
+    if total_rows is None or total_sent is None:
+        return None
+    
+    return total_rows, total_sent
+
+
+def _db_signature() -> Tuple:
+    """Size and mtime of the database and its WAL file (changes on every commit)"""
+    signature = []
+    for path in (RADIUS_DB_PATH, RADIUS_DB_PATH + '-wal'):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def run_daemon():
+    """Watch the database and sync new activations until SIGTERM"""
+    stop = threading.Event()
+    
+    def handle_signal(signum, frame):
+        logger.info(f"Received signal {signum}, stopping...")
+        stop.set()
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    
+    logger.info(f"Activation sync daemon started (poll {DAEMON_MIN_POLL * 1000:.0f}-{DAEMON_MAX_POLL * 1000:.0f} ms)")
+    
+    last_signature = None
+    last_sync = 0.0
+    poll = DAEMON_MIN_POLL
+    failures = 0
+    
+    while not stop.is_set():
+        signature = _db_signature()
+        full_check_due = time.monotonic() - last_sync >= DAEMON_FULL_CHECK
+        
+        if signature == last_signature and not full_check_due:
+            # Idle: back off towards the maximum poll interval
+            stop.wait(poll)
+            poll = min(poll * 2, DAEMON_MAX_POLL)
+            continue
+        
+        if signature != last_signature and last_signature is not None:
+            # Let a burst of authentications land, then send them as one micro-batch
+            stop.wait(DAEMON_BATCH_DELAY)
+        
+        # Taken before reading, so commits during the sync trigger another cycle
+        last_signature = _db_signature()
+        last_sync = time.monotonic()
+        poll = DAEMON_MIN_POLL
+        
+        try:
+            result = sync_pending()
+        except Exception as e:
+            logger.error(f"Sync error: {e}", exc_info=True)
+            result = None
+        
+        if result is None:
+            failures += 1
+            # Laravel failures follow the outbox backoff (shared with cron runs)
+            backoff = outbox.retry_in() or min(DAEMON_MAX_BACKOFF, 2 ** failures)
+            logger.warning(f"Sync failed ({failures} in a row), retrying in {backoff:.0f}s")
+            # Force a re-check after the backoff even if nothing changed
+            last_signature = None
+            stop.wait(backoff)
+            continue
+        
+        failures = 0
+        rows, activations = result
+        if rows or activations:
+            logger.info(f"Synced {activations} activation(s), {rows} new row(s)")
+    
+    laravel.log_stats()
+    laravel.close()
+    outbox.close()
+    db_pool.close()
+    logger.info("Activation sync daemon stopped")
+
+
+def main():
+    """Main function - single run (cron) or daemon mode"""
+    parser = argparse.ArgumentParser(description='Sync RADIUS activations to Laravel')
+    parser.add_argument('--daemon', action='store_true', help='Run continuously (systemd service)')
+    args = parser.parse_args()
+    
+    if args.daemon:
+        run_daemon()
+        return
+    
+    try:
+        logger.info("Starting activation sync...")
+        
+        result = sync_pending()
+        
+        if result is None:
+            # Queued activations stay in the outbox and are retried on the next run
+            sys.exit(1)
+        
+        total_rows, total_activations = result
+        
+        if total_rows == 0 and total_activations == 0:
+            logger.info("No new authentications since last run")
         else:
-            logger.info("No MAC bindings required")
+            logger.info(f"Activation sync completed: {total_activations} activation(s) sent, {total_rows} new row(s)")
+            laravel.log_stats()
             
     except Exception as e:
         logger.error(f"Sync error: {e}", exc_info=True)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+RadTik Activation Outbox
+Durable queue of activations waiting to be acknowledged by Laravel.
+
+activation-sync.py copies new Access-Accept rows from radpostauth into the
+outbox (a separate SQLite database, not radius.db) and marks them processed,
+then drains the outbox towards Laravel in chunks capped both by entry count
+and by JSON size. While Laravel is unreachable nothing is lost and
+radius.db is not rescanned: pending entries are de-duplicated by
+username + NAS + MAC, drain attempts back off exponentially (the state is
+kept in the outbox, so single cron runs respect it too), and recovery after
+an outage sends the backlog as a sequence of small POSTs. Every accepted
+POST is recorded in activation_outbox_acks; acknowledged entries are purged
+after `retention_hours`.
+"""
+
+import json
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from db_pool import ConnectionPool
+
+logger = logging.getLogger('activation-outbox')
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS activation_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        dedup_key TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        ack_id INTEGER,
+        acked_at TEXT
+    )
+    """,
+    # One pending entry per username + NAS + MAC (keeps the first authentication)
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_activation_outbox_pending_key "
+    "ON activation_outbox(dedup_key) WHERE ack_id IS NULL",
+    "CREATE INDEX IF NOT EXISTS idx_activation_outbox_ack ON activation_outbox(ack_id, id)",
+    """
+    CREATE TABLE IF NOT EXISTS activation_outbox_acks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        acked_at TEXT NOT NULL,
+        entries INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        duration_ms INTEGER NOT NULL,
+        mac_bindings INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS activation_outbox_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        failures INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL DEFAULT 0,
+        last_error TEXT,
+        last_success_at TEXT
+    )
+    """,
+    "INSERT OR IGNORE INTO activation_outbox_state (id) VALUES (1)",
+]
+
+
+def _now() -> str:
+    return datetime.now().isoformat()
+
+
+class ActivationOutbox:
+    """Durable storage for activations not yet acknowledged by Laravel"""
+
+    def __init__(self, db_path: str, chunk_size: int = 500, max_chunk_bytes: int = 262144,
+                 min_backoff: float = 5.0, max_backoff: float = 300.0,
+                 retention_hours: float = 72.0):
+        self.db_path = db_path
+        self.chunk_size = max(1, chunk_size)
+        self.max_chunk_bytes = max_chunk_bytes
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.retention_hours = retention_hours
+        self.pool = ConnectionPool(db_path, size=1)
+
+        with self.pool.connection() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+
+    def enqueue(self, activations: List[Dict]) -> int:
+        """
+        Durably store activations (already pending duplicates are skipped)
+
+        Returns:
+            Number of new outbox entries
+        """
+        rows = []
+        for activation in activations:
+            payload = json.dumps(activation, separators=(',', ':'))
+            key = '\x1f'.join(str(activation.get(field) or '')
+                              for field in ('username', 'nas_identifier', 'calling_station_id'))
+            rows.append((key, payload, len(payload), _now()))
+
+        with self.pool.connection() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO activation_outbox (dedup_key, payload, size, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+            return conn.total_changes - before
+
+    def pending(self) -> int:
+        """Number of entries waiting for an acknowledgement"""
+        with self.pool.connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM activation_outbox WHERE ack_id IS NULL"
+            ).fetchone()[0]
+
+    def next_chunk(self) -> Tuple[List[int], List[Dict]]:
+        """
+        Oldest pending entries, at most chunk_size of them and max_chunk_bytes
+        of JSON (always at least one entry)
+
+        Returns:
+            (entry ids, activations)
+        """
+        ids = []
+        activations = []
+        total_bytes = 0
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT id, payload, size FROM activation_outbox WHERE ack_id IS NULL ORDER BY id LIMIT ?",
+                (self.chunk_size,)
+            ).fetchall()
+
+        for row in rows:
+            if ids and total_bytes + row['size'] > self.max_chunk_bytes:
+                break
+            ids.append(row['id'])
+            activations.append(json.loads(row['payload']))
+            total_bytes += row['size']
+
+        return ids, activations
+
+    def retry_in(self) -> float:
+        """Seconds until the next drain attempt is allowed (0 = now)"""
+        with self.pool.connection() as conn:
+            next_attempt_at = conn.execute(
+                "SELECT next_attempt_at FROM activation_outbox_state WHERE id = 1"
+            ).fetchone()[0]
+        return max(0.0, next_attempt_at - time.time())
+
+    def ack(self, ids: List[int], duration: float, mac_bindings: int = 0):
+        """Record Laravel's acknowledgement of a chunk and reset the backoff"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO activation_outbox_acks (acked_at, entries, bytes, duration_ms, mac_bindings) "
+                "SELECT ?, COUNT(*), COALESCE(SUM(size), 0), ?, ? FROM activation_outbox "
+                f"WHERE id IN ({','.join('?' * len(ids))})",
+                [_now(), int(duration * 1000), mac_bindings] + ids
+            )
+            ack_id = cursor.lastrowid
+            conn.executemany(
+                "UPDATE activation_outbox SET ack_id = ?, acked_at = ? WHERE id = ?",
+                [(ack_id, _now(), entry_id) for entry_id in ids]
+            )
+            conn.execute(
+                "UPDATE activation_outbox_state "
+                "SET failures = 0, next_attempt_at = 0, last_error = NULL, last_success_at = ? WHERE id = 1",
+                (_now(),)
+            )
+            conn.commit()
+
+    def record_failure(self, ids: List[int], error: str) -> float:
+        """
+        Record a failed drain attempt and schedule the next one
+
+        Returns:
+            Backoff in seconds (exponential with jitter, capped at max_backoff)
+        """
+        with self.pool.connection() as conn:
+            failures = conn.execute(
+                "SELECT failures FROM activation_outbox_state WHERE id = 1"
+            ).fetchone()[0] + 1
+            backoff = min(self.max_backoff, self.min_backoff * 2 ** (failures - 1))
+            backoff *= random.uniform(0.5, 1.0)
+
+            conn.execute(
+                "UPDATE activation_outbox_state SET failures = ?, next_attempt_at = ?, last_error = ? WHERE id = 1",
+                (failures, time.time() + backoff, error)
+            )
+            conn.executemany(
+                "UPDATE activation_outbox SET attempts = attempts + 1 WHERE id = ?",
+                [(entry_id,) for entry_id in ids]
+            )
+            conn.commit()
+
+        return backoff
+
+    def purge(self) -> int:
+        """Delete acknowledged entries (and their ack records) older than the retention window"""
+        cutoff = (datetime.now() - timedelta(hours=self.retention_hours)).isoformat()
+
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "DELETE FROM activation_outbox WHERE ack_id IS NOT NULL AND acked_at < ?",
+                (cutoff,)
+            )
+            conn.execute("DELETE FROM activation_outbox_acks WHERE acked_at < ?", (cutoff,))
+            conn.commit()
+            return cursor.rowcount
+
+    def close(self):
+        self.pool.close()
+
+
+def outbox_from_config(config) -> ActivationOutbox:
+    """Build the outbox from the [outbox] section of config.ini"""
+    return ActivationOutbox(
+        config.get('outbox', 'db_path', fallback='/var/lib/radtik-radius/activation-outbox.db'),
+        chunk_size=config.getint('outbox', 'chunk_size', fallback=500),
+        max_chunk_bytes=config.getint('outbox', 'max_chunk_bytes', fallback=262144),
+        min_backoff=config.getfloat('outbox', 'min_backoff_seconds', fallback=5),
+        max_backoff=config.getfloat('outbox', 'max_backoff_seconds', fallback=300),
+        retention_hours=config.getfloat('outbox', 'retention_hours', fallback=72)
+    )
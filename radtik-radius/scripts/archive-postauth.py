@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+RadTik Post-Auth Archiver
+Keeps FreeRADIUS's radpostauth table at about one retention window.
+
+This script runs via cron and:
+1. Moves radpostauth rows older than [archive] retention_hours to the
+   archive database (rows and/or daily summaries, see postauth_archive.py),
+   deleting them from radius.db in short, time-bounded slices
+2. Deletes archived rows and summaries past their own retention
+
+A run stops after [archive] max_run_seconds; the next run continues where
+it stopped, so the first run on a large existing table catches up over a
+few runs without holding radius.db's write lock for long.
+
+Usage:
+    python3 archive-postauth.py            # rotate + prune
+    python3 archive-postauth.py --status   # show archive state
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import sys
+
+from db_pool import pool_from_config
+from postauth_archive import archive_from_config
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('/var/log/radtik-archive-postauth.log'),
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('archive-postauth')
+
+# Load configuration
+config = configparser.ConfigParser()
+config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
+
+if not os.path.exists(config_path):
+    logger.error(f"Configuration file not found: {config_path}")
+    sys.exit(1)
+
+config.read(config_path)
+
+# Configuration variables
+RADIUS_DB_PATH = config.get('radius', 'db_path', fallback='/etc/freeradius/3.0/sqlite/radius.db')
+ENABLED = config.getboolean('archive', 'enabled', fallback=True)
+
+if not os.path.exists(RADIUS_DB_PATH):
+    logger.error(f"RADIUS database not found: {RADIUS_DB_PATH}")
+    sys.exit(1)
+
+
+def main():
+    """Main function - rotate radpostauth into the archive"""
+    parser = argparse.ArgumentParser(description='Archive old FreeRADIUS radpostauth rows')
+    parser.add_argument('--status', action='store_true', help='Show archive state and exit')
+    args = parser.parse_args()
+    
+    if not ENABLED and not args.status:
+        return
+    
+    try:
+        archive = archive_from_config(config)
+    except Exception as e:
+        logger.error(f"Post-auth archive unavailable: {e}")
+        sys.exit(1)
+    
+    if args.status:
+        logger.info(json.dumps(archive.stats()))
+        archive.close()
+        return
+    
+    db_pool = pool_from_config(config, RADIUS_DB_PATH, size=1)
+    
+    try:
+        result = archive.rotate(db_pool)
+        pruned = archive.prune()
+        
+        if result['archived'] or result['deleted'] or any(pruned.values()):
+            logger.info(f"Archived {result['archived']} radpostauth row(s) older than {result['cutoff']} "
+                        f"({archive.mode}), deleted {result['deleted']} in {result['slices']} slice(s); "
+                        f"pruned {pruned['radpostauth_archive']} archived row(s) and "
+                        f"{pruned['radpostauth_daily']} daily summaries")
+        if not result['complete']:
+            logger.info("Time budget reached, the next run continues")
+    except Exception as e:
+        logger.error(f"Fatal error: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        sys.exit(1)
+    finally:
+        archive.close()
+        db_pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+RadTik Authorize Index
+In-memory copy of radcheck/radreply/radusergroup keyed by username (plus the
+small radgroupcheck/radgroupreply tables keyed by group), used by the API's
+POST /authorize endpoint (FreeRADIUS rlm_rest) instead of running the
+authorize check/reply and group queries against SQLite for every
+Access-Request.
+
+Keeping it current:
+- Triggers (migrations 5 and 7) append the username of every radcheck,
+  radreply and radusergroup change to radtik_authorize_changes, and an
+  empty username for every group attribute change. At most every
+  `refresh_ms` a lookup
+  reads the rows after the index's cursor (a primary key range read that
+  is usually empty) and reloads just those usernames, so writes from other
+  workers, the cron scripts and the activation sync are picked up quickly
+- The API's own write paths call refresh(force=True) right after a commit,
+  so the worker that applied a change sees it immediately
+- Every `reconcile_seconds` the whole index is rebuilt from SQLite in a
+  background thread and swapped in, and old change rows are trimmed
+
+Check items are evaluated like rlm_sql: assignment operators go to the
+control list, comparison operators are matched against the request and a
+failed comparison means "not found". Comparison operators RadTik does not
+write raise UnsupportedOperator so the caller can let FreeRADIUS fall back
+to SQL. Groups (rate-limit profiles, see radius_store.PROFILE_PREFIX) are
+then applied in priority order: a group whose check items do not match is
+skipped, and Fall-Through = No in a reply stops the group processing.
+"""
+
+import logging
+import sys
+import threading
+import time
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple
+
+import radius_store
+
+logger = logging.getLogger('authorize-index')
+
+# Check/reply operators that set an attribute (control or reply list)
+ASSIGN_OPS = (':=', '=', '+=')
+
+# Comparison operators: (request value or None, check value) -> matched
+COMPARE_OPS = {
+    '==': lambda actual, expected: actual is not None and actual == expected,
+    '!=': lambda actual, expected: actual is not None and actual != expected,
+    '=*': lambda actual, expected: actual is not None,
+    '!*': lambda actual, expected: actual is None,
+}
+
+# Usernames reloaded per query
+_RELOAD_CHUNK = 500
+
+_Item = Tuple[str, str, str]
+
+_ROWS = "SELECT username, attribute, op, value FROM {table}"
+_GROUP_ROWS = "SELECT username, groupname FROM radusergroup"
+
+
+class UnsupportedOperator(Exception):
+    """A check item uses an operator the index cannot evaluate"""
+
+
+class AuthorizeIndex:
+    """In-memory radcheck/radreply/radusergroup index with incremental refresh"""
+
+    def __init__(self, pool, refresh_ms: float = 100.0, reconcile_seconds: float = 300.0,
+                 keep_changes: int = 100000, max_changes: int = 10000):
+        self.pool = pool
+        self.refresh_interval = refresh_ms / 1000.0
+        self.reconcile_interval = reconcile_seconds
+        self.keep_changes = keep_changes
+        self.max_changes = max_changes
+
+        self._entries: Dict[str, tuple] = {}
+        self._groups: Dict[str, Tuple[tuple, tuple]] = {}
+        self._cursor = 0
+        self._loaded = False
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._stats = {
+            'lookups': 0,
+            'hits': 0,
+            'refreshes': 0,
+            'reloaded_usernames': 0,
+            'reconciles': 0,
+            'last_reconcile_seconds': 0.0,
+            'errors': 0,
+        }
+
+        self._thread = threading.Thread(target=self._run, name='authorize-index', daemon=True)
+        self._thread.start()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    @staticmethod
+    def _build(check_rows, reply_rows, group_rows) -> Dict:
+        """
+        Index (username, attribute, op, value) check/reply rows and
+        (username, groupname) membership rows, each ordered by username
+
+        Each username maps to one flat tuple (number of check items, number
+        of reply items, check items..., reply items..., group names...) to
+        keep the per-voucher overhead small.
+        """
+        # Identical (attribute, op, value) items (NAS-Identifier, rate limits)
+        # repeat across thousands of vouchers, keep one tuple per distinct item
+        shared: Dict[_Item, _Item] = {}
+
+        def grouped(rows):
+            for username, items in groupby(rows, key=itemgetter(0)):
+                yield username, [
+                    shared.setdefault(item, item)
+                    for item in ((sys.intern(attribute), sys.intern(op), value) for _, attribute, op, value in items)
+                ]
+            yield None, None
+
+        def memberships(rows):
+            for username, items in groupby(rows, key=itemgetter(0)):
+                yield username, [sys.intern(groupname) for _, groupname in items]
+            yield None, None
+
+        entries = {}
+        streams = [grouped(check_rows), grouped(reply_rows), memberships(group_rows)]
+        heads = [next(stream) for stream in streams]
+
+        # Merge the three username-ordered streams
+        while True:
+            usernames = [username for username, _ in heads if username is not None]
+            if not usernames:
+                break
+            username = min(usernames)
+
+            parts = []
+            for position, (head_user, items) in enumerate(heads):
+                if head_user == username:
+                    parts.append(items)
+                    heads[position] = next(streams[position])
+                else:
+                    parts.append(())
+
+            checks, replies, groups = parts
+            entries[username] = (len(checks), len(replies), *checks, *replies, *groups)
+
+        return entries
+
+    @staticmethod
+    def _load_groups(conn) -> Dict:
+        """Check and reply items of every group: groupname -> (checks, replies)"""
+        groups: Dict[str, Tuple[list, list]] = {}
+
+        for position, table in enumerate(('radgroupcheck', 'radgroupreply')):
+            for groupname, attribute, op, value in conn.execute(
+                f"SELECT groupname, attribute, op, value FROM {table} ORDER BY groupname, id"
+            ):
+                groups.setdefault(groupname, ([], []))[position].append((attribute, op, value))
+
+        return {groupname: (tuple(checks), tuple(replies)) for groupname, (checks, replies) in groups.items()}
+
+    def reconcile(self):
+        """Rebuild the whole index from one consistent SQLite snapshot"""
+        with self._reconcile_lock:
+            started = time.monotonic()
+
+            with self.pool.connection() as conn:
+                # One read transaction: the cursor and the tables match.
+                # Rows are streamed into the new index, not fetched as lists
+                conn.execute("BEGIN")
+                try:
+                    cursor = conn.execute(
+                        "SELECT COALESCE(MAX(seq), 0) FROM radtik_authorize_changes"
+                    ).fetchone()[0]
+                    groups = self._load_groups(conn)
+                    entries = self._build(
+                        conn.execute(_ROWS.format(table='radcheck') + " ORDER BY username, id"),
+                        conn.execute(_ROWS.format(table='radreply') + " ORDER BY username, id"),
+                        conn.execute(_GROUP_ROWS + " ORDER BY username, priority, id")
+                    )
+                finally:
+                    conn.rollback()
+
+                if self.keep_changes and radius_store.trim_authorize_changes(conn, self.keep_changes):
+                    # Lagging readers notice the gap and rebuild
+                    conn.commit()
+
+            with self._lock:
+                self._groups = groups
+                self._entries = entries
+                # Changes after the snapshot are re-read by the next refresh
+                self._cursor = cursor
+                self._loaded = True
+                self._next_refresh = 0.0
+
+            elapsed = time.monotonic() - started
+            self._stats['reconciles'] += 1
+            self._stats['last_reconcile_seconds'] = round(elapsed, 3)
+            logger.info(f"Authorize index loaded: {len(entries)} usernames in {elapsed:.2f}s (cursor {cursor})")
+
+    def _reload(self, conn, usernames: List[str]) -> Dict:
+        """Current rows of some usernames"""
+        entries = {}
+
+        for start in range(0, len(usernames), _RELOAD_CHUNK):
+            chunk = usernames[start:start + _RELOAD_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            where = f" WHERE username IN ({placeholders}) ORDER BY username"
+            check_rows = conn.execute(_ROWS.format(table='radcheck') + where + ", id", chunk).fetchall()
+            reply_rows = conn.execute(_ROWS.format(table='radreply') + where + ", id", chunk).fetchall()
+            group_rows = conn.execute(_GROUP_ROWS + where + ", priority, id", chunk).fetchall()
+            entries.update(self._build(check_rows, reply_rows, group_rows))
+
+        return entries
+
+    def refresh(self, force: bool = False):
+        """
+        Apply changes recorded since the cursor
+
+        Args:
+            force: Refresh now instead of at most once per refresh_ms
+        """
+        if not self._loaded or (not force and time.monotonic() < self._next_refresh):
+            return
+
+        rebuild = False
+        with self._lock:
+            if not force and time.monotonic() < self._next_refresh:
+                return
+            self._next_refresh = time.monotonic() + self.refresh_interval
+
+            with self.pool.connection() as conn:
+                while True:
+                    rows = conn.execute(
+                        "SELECT seq, username FROM radtik_authorize_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                        (self._cursor, self.max_changes)
+                    ).fetchall()
+                    if not rows:
+                        break
+
+                    if rows[0][0] != self._cursor + 1:
+                        oldest = conn.execute("SELECT MIN(seq) FROM radtik_authorize_changes").fetchone()[0]
+                        if oldest is not None and oldest > self._cursor + 1:
+                            # Rows after the cursor were trimmed
+                            rebuild = True
+                            break
+
+                    usernames = list({row[1] for row in rows})
+                    if '' in usernames:
+                        # Group attributes changed
+                        self._groups = self._load_groups(conn)
+                    entries = self._reload(conn, usernames)
+                    for username in usernames:
+                        entry = entries.get(username)
+                        if entry is None:
+                            self._entries.pop(username, None)
+                        else:
+                            self._entries[username] = entry
+
+                    self._cursor = rows[-1][0]
+                    self._stats['refreshes'] += 1
+                    self._stats['reloaded_usernames'] += len(usernames)
+
+                    if len(rows) < self.max_changes:
+                        break
+
+        if rebuild:
+            logger.warning("Authorize index fell behind the change log, rebuilding")
+            self.reconcile()
+
+    def authorize(self, username: str, attributes: Dict[str, str]) -> Optional[Dict]:
+        """
+        Evaluate a user's check items against the request
+
+        Args:
+            username: User-Name of the request
+            attributes: Request attributes (name -> first value)
+
+        Returns:
+            rlm_rest response attributes ("control:X" / "reply:X" ->
+            {'op': ..., 'value': [...]}), or None if the user is unknown
+            or a check comparison failed
+
+        Raises:
+            UnsupportedOperator for check operators not handled here
+        """
+        try:
+            self.refresh()
+        except Exception as e:
+            # Serve the last known state, reconciliation catches up
+            self._stats['errors'] += 1
+            logger.error(f"Authorize index refresh failed: {e}")
+
+        self._stats['lookups'] += 1
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+
+        check_count, reply_count = entry[0], entry[1]
+        checks = entry[2:check_count + 2]
+        replies = entry[check_count + 2:check_count + reply_count + 2]
+        response: Dict[str, Dict] = {}
+
+        if not self._evaluate(checks, attributes, response):
+            return None
+        fall_through = self._add_replies(replies, response)
+
+        for groupname in entry[check_count + reply_count + 2:]:
+            if not fall_through:
+                break
+            group_checks, group_replies = self._groups.get(groupname, ((), ()))
+            check_response: Dict[str, Dict] = {}
+            if not self._evaluate(group_checks, attributes, check_response):
+                continue
+            for key, item in check_response.items():
+                for value in item['value']:
+                    self._add(response, key, item['op'], value)
+            fall_through = self._add_replies(group_replies, response)
+
+        self._stats['hits'] += 1
+        return response
+
+    @staticmethod
+    def _add(response: Dict, key: str, op: str, value: str):
+        """Add an attribute to a response list like radius_pairmove()"""
+        item = response.get(key)
+        if item is None:
+            response[key] = {'op': op, 'value': [value]}
+        elif op == ':=':
+            item.update({'op': op, 'value': [value]})
+        elif op == '+=':
+            item['value'].append(value)
+
+    @classmethod
+    def _evaluate(cls, checks, attributes: Dict[str, str], response: Dict) -> bool:
+        """
+        Apply check items: assignments go to the control list, comparisons
+        are matched against the request
+
+        Returns:
+            False if a comparison failed
+        """
+        for attribute, op, value in checks:
+            if op in ASSIGN_OPS:
+                cls._add(response, f"control:{attribute}", op, value)
+            elif op in COMPARE_OPS:
+                if not COMPARE_OPS[op](attributes.get(attribute), value):
+                    return False
+            else:
+                raise UnsupportedOperator(f"{attribute} {op} {value}")
+        return True
+
+    @classmethod
+    def _add_replies(cls, replies, response: Dict) -> bool:
+        """
+        Add reply items to the response
+
+        Returns:
+            False if the items contain Fall-Through = No (stop reading groups)
+        """
+        fall_through = True
+        for attribute, op, value in replies:
+            if attribute == 'Fall-Through':
+                fall_through = value.lower() not in ('no', '0')
+                continue
+            cls._add(response, f"reply:{attribute}", op, value)
+        return fall_through
+
+    def _run(self):
+        """Initial load, then periodic reconciliation"""
+        while True:
+            try:
+                self.reconcile()
+            except Exception as e:
+                self._stats['errors'] += 1
+                logger.error(f"Authorize index reconciliation failed: {e}")
+                time.sleep(min(self.reconcile_interval, 10))
+                continue
+            time.sleep(self.reconcile_interval)
+
+    def stats(self) -> Dict:
+        stats = dict(self._stats)
+        stats['loaded'] = self._loaded
+        stats['usernames'] = len(self._entries)
+        stats['groups'] = len(self._groups)
+        stats['cursor'] = self._cursor
+        return stats
+
+
+def index_from_config(config, pool) -> AuthorizeIndex:
+    """Build the index from the [authorize] section of config.ini"""
+    return AuthorizeIndex(
+        pool,
+        refresh_ms=config.getfloat('authorize', 'refresh_ms', fallback=100),
+        reconcile_seconds=config.getfloat('authorize', 'reconcile_seconds', fallback=300),
+        keep_changes=config.getint('authorize', 'keep_changes', fallback=100000)
+    )
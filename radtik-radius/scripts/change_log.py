@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+RadTik Change Log
+Append-only log of voucher mutations (radtik_changes, migration 6) used to
+replicate one RADIUS server (the primary, which receives pushes from
+Laravel) to any number of followers.
+
+Every mutation is logged as the writer operation that produced it
+(operation name + JSON payload, see write_queue.OPERATIONS) in the same
+transaction as the mutation itself, so the log never contains a change
+that was rolled back. Operations set state (create, delete, enable,
+disable, bind MAC) rather than increment it, so replaying them in order on
+a follower converges to the primary's voucher set.
+
+Flow:
+- The primary logs changes from the API writer, cleanup-orphaned.py and
+  activation-sync.py ([replication] changelog = true) and serves them from
+  GET /changes?since=<seq> and GET /changes/snapshot
+- A follower (follow-changes.py, [replication] primary_url) copies the
+  voucher set once from the snapshot, then pulls pages of changes after its
+  cursor and applies each page in one transaction together with the cursor
+- If the follower falls behind the log retention (or the primary's log was
+  reset), /changes answers "reset" and the follower copies the snapshot again
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+import radius_store
+
+logger = logging.getLogger('change-log')
+
+# Keys in radtik_sync_state on a follower
+CURSOR_KEY = 'follower.cursor'
+SNAPSHOT_KEY = 'follower.snapshot'
+PRIMARY_LATEST_KEY = 'follower.primary_latest'
+
+# Voucher tables copied by the snapshot and their columns (radpostauth /
+# radacct stay local)
+SNAPSHOT_TABLES = {
+    'radcheck': ('username', 'attribute', 'op', 'value'),
+    'radreply': ('username', 'attribute', 'op', 'value'),
+    'radusergroup': ('username', 'groupname', 'priority'),
+}
+
+
+def is_follower(config) -> bool:
+    """Whether this server replicates from a primary"""
+    return bool(config.get('replication', 'primary_url', fallback='').strip())
+
+
+def changelog_enabled(config) -> bool:
+    """Whether mutations made on this server are logged for followers"""
+    return config.getboolean('replication', 'changelog', fallback=False) and not is_follower(config)
+
+
+def record(conn: sqlite3.Connection, op: str, payload: Dict) -> int:
+    """
+    Append a mutation to the change log (not committed here)
+
+    Args:
+        conn: Open database connection, inside the mutation's transaction
+        op: Writer operation name (write_queue.OPERATIONS)
+        payload: Operation payload
+
+    Returns:
+        Sequence number of the change
+    """
+    cursor = conn.execute(
+        "INSERT INTO radtik_changes (op, payload, created_at) VALUES (?, ?, ?)",
+        (op, json.dumps(payload, separators=(',', ':')), int(time.time()))
+    )
+    return cursor.lastrowid
+
+
+def latest_seq(conn: sqlite3.Connection) -> int:
+    """Highest sequence number ever assigned (survives trimming)"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'radtik_changes'").fetchone()
+    return row[0] if row else 0
+
+
+def read_changes(conn: sqlite3.Connection, since: int, limit: int, max_bytes: int) -> Dict:
+    """
+    Read a page of changes after a cursor
+
+    Payloads are returned as raw JSON text so the API can pass them through
+    without decoding and encoding them again.
+
+    Args:
+        conn: Open database connection
+        since: Sequence number of the last change the caller applied
+        limit: Maximum number of changes
+        max_bytes: Stop adding changes once their payloads exceed this size
+                   (at least one change is always returned)
+
+    Returns:
+        Dictionary with 'changes' (list of (seq, op, payload_json, created_at)),
+        'cursor', 'latest', 'has_more' and 'reset' (the caller missed trimmed
+        changes, or is ahead of this log, and has to copy the snapshot again)
+    """
+    # One read transaction: latest and the page are consistent
+    conn.execute("BEGIN")
+    try:
+        latest = latest_seq(conn)
+        oldest = conn.execute("SELECT MIN(seq) FROM radtik_changes").fetchone()[0]
+        rows = conn.execute(
+            "SELECT seq, op, payload, created_at FROM radtik_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+            (since, limit)
+        ).fetchall()
+    finally:
+        conn.rollback()
+
+    if oldest is None:
+        oldest = latest + 1
+
+    if since > latest or since < oldest - 1:
+        return {'changes': [], 'cursor': since, 'latest': latest, 'has_more': False, 'reset': True}
+
+    changes = []
+    size = 0
+    for row in rows:
+        if changes and size + len(row[2]) > max_bytes:
+            break
+        changes.append(row)
+        size += len(row[2])
+
+    cursor = changes[-1][0] if changes else since
+
+    return {
+        'changes': changes,
+        'cursor': cursor,
+        'latest': latest,
+        'has_more': cursor < latest,
+        'reset': False,
+    }
+
+
+def read_snapshot(conn: sqlite3.Connection, after: str, limit: int) -> Dict:
+    """
+    Read the radcheck/radreply/radusergroup rows of a keyset page of usernames
+
+    Every page also carries the radgroupreply rows of all rate-limit
+    profiles (a handful of rows), so memberships never reference a profile
+    the follower does not have.
+
+    Args:
+        conn: Open database connection
+        after: Last username of the previous page ('' for the first page)
+        limit: Usernames per page
+
+    Returns:
+        Dictionary with 'seq' (change log position the page is at least as
+        new as), 'after', 'until' (last username of the page, None for the
+        final page, which covers everything after `after`), the rows of each
+        table as lists of its SNAPSHOT_TABLES columns and 'profiles'
+        ([groupname, attribute, op, value] lists)
+    """
+    conn.execute("BEGIN")
+    try:
+        seq = latest_seq(conn)
+        usernames = [row[0] for row in conn.execute(
+            "SELECT DISTINCT username FROM radcheck WHERE username > ? ORDER BY username LIMIT ?",
+            (after, limit)
+        )]
+        until = usernames[-1] if len(usernames) == limit else None
+
+        page = {'seq': seq, 'after': after, 'until': until}
+        for table, columns in SNAPSHOT_TABLES.items():
+            if until is None:
+                rows = conn.execute(
+                    f"SELECT {', '.join(columns)} FROM {table} WHERE username > ? ORDER BY username, id",
+                    (after,)
+                )
+            else:
+                rows = conn.execute(
+                    f"SELECT {', '.join(columns)} FROM {table} "
+                    f"WHERE username > ? AND username <= ? ORDER BY username, id",
+                    (after, until)
+                )
+            page[table] = [list(row) for row in rows]
+
+        page['profiles'] = [list(row) for row in conn.execute(
+            "SELECT groupname, attribute, op, value FROM radgroupreply WHERE groupname LIKE ? ORDER BY groupname, id",
+            (radius_store.PROFILE_PREFIX + '%',)
+        )]
+    finally:
+        conn.rollback()
+
+    return page
+
+
+def apply_snapshot_page(conn: sqlite3.Connection, page: Dict) -> Dict:
+    """
+    Replace the local rows in a snapshot page's username range (not committed here)
+
+    Local usernames in the range that the primary does not have are removed.
+    Rate-limit profiles are named after their value, so only profiles the
+    follower does not have yet are added.
+
+    Returns:
+        Rows deleted and inserted per table
+    """
+    after, until = page['after'], page['until']
+    result = {}
+
+    profiles = page.get('profiles') or []
+    known = {row[0] for row in conn.execute(
+        "SELECT DISTINCT groupname FROM radgroupreply WHERE groupname LIKE ?",
+        (radius_store.PROFILE_PREFIX + '%',)
+    )}
+    conn.executemany(
+        "INSERT INTO radgroupreply (groupname, attribute, op, value) VALUES (?, ?, ?, ?)",
+        [row for row in profiles if row[0] not in known]
+    )
+
+    for table, columns in SNAPSHOT_TABLES.items():
+        if until is None:
+            deleted = conn.execute(f"DELETE FROM {table} WHERE username > ?", (after,)).rowcount
+        else:
+            deleted = conn.execute(
+                f"DELETE FROM {table} WHERE username > ? AND username <= ?", (after, until)
+            ).rowcount
+
+        rows = page.get(table) or []
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            rows
+        )
+        result[table] = {'deleted': deleted, 'inserted': len(rows)}
+
+    return result
+
+
+def apply_changes(conn: sqlite3.Connection, changes: List[Dict], operations: Dict,
+                  primary_latest: Optional[int] = None) -> Dict:
+    """
+    Apply a page of changes and advance the follower cursor in one transaction
+
+    Each change runs in its own savepoint like a writer job, so a change
+    that fails (it also failed on the primary, or the follower is not in
+    sync) is skipped instead of blocking replication.
+
+    Args:
+        conn: Open database connection (not in a transaction)
+        changes: [{"seq": ..., "op": ..., "payload": {...}}, ...] in seq order
+        operations: Operation name -> function(conn, payload) (write_queue.OPERATIONS)
+        primary_latest: Newest sequence number on the primary, stored for /stats
+
+    Returns:
+        Dictionary with 'applied', 'skipped' and 'cursor'
+    """
+    applied = skipped = 0
+    cursor = None
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for change in changes:
+            conn.execute("SAVEPOINT change")
+            try:
+                result = operations[change['op']](conn, change['payload'])
+            except Exception as e:
+                conn.execute("ROLLBACK TO change")
+                logger.error(f"Change {change['seq']} ({change['op']}) could not be applied: {e}")
+                skipped += 1
+            else:
+                if isinstance(result, dict) and 'database_error' in result:
+                    conn.execute("ROLLBACK TO change")
+                    logger.error(f"Change {change['seq']} ({change['op']}) failed: {result['database_error']}")
+                    skipped += 1
+                else:
+                    applied += 1
+            conn.execute("RELEASE change")
+            cursor = change['seq']
+
+        if cursor is not None:
+            radius_store.set_state(conn, CURSOR_KEY, cursor)
+        if primary_latest is not None:
+            radius_store.set_state(conn, PRIMARY_LATEST_KEY, primary_latest)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return {'applied': applied, 'skipped': skipped, 'cursor': cursor}
+
+
+def trim(conn: sqlite3.Connection, retention_hours: float) -> int:
+    """
+    Delete changes older than the retention period (not committed here)
+
+    Returns:
+        Number of changes deleted
+    """
+    cutoff = int(time.time() - retention_hours * 3600)
+    row = conn.execute(
+        "SELECT seq FROM radtik_changes WHERE created_at < ? ORDER BY created_at DESC, seq DESC LIMIT 1",
+        (cutoff,)
+    ).fetchone()
+
+    if row is None:
+        return 0
+
+    return conn.execute("DELETE FROM radtik_changes WHERE seq <= ?", (row[0],)).rowcount
+
+
+def follower_status(conn: sqlite3.Connection) -> Dict:
+    """Cursor and lag of a follower, from radtik_sync_state"""
+    cursor = radius_store.get_state(conn, CURSOR_KEY)
+    latest = radius_store.get_state(conn, PRIMARY_LATEST_KEY)
+    snapshot = radius_store.get_state(conn, SNAPSHOT_KEY)
+
+    status: Dict[str, Optional[object]] = {
+        'cursor': int(cursor) if cursor is not None else None,
+        'primary_latest': int(latest) if latest is not None else None,
+        'copying_snapshot': bool(snapshot),
+    }
+    if status['cursor'] is not None and status['primary_latest'] is not None:
+        status['lag'] = max(0, status['primary_latest'] - status['cursor'])
+
+    return status
@@ -4,23 +4,59 @@ RadTik Orphaned Voucher Cleanup Script
 Removes vouchers from RADIUS database that don't exist in RADTik Laravel database.
 
 This script runs via cron and:
-1. Queries all usernames from RADIUS radcheck table
+1. Streams usernames from RADIUS radcheck table (keyset pages)
 2. Sends usernames to Laravel API for verification
 3. Deletes orphaned vouchers (those not in RADTik) from RADIUS database
 4. Prevents RADIUS database from becoming cluttered with stale data
 
+With [cleanup] reconcile = digest (default) usernames are first compared by
+bucket digests (see voucher_digest.py): only buckets whose digest differs
+from Laravel's are sent for verification, so a run where nothing changed
+transfers a few hundred bytes. Without Laravel support for digests (HTTP
+404) the script falls back to verifying every username.
+
+With [cleanup] tombstones = true (default) each run first pulls the
+usernames Laravel deleted since the last run from a cursor-based feed
+(POST /api/radius/voucher-tombstones) and deletes just those, saving the
+cursor in radtik_sync_state. The full (or digest) reconciliation above only
+runs every [cleanup] reconcile_interval_hours as a safety net (also when
+the feed is unavailable), immediately when the cursor is older than
+Laravel's retention, or when run with --reconcile. This keeps a run
+O(changes), so the cron job runs every minute.
+
+Usernames are read in keyset-paginated pages, so memory stays flat however
+large radcheck grows. After each batch is verified and its orphans deleted
+the last username is saved as a checkpoint; a reconciliation that is
+interrupted (crash, timeout, reboot) resumes after it on the next run.
+
+Verification is pipelined: up to [cleanup] concurrency requests are in
+flight at once, and a single deletion thread removes the orphans reported
+by each batch while the next batches are being verified.
+
 RADTik database is the source of truth.
 """
 
+import argparse
 import sqlite3
 import requests
 import configparser
 import logging
+import queue
 import sys
 import os
-from typing import List, Dict, Set
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, List, Dict, Optional, Set
 from datetime import datetime
 
+import change_log
+import radius_store
+from db_pool import pool_from_config
+from laravel_client import client_from_config
+from voucher_digest import BucketDigests, bucket_of
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -48,6 +84,36 @@ LARAVEL_API_URL = config.get('laravel', 'api_url', fallback='')
 AUTH_TOKEN = config.get('api', 'auth_token', fallback='')
 BATCH_SIZE = config.getint('cleanup', 'batch_size', fallback=1000)
 DRY_RUN = config.getboolean('cleanup', 'dry_run', fallback=False)
+# Verification requests in flight at once (limits the load put on Laravel)
+CONCURRENCY = max(1, config.getint('cleanup', 'concurrency', fallback=4))
+# Deletes are committed in slices of at most DELETE_SLICE_SIZE usernames; the
+# slice size adapts so each write transaction stays within DELETE_SLICE_BUDGET,
+# and DELETE_SLICE_PAUSE lets FreeRADIUS write radpostauth/radacct in between
+DELETE_SLICE_SIZE = max(1, config.getint('cleanup', 'delete_slice_size', fallback=200))
+DELETE_SLICE_BUDGET = config.getfloat('cleanup', 'delete_slice_budget_ms', fallback=25) / 1000.0
+DELETE_SLICE_PAUSE = config.getfloat('cleanup', 'delete_slice_pause_ms', fallback=10) / 1000.0
+# 'digest' = verify only buckets whose digest differs from Laravel's, 'full' = verify everything
+RECONCILE = config.get('cleanup', 'reconcile', fallback='digest').strip().lower()
+DIGEST_BUCKETS = config.getint('cleanup', 'digest_buckets', fallback=1024)
+# Delta cleanup from Laravel's tombstone feed; the full reconciliation becomes a periodic safety net
+TOMBSTONES = config.getboolean('cleanup', 'tombstones', fallback=True)
+TOMBSTONE_PAGE_SIZE = config.getint('cleanup', 'tombstone_page_size', fallback=1000)
+RECONCILE_INTERVAL = config.getfloat('cleanup', 'reconcile_interval_hours', fallback=6) * 3600
+# Usernames read from radcheck per keyset page
+SCAN_PAGE_SIZE = max(1, config.getint('cleanup', 'scan_page_size', fallback=5000))
+# Authorize index change log rows kept (trimmed every run)
+AUTHORIZE_KEEP_CHANGES = config.getint('authorize', 'keep_changes', fallback=100000)
+
+# Replication: deletions are logged for followers; a follower takes its
+# voucher set from the primary and does not clean up on its own
+CHANGELOG_ENABLED = change_log.changelog_enabled(config)
+CHANGELOG_RETENTION_HOURS = config.getfloat('replication', 'retention_hours', fallback=168)
+FOLLOWER = change_log.is_follower(config)
+
+# Keys in radtik_sync_state
+TOMBSTONE_CURSOR_KEY = 'cleanup.tombstone_cursor'
+LAST_RECONCILE_KEY = 'cleanup.last_reconcile'
+SCAN_CHECKPOINT_KEY = 'cleanup.scan_checkpoint'
 
 # Validate configuration
 if not LARAVEL_API_URL:
@@ -60,31 +126,83 @@ if not AUTH_TOKEN:
     logger.error("This should match the RADIUS server auth_token in Laravel")
     sys.exit(1)
 
-def get_radius_usernames() -> List[str]:
+# Shared connection pool (a single connection is enough for this script)
+db_pool = pool_from_config(config, RADIUS_DB_PATH, size=1)
+
+# Current delete slice size (adapted across calls, only the deletion thread writes it)
+_delete_slice = {'size': DELETE_SLICE_SIZE}
+
+# Pooled keep-alive client for Laravel (one connection per in-flight request)
+laravel = client_from_config(config, min_pool_size=CONCURRENCY)
+
+def count_radius_usernames() -> int:
     """
-    Get all usernames from RADIUS radcheck table
+    Number of vouchers in RADIUS, from the trigger-maintained radius_stats
+    counter (migration 2) instead of a table scan
     
     Returns:
-        List of usernames currently in RADIUS database
+        Voucher count (0 if it cannot be read)
     """
     try:
-        conn = sqlite3.connect(RADIUS_DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT DISTINCT username FROM radcheck WHERE attribute = 'Cleartext-Password'")
-        usernames = [row[0] for row in cursor.fetchall()]
+        with db_pool.connection() as conn:
+            row = conn.execute("SELECT vouchers FROM radius_stats WHERE id = 1").fetchone()
+        return row[0] if row else 0
+    except sqlite3.Error as e:
+        logger.error(f"Database error while counting vouchers: {e}")
+        return 0
+
+def iter_radius_usernames(after: str = '') -> Iterator[str]:
+    """
+    Stream usernames from RADIUS radcheck table in username order
+    
+    Keyset pagination (username > last seen) on the covering
+    idx_radcheck_username_attribute index: each page is one short read and
+    the pooled connection is released between pages, so the deletion
+    thread is never starved and memory does not grow with the table.
+    
+    Args:
+        after: Only yield usernames sorting after this one (resume point)
         
-        conn.close()
+    Yields:
+        Usernames currently in RADIUS database
+    """
+    last = after
+    
+    while True:
+        with db_pool.connection() as conn:
+            rows = conn.execute("""
+                SELECT DISTINCT username FROM radcheck
+                WHERE attribute = 'Cleartext-Password' AND username > ?
+                ORDER BY username
+                LIMIT ?
+            """, (last, SCAN_PAGE_SIZE)).fetchall()
         
-        logger.info(f"Found {len(usernames)} unique usernames in RADIUS database")
-        return usernames
+        for row in rows:
+            yield row[0]
         
+        if len(rows) < SCAN_PAGE_SIZE:
+            return
+        last = rows[-1][0]
+
+def load_checkpoint() -> str:
+    """Username after which an interrupted reconciliation resumes ('' = start)"""
+    try:
+        with db_pool.connection() as conn:
+            return radius_store.get_state(conn, SCAN_CHECKPOINT_KEY, '')
     except sqlite3.Error as e:
-        logger.error(f"Database error while reading usernames: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Unexpected error reading usernames: {e}")
-        return []
+        logger.error(f"Could not read the scan checkpoint: {e}")
+        return ''
+
+def save_checkpoint(username: str):
+    """Persist the reconciliation checkpoint ('' clears it)"""
+    if DRY_RUN:
+        return
+    try:
+        with db_pool.connection() as conn:
+            radius_store.set_state(conn, SCAN_CHECKPOINT_KEY, username)
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Could not save the scan checkpoint: {e}")
 
 def verify_with_laravel(usernames: List[str]) -> Dict[str, List[str]]:
     """
@@ -94,7 +212,8 @@ def verify_with_laravel(usernames: List[str]) -> Dict[str, List[str]]:
         usernames: List of usernames to verify
         
     Returns:
-        Dictionary with 'valid' and 'orphaned' lists
+        Dictionary with 'valid' and 'orphaned' lists ('failed' is set if
+        the batch could not be verified)
     """
     if not usernames:
         return {'valid': [], 'orphaned': []}
@@ -102,16 +221,8 @@ def verify_with_laravel(usernames: List[str]) -> Dict[str, List[str]]:
     api_endpoint = f"{LARAVEL_API_URL.rstrip('/')}/api/radius/verify-vouchers"
     
     try:
-        response = requests.post(
-            api_endpoint,
-            json={'usernames': usernames},
-            headers={
-                'Authorization': f'Bearer {AUTH_TOKEN}',
-                'Content-Type': 'application/json',
-                'Accept': 'application/json'
-            },
-            timeout=60
-        )
+        # Pooled connection, gzip body, retries with jitter (laravel_client.py)
+        response = laravel.post('/api/radius/verify-vouchers', {'usernames': usernames}, timeout=60)
         
         if response.status_code == 200:
             data = response.json()
@@ -121,17 +232,187 @@ def verify_with_laravel(usernames: List[str]) -> Dict[str, List[str]]:
             }
         else:
             logger.error(f"Laravel API returned error: {response.status_code} - {response.text}")
-            return {'valid': [], 'orphaned': []}
+            return {'valid': [], 'orphaned': [], 'failed': True}
             
     except requests.exceptions.Timeout:
         logger.error("Request to Laravel API timed out")
-        return {'valid': [], 'orphaned': []}
+        return {'valid': [], 'orphaned': [], 'failed': True}
     except requests.exceptions.ConnectionError:
         logger.error(f"Could not connect to Laravel API: {api_endpoint}")
-        return {'valid': [], 'orphaned': []}
+        return {'valid': [], 'orphaned': [], 'failed': True}
     except Exception as e:
         logger.error(f"Error communicating with Laravel API: {e}")
-        return {'valid': [], 'orphaned': []}
+        return {'valid': [], 'orphaned': [], 'failed': True}
+
+def fetch_laravel_digests(root: str) -> Optional[Dict]:
+    """
+    Get Laravel's bucket digests for this server's vouchers
+    
+    Args:
+        root: Local root digest (Laravel omits the bucket list if it matches)
+        
+    Returns:
+        Response with 'match', 'root' and (unless matching) 'digests', or
+        None if digests are unavailable
+    """
+    try:
+        response = laravel.post(
+            '/api/radius/voucher-digests',
+            {'buckets': DIGEST_BUCKETS, 'root': root},
+            timeout=120
+        )
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Could not fetch voucher digests from Laravel: {e}")
+        return None
+    
+    if response.status_code == 404:
+        logger.warning("Laravel does not provide voucher digests (404)")
+        return None
+    
+    if response.status_code != 200:
+        logger.error(f"Laravel digest request failed: {response.status_code} - {response.text}")
+        return None
+    
+    data = response.json()
+    if data.get('buckets') != DIGEST_BUCKETS or (not data.get('match') and 'digests' not in data):
+        logger.error("Unexpected digest response from Laravel")
+        return None
+    
+    return data
+
+def select_buckets() -> Optional[Set[int]]:
+    """
+    Find the digest buckets whose usernames differ from Laravel's
+    
+    The local digests are built from one streaming pass over radcheck.
+    
+    Returns:
+        Buckets to verify (empty if everything matches), or None to verify
+        every username (digests unavailable)
+    """
+    local = BucketDigests(DIGEST_BUCKETS)
+    local.update(iter_radius_usernames())
+    root = local.root()
+    
+    remote = fetch_laravel_digests(root)
+    
+    if remote is None:
+        logger.info("Falling back to a full scan")
+        return None
+    
+    if remote['match']:
+        logger.info(f"Digests match Laravel ({local.total} vouchers, root {root[:12]}), nothing to verify")
+        return set()
+    
+    differing = local.differing(remote['digests'])
+    logger.info(f"{len(differing)}/{DIGEST_BUCKETS} digest bucket(s) differ, verifying their usernames")
+    return differing
+
+def apply_tombstones() -> Optional[Dict]:
+    """
+    Delete the vouchers Laravel reported as deleted since the saved cursor
+    
+    Pages through the feed until it has no more entries, saving the cursor
+    after each page's deletes. A page whose deletes failed is not retried;
+    the periodic reconciliation removes anything left behind.
+    
+    Returns:
+        Dictionary with 'received', 'deleted', 'cursor' and 'reset', or
+        None if the feed is unavailable (the caller reconciles instead)
+    """
+    try:
+        with db_pool.connection() as conn:
+            cursor = int(radius_store.get_state(conn, TOMBSTONE_CURSOR_KEY, '0'))
+    except sqlite3.Error as e:
+        logger.error(f"Could not read the tombstone cursor (run migrate.py): {e}")
+        return None
+    
+    totals = {'received': 0, 'deleted': 0, 'cursor': cursor, 'reset': False}
+    
+    while True:
+        try:
+            response = laravel.post(
+                '/api/radius/voucher-tombstones',
+                {'since': cursor, 'limit': TOMBSTONE_PAGE_SIZE}
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Could not fetch voucher tombstones from Laravel: {e}")
+            return None
+        
+        if response.status_code == 404:
+            logger.warning("Laravel does not provide a voucher tombstone feed (404)")
+            return None
+        
+        if response.status_code != 200:
+            logger.error(f"Laravel tombstone request failed: {response.status_code} - {response.text}")
+            return None
+        
+        data = response.json()
+        usernames = data.get('usernames', [])
+        
+        if data.get('reset'):
+            logger.warning(f"Tombstones after cursor {cursor} were pruned by Laravel, full reconciliation needed")
+            totals['reset'] = True
+        
+        totals['received'] += len(usernames)
+        totals['deleted'] += delete_orphaned_vouchers(usernames)
+        
+        if DRY_RUN:
+            # Keep the cursor so the real run sees the same tombstones
+            break
+        
+        cursor = int(data.get('cursor', cursor))
+        with db_pool.connection() as conn:
+            radius_store.set_state(conn, TOMBSTONE_CURSOR_KEY, cursor)
+            conn.commit()
+        
+        if not data.get('has_more'):
+            break
+    
+    totals['cursor'] = cursor
+    return totals
+
+def reconcile_due() -> bool:
+    """Whether the full reconciliation should run now (interval elapsed or interrupted run)"""
+    try:
+        with db_pool.connection() as conn:
+            last = radius_store.get_state(conn, LAST_RECONCILE_KEY)
+            checkpoint = radius_store.get_state(conn, SCAN_CHECKPOINT_KEY, '')
+    except sqlite3.Error:
+        return True
+    
+    if checkpoint:
+        return True
+    
+    return last is None or time.time() - float(last) >= RECONCILE_INTERVAL
+
+def mark_reconciled():
+    """Record a completed reconciliation"""
+    try:
+        with db_pool.connection() as conn:
+            radius_store.set_state(conn, LAST_RECONCILE_KEY, f"{time.time():.0f}")
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Could not record the reconciliation time: {e}")
+
+def trim_change_logs():
+    """
+    Keep the authorize index change log (written even when the index is
+    disabled) and the replication change log bounded
+    """
+    if DRY_RUN:
+        return
+    
+    try:
+        with db_pool.connection() as conn:
+            trimmed = radius_store.trim_authorize_changes(conn, AUTHORIZE_KEEP_CHANGES)
+            if CHANGELOG_ENABLED:
+                trimmed += change_log.trim(conn, CHANGELOG_RETENTION_HOURS)
+            conn.commit()
+        if trimmed:
+            logger.debug(f"Trimmed {trimmed} change log entries")
+    except sqlite3.Error as e:
+        logger.error(f"Could not trim the change logs: {e}")
 
 def delete_orphaned_vouchers(usernames: List[str]) -> int:
     """
@@ -155,42 +436,166 @@ def delete_orphaned_vouchers(usernames: List[str]) -> int:
         return len(usernames)
     
     deleted_count = 0
+    slice_size = _delete_slice['size']
+    pos = 0
     
-    try:
-        conn = sqlite3.connect(RADIUS_DB_PATH)
-        cursor = conn.cursor()
+    # Set-based deletes (radcheck, radreply, radpostauth, radacct) committed in
+    # short slices, so FreeRADIUS's own inserts never wait long for the write lock
+    while pos < len(usernames):
+        batch = usernames[pos:pos + slice_size]
+        started = time.monotonic()
+        
+        try:
+            with db_pool.connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    result = radius_store.delete_vouchers(conn, batch)
+                    if CHANGELOG_ENABLED and result['vouchers']:
+                        change_log.record(conn, 'delete_vouchers', {'usernames': batch})
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            deleted_count += result['vouchers']
+        except sqlite3.Error as e:
+            logger.error(f"Database error deleting {len(batch)} orphaned vouchers: {e}")
+        
+        elapsed = time.monotonic() - started
+        pos += len(batch)
+        
+        # Halve the slice when it held the lock too long, grow it back when cheap
+        if elapsed > DELETE_SLICE_BUDGET and slice_size > 1:
+            slice_size = max(1, slice_size // 2)
+        elif elapsed < DELETE_SLICE_BUDGET / 2:
+            slice_size = min(DELETE_SLICE_SIZE, slice_size * 2)
+        
+        if pos < len(usernames):
+            time.sleep(DELETE_SLICE_PAUSE)
+    
+    _delete_slice['size'] = slice_size
+    logger.info(f"Successfully deleted {deleted_count} orphaned vouchers from RADIUS")
+    
+    return deleted_count
+
+def verify_and_delete(usernames: Iterable[str]) -> Dict[str, int]:
+    """
+    Pipelined cleanup: concurrent verification, single deletion consumer
+    
+    Batches are submitted to a thread pool, never more than CONCURRENCY at
+    once. Each orphan list is handed to one deletion thread through a
+    bounded queue, so SQLite sees a single writer and verification does not
+    wait for deletes (and vice versa).
+    
+    Batches complete out of order; the checkpoint only advances to the last
+    username of a batch once every earlier batch is complete too (verified,
+    orphans deleted, or failed and left for the next reconciliation).
+    
+    Args:
+        usernames: Usernames to verify, in username order
         
-        # Delete from radcheck, radreply, and radpostauth tables
-        for username in usernames:
+    Returns:
+        Dictionary with 'verified', 'valid', 'orphaned', 'deleted' and
+        'failed_batches'
+    """
+    totals = {'verified': 0, 'valid': 0, 'orphaned': 0, 'deleted': 0, 'failed_batches': 0}
+    deletions = queue.Queue(maxsize=CONCURRENCY * 2)
+    pending = deque()  # (batch_num, last username) in submission order
+    completed = set()
+    checkpoint_lock = threading.Lock()
+    
+    def complete(batch_num: int):
+        with checkpoint_lock:
+            completed.add(batch_num)
+            checkpoint = None
+            while pending and pending[0][0] in completed:
+                done_num, checkpoint = pending.popleft()
+                completed.discard(done_num)
+            # Saved under the lock so checkpoints are never written out of order
+            if checkpoint is not None:
+                save_checkpoint(checkpoint)
+    
+    def deletion_consumer():
+        while True:
+            item = deletions.get()
+            if item is None:
+                return
+            batch_num, orphaned = item
             try:
-                cursor.execute("DELETE FROM radcheck WHERE username = ?", (username,))
-                cursor.execute("DELETE FROM radreply WHERE username = ?", (username,))
-                cursor.execute("DELETE FROM radpostauth WHERE username = ?", (username,))
-                deleted_count += 1
-                
-                if deleted_count % 100 == 0:
-                    logger.info(f"Deleted {deleted_count}/{len(usernames)} orphaned vouchers...")
-                    
-            except sqlite3.Error as e:
-                logger.error(f"Failed to delete voucher {username}: {e}")
-                continue
+                totals['deleted'] += delete_orphaned_vouchers(orphaned)
+            except Exception as e:
+                logger.error(f"Deletion of {len(orphaned)} orphaned vouchers failed: {e}")
+            complete(batch_num)
+    
+    def handle(future, batch_num: int, size: int):
+        result = future.result()
         
-        conn.commit()
-        conn.close()
+        if result.get('failed'):
+            totals['failed_batches'] += 1
+            logger.warning(f"Batch {batch_num}: verification failed, skipped ({size} usernames)")
+            complete(batch_num)
+            return
         
-        logger.info(f"Successfully deleted {deleted_count} orphaned vouchers from RADIUS")
+        totals['valid'] += len(result['valid'])
+        totals['orphaned'] += len(result['orphaned'])
         
-        return deleted_count
+        logger.info(f"Batch {batch_num}: {len(result['valid'])} valid, {len(result['orphaned'])} orphaned")
         
-    except sqlite3.Error as e:
-        logger.error(f"Database error during deletion: {e}")
-        return deleted_count
-    except Exception as e:
-        logger.error(f"Unexpected error during deletion: {e}")
-        return deleted_count
+        if result['orphaned']:
+            # Blocks when the deletion thread falls behind (bounds memory)
+            deletions.put((batch_num, result['orphaned']))
+        else:
+            complete(batch_num)
+    
+    consumer = threading.Thread(target=deletion_consumer, name='cleanup-delete')
+    consumer.start()
+    
+    try:
+        with ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix='cleanup-verify') as executor:
+            in_flight = {}
+            
+            for batch_num, batch in enumerate(laravel.iter_chunks(usernames, max_items=BATCH_SIZE), 1):
+                if len(in_flight) >= CONCURRENCY:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        handle(future, *in_flight.pop(future))
+                
+                totals['verified'] += len(batch)
+                logger.info(f"Verifying batch {batch_num} ({len(batch)} usernames, {totals['verified']} so far)...")
+                with checkpoint_lock:
+                    pending.append((batch_num, batch[-1]))
+                in_flight[executor.submit(verify_with_laravel, batch)] = (batch_num, len(batch))
+            
+            for future in list(in_flight):
+                handle(future, *in_flight.pop(future))
+    finally:
+        deletions.put(None)
+        consumer.join()
+    
+    return totals
 
 def main():
     """Main execution function"""
+    parser = argparse.ArgumentParser(description='Remove RADIUS vouchers that no longer exist in RADTik')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='Run the full reconciliation now instead of waiting for reconcile_interval_hours')
+    args = parser.parse_args()
+    
+    trim_change_logs()
+    
+    if FOLLOWER:
+        # Deletions arrive from the primary through follow-changes.py
+        return
+    
+    # Step 1: Apply deletions reported by Laravel since the last run
+    feed = apply_tombstones() if TOMBSTONES else None
+    
+    if not args.reconcile and not (feed and feed['reset']) and not reconcile_due():
+        if feed and feed['received']:
+            logger.info(f"Tombstone feed: {feed['received']} deleted in RADTik, "
+                        f"{feed['deleted']} removed from RADIUS (cursor {feed['cursor']})")
+            laravel.log_stats()
+        return
+    
     logger.info("=" * 60)
     logger.info("Starting orphaned voucher cleanup")
     logger.info("=" * 60)
@@ -198,46 +603,61 @@ def main():
     if DRY_RUN:
         logger.info("** DRY RUN MODE - No changes will be made **")
     
-    # Step 1: Get all usernames from RADIUS
-    radius_usernames = get_radius_usernames()
+    if feed is not None:
+        logger.info(f"Tombstone feed: {feed['received']} deleted in RADTik, "
+                    f"{feed['deleted']} removed from RADIUS (cursor {feed['cursor']})")
+        logger.info("Running full reconciliation (safety net)")
+    
+    # Step 2: Count vouchers in RADIUS
+    radius_total = count_radius_usernames()
     
-    if not radius_usernames:
+    if not radius_total:
         logger.info("No vouchers found in RADIUS database. Nothing to clean.")
+        if not DRY_RUN:
+            mark_reconciled()
         return
     
-    # Step 2: Process in batches
-    total_deleted = 0
-    total_valid = 0
+    logger.info(f"Found {radius_total} vouchers in RADIUS database")
     
-    for i in range(0, len(radius_usernames), BATCH_SIZE):
-        batch = radius_usernames[i:i + BATCH_SIZE]
-        batch_num = (i // BATCH_SIZE) + 1
-        total_batches = (len(radius_usernames) + BATCH_SIZE - 1) // BATCH_SIZE
-        
-        logger.info(f"Processing batch {batch_num}/{total_batches} ({len(batch)} usernames)...")
-        
-        # Verify with Laravel
-        result = verify_with_laravel(batch)
-        
-        valid_count = len(result['valid'])
-        orphaned_count = len(result['orphaned'])
-        
-        total_valid += valid_count
+    # Step 3: Compare bucket digests with Laravel, keep only differing buckets
+    buckets = select_buckets() if RECONCILE == 'digest' else None
+    
+    # Step 4: Stream usernames (from the checkpoint of an interrupted run) and verify
+    # batches (at most BATCH_SIZE usernames and [laravel] max_body_bytes each) with up
+    # to CONCURRENCY requests in flight; orphans go to the deletion thread
+    totals = {'verified': 0, 'valid': 0, 'orphaned': 0, 'deleted': 0, 'failed_batches': 0}
+    if buckets is None or buckets:
+        checkpoint = load_checkpoint()
+        if checkpoint:
+            logger.info(f"Resuming interrupted reconciliation after '{checkpoint}'")
         
-        logger.info(f"Batch {batch_num}: {valid_count} valid, {orphaned_count} orphaned")
+        to_verify = iter_radius_usernames(after=checkpoint)
+        if buckets is not None:
+            to_verify = (username for username in to_verify if bucket_of(username, DIGEST_BUCKETS) in buckets)
         
-        # Delete orphaned vouchers
-        if result['orphaned']:
-            deleted = delete_orphaned_vouchers(result['orphaned'])
-            total_deleted += deleted
+        totals = verify_and_delete(to_verify)
+    
+    # The pass is complete, the next reconciliation starts from the beginning
+    save_checkpoint('')
+    total_valid = totals['valid']
+    total_deleted = totals['deleted']
     
     # Summary
     logger.info("=" * 60)
     logger.info("Cleanup Summary:")
-    logger.info(f"  Total vouchers in RADIUS: {len(radius_usernames)}")
-    logger.info(f"  Valid vouchers (kept): {total_valid}")
+    logger.info(f"  Total vouchers in RADIUS: {radius_total}")
+    logger.info(f"  Usernames verified: {totals['verified']}")
+    logger.info(f"  Valid vouchers (verified and kept): {total_valid}")
     logger.info(f"  Orphaned vouchers (deleted): {total_deleted}")
+    if totals['failed_batches']:
+        logger.info(f"  Batches that could not be verified: {totals['failed_batches']}")
     logger.info("=" * 60)
+    laravel.log_stats()
+    
+    # Recorded even if some batches failed, so an outage does not turn every
+    # cron run into a full scan; they are verified at the next interval
+    if not DRY_RUN:
+        mark_reconciled()
     
     if DRY_RUN:
         logger.info("** DRY RUN completed - No actual changes made **")
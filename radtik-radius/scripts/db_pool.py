@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+RadTik SQLite Connection Pool
+Small per-process pool of tuned SQLite connections shared by the API server
+and the cron scripts.
+
+Each connection gets the PRAGMA profile from the [database] section of
+config.ini once, when it is opened, and is health-checked before reuse.
+Pools are bound to the process that created them, so gunicorn workers forked
+from a parent never share a connection.
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import metrics
+
+logger = logging.getLogger('db-pool')
+
+# Default PRAGMA profile (see sqlite/DATABASE.md "Performance Optimizations")
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 30000,
+    'synchronous': 'NORMAL',
+    'cache_size': -20000,       # negative = KiB, ~20 MB page cache
+    'mmap_size': 268435456,     # 256 MB memory-mapped I/O
+    'temp_store': 'MEMORY',
+}
+
+
+class ConnectionPool:
+    """Thread-safe pool of SQLite connections for a single database file"""
+
+    def __init__(self, db_path: str, size: int = 4, pragmas: Optional[Dict] = None,
+                 cached_statements: int = 256, health_check_interval: float = 30.0,
+                 acquire_timeout: float = 30.0):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.cached_statements = cached_statements
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """(Re)initialise pool state for the current process"""
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._last_used = {}
+        self._created = 0
+        self._stats = {
+            'connections_opened': 0,
+            'connections_discarded': 0,
+            'acquired': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'health_check_failures': 0,
+        }
+
+    def _open(self) -> sqlite3.Connection:
+        """Open a new connection and apply the PRAGMA profile"""
+        timeout = self.pragmas.get('busy_timeout', 30000) / 1000.0
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.row_factory = sqlite3.Row
+
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+
+        self._stats['connections_opened'] += 1
+        return conn
+
+    def _discard(self, conn: sqlite3.Connection):
+        """Close a connection and free its slot"""
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+            self._last_used.pop(id(conn), None)
+            self._stats['connections_discarded'] += 1
+
+    def _is_healthy(self, conn: sqlite3.Connection) -> bool:
+        """Verify an idle connection still works"""
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error as e:
+            logger.warning(f"Discarding unhealthy database connection: {e}")
+            self._stats['health_check_failures'] += 1
+            return False
+
+    def acquire(self) -> sqlite3.Connection:
+        """Take a connection from the pool, opening one if below capacity"""
+        if os.getpid() != self._pid:
+            # Forked child: never reuse the parent's connections
+            with self._lock:
+                self._reset()
+
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+
+            if conn is None:
+                with self._lock:
+                    can_open = self._created < self.size
+                    if can_open:
+                        self._created += 1
+
+                if can_open:
+                    try:
+                        conn = self._open()
+                    except sqlite3.Error as e:
+                        with self._lock:
+                            self._created -= 1
+                        logger.error(f"Database connection error: {e}")
+                        raise
+                else:
+                    started = time.monotonic()
+                    self._stats['waits'] += 1
+                    metrics.inc('radtik_sqlite_pool_waits_total')
+                    try:
+                        conn = self._idle.get(timeout=self.acquire_timeout)
+                    except queue.Empty:
+                        metrics.inc('radtik_errors_total', type='pool_timeout')
+                        raise sqlite3.OperationalError(
+                            f"Timed out waiting for a database connection ({self.size} in use)"
+                        )
+                    finally:
+                        waited = time.monotonic() - started
+                        self._stats['wait_seconds'] += waited
+                        metrics.inc('radtik_sqlite_pool_wait_seconds_total', waited)
+
+            idle_for = time.monotonic() - self._last_used.get(id(conn), time.monotonic())
+            if idle_for >= self.health_check_interval and not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+
+            self._stats['acquired'] += 1
+            return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool, rolling back any open transaction"""
+        if os.getpid() != self._pid:
+            return
+
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            logger.warning(f"Rollback on release failed: {e}")
+            self._discard(conn)
+            return
+
+        self._last_used[id(conn)] = time.monotonic()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager yielding a pooled connection"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self) -> Dict:
+        """Return pool statistics for this process"""
+        with self._lock:
+            in_pool = self._created
+        idle = self._idle.qsize()
+        stats = dict(self._stats)
+        stats['wait_seconds'] = round(stats['wait_seconds'], 6)
+        stats.update({
+            'pid': self._pid,
+            'size': self.size,
+            'open': in_pool,
+            'idle': idle,
+            'in_use': in_pool - idle,
+            'cached_statements': self.cached_statements,
+        })
+        return stats
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+def pool_from_config(config, db_path: str, size: Optional[int] = None) -> ConnectionPool:
+    """
+    Build a pool from the [database] section of config.ini
+
+    Args:
+        config: Loaded ConfigParser
+        db_path: Path to the RADIUS SQLite database
+        size: Override pool size (cron scripts only need one connection)
+    """
+    section = 'database'
+    pragmas = {
+        'journal_mode': config.get(section, 'journal_mode', fallback=DEFAULT_PRAGMAS['journal_mode']),
+        'busy_timeout': config.getint(section, 'busy_timeout', fallback=DEFAULT_PRAGMAS['busy_timeout']),
+        'synchronous': config.get(section, 'synchronous', fallback=DEFAULT_PRAGMAS['synchronous']),
+        'cache_size': config.getint(section, 'cache_size', fallback=DEFAULT_PRAGMAS['cache_size']),
+        'mmap_size': config.getint(section, 'mmap_size', fallback=DEFAULT_PRAGMAS['mmap_size']),
+        'temp_store': config.get(section, 'temp_store', fallback=DEFAULT_PRAGMAS['temp_store']),
+    }
+
+    return ConnectionPool(
+        db_path,
+        size=size if size is not None else config.getint(section, 'pool_size', fallback=4),
+        pragmas=pragmas,
+        cached_statements=config.getint(section, 'cached_statements', fallback=256),
+        health_check_interval=config.getfloat(section, 'health_check_interval', fallback=30.0),
+    )
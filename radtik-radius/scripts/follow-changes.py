@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+RadTik Replication Follower
+Keeps this RADIUS server's voucher set in sync with a primary RadTik RADIUS
+server, so Laravel only has to push to the primary.
+
+Each cycle:
+1. If this server has no replication cursor yet (or the primary reported a
+   reset), copies the primary's radcheck/radreply/radusergroup rows (and
+   its rate-limit profiles) page by page from GET /changes/snapshot. Progress is saved after every page, so an
+   interrupted copy resumes where it stopped
+2. Pulls pages of changes after the cursor from GET /changes?since=<seq>
+   and applies each page with the same operations the primary's writer
+   used, in one transaction together with the new cursor
+
+The primary must have [replication] changelog = true. radpostauth and
+radacct are not replicated: every server keeps its own authentication and
+accounting history.
+
+Usage:
+    python3 follow-changes.py            # catch up once and exit
+    python3 follow-changes.py --daemon   # long-running (radtik-replication-follower.service)
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict
+
+import requests
+
+import change_log
+import radius_store
+from db_pool import pool_from_config
+from write_queue import OPERATIONS
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('/var/log/radtik-replication-follower.log'),
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('follow-changes')
+
+# Load configuration
+config = configparser.ConfigParser()
+config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
+
+if not os.path.exists(config_path):
+    logger.error(f"Configuration file not found: {config_path}")
+    sys.exit(1)
+
+config.read(config_path)
+
+# Configuration variables
+RADIUS_DB_PATH = config.get('radius', 'db_path', fallback='/etc/freeradius/3.0/sqlite/radius.db')
+PRIMARY_URL = config.get('replication', 'primary_url', fallback='').strip().rstrip('/')
+PRIMARY_TOKEN = config.get('replication', 'primary_token', fallback='') or config.get('api', 'auth_token', fallback='')
+PAGE_SIZE = config.getint('replication', 'page_size', fallback=1000)
+SNAPSHOT_PAGE_SIZE = config.getint('replication', 'snapshot_page_size', fallback=5000)
+POLL_INTERVAL = config.getfloat('replication', 'poll_interval', fallback=1.0)
+MAX_BACKOFF = config.getfloat('replication', 'max_backoff_seconds', fallback=60)
+REQUEST_TIMEOUT = config.getfloat('replication', 'timeout', fallback=30)
+
+# Validate configuration
+if not PRIMARY_URL:
+    logger.error("primary_url not configured in config.ini [replication] section!")
+    sys.exit(1)
+
+if not PRIMARY_TOKEN:
+    logger.error("primary_token not configured in config.ini [replication] section!")
+    sys.exit(1)
+
+if not os.path.exists(RADIUS_DB_PATH):
+    logger.error(f"RADIUS database not found: {RADIUS_DB_PATH}")
+    sys.exit(1)
+
+
+# Shared connection pool (a single connection is enough for this script)
+db_pool = pool_from_config(config, RADIUS_DB_PATH, size=1)
+
+# Keep-alive session to the primary's API
+session = requests.Session()
+session.headers.update({
+    'Authorization': f'Bearer {PRIMARY_TOKEN}',
+    'Accept': 'application/json',
+})
+
+
+class PrimaryError(Exception):
+    """The primary could not be reached or answered with an error"""
+
+
+def fetch(path: str, params: Dict) -> Dict:
+    """GET a replication endpoint of the primary"""
+    try:
+        response = session.get(f"{PRIMARY_URL}{path}", params=params, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise PrimaryError(f"{path}: {e}")
+    
+    if response.status_code != 200:
+        try:
+            error = response.json().get('error', '')
+        except ValueError:
+            error = response.text[:200]
+        raise PrimaryError(f"{path}: HTTP {response.status_code} {error}")
+    
+    return response.json()
+
+
+def copy_snapshot(restart: bool = False) -> int:
+    """
+    Copy the primary's voucher set, page by page
+    
+    Args:
+        restart: Start from the first page even if a copy was in progress
+    
+    Returns:
+        Number of usernames' rows copied (radcheck rows)
+    """
+    with db_pool.connection() as conn:
+        saved = radius_store.get_state(conn, change_log.SNAPSHOT_KEY, '')
+    
+    state = json.loads(saved) if saved and not restart else {'seq': None, 'after': ''}
+    
+    if state['after']:
+        logger.info(f"Resuming snapshot copy after '{state['after']}'")
+    else:
+        logger.info("Copying the voucher set from the primary")
+    
+    copied = 0
+    started = time.monotonic()
+    
+    while True:
+        page = fetch('/changes/snapshot', {'after': state['after'], 'limit': SNAPSHOT_PAGE_SIZE})
+        # Changes are replayed from the position of the first page, so
+        # anything that changed while later pages were read is applied again
+        seq = state['seq'] if state['seq'] is not None else page['seq']
+        
+        with db_pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                change_log.apply_snapshot_page(conn, page)
+                if page['until'] is None:
+                    radius_store.set_state(conn, change_log.CURSOR_KEY, seq)
+                    radius_store.set_state(conn, change_log.SNAPSHOT_KEY, '')
+                else:
+                    radius_store.set_state(conn, change_log.SNAPSHOT_KEY,
+                                           json.dumps({'seq': seq, 'after': page['until']}))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        
+        copied += len(page['radcheck'])
+        
+        if page['until'] is None:
+            break
+        state = {'seq': seq, 'after': page['until']}
+    
+    logger.info(f"Snapshot copied: {copied} radcheck rows in {time.monotonic() - started:.1f}s, "
+                f"replaying changes after {seq}")
+    return copied
+
+
+def pull_changes() -> int:
+    """
+    Catch up with the primary
+    
+    Returns:
+        Number of changes applied
+    """
+    with db_pool.connection() as conn:
+        cursor = radius_store.get_state(conn, change_log.CURSOR_KEY)
+        snapshot = radius_store.get_state(conn, change_log.SNAPSHOT_KEY, '')
+    
+    if cursor is None or snapshot:
+        copy_snapshot()
+        with db_pool.connection() as conn:
+            cursor = radius_store.get_state(conn, change_log.CURSOR_KEY)
+    
+    cursor = int(cursor)
+    applied = 0
+    
+    while True:
+        page = fetch('/changes', {'since': cursor, 'limit': PAGE_SIZE})
+        
+        if page['reset']:
+            logger.warning(f"Primary no longer has the changes after {cursor} "
+                           f"(latest {page['latest']}), copying the voucher set again")
+            copy_snapshot(restart=True)
+            with db_pool.connection() as conn:
+                cursor = int(radius_store.get_state(conn, change_log.CURSOR_KEY))
+            continue
+        
+        if page['changes']:
+            with db_pool.connection() as conn:
+                result = change_log.apply_changes(conn, page['changes'], OPERATIONS,
+                                                  primary_latest=page['latest'])
+            applied += result['applied']
+            if result['skipped']:
+                logger.warning(f"{result['skipped']} change(s) up to {result['cursor']} could not be applied")
+            cursor = result['cursor']
+        
+        if not page['has_more']:
+            return applied
+
+
+def run_daemon():
+    """Follow the primary until SIGTERM"""
+    stop = threading.Event()
+    
+    def handle_signal(signum, frame):
+        logger.info(f"Received signal {signum}, stopping...")
+        stop.set()
+    
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    
+    logger.info(f"Replication follower started (primary {PRIMARY_URL}, poll {POLL_INTERVAL:.1f}s)")
+    
+    failures = 0
+    
+    while not stop.is_set():
+        try:
+            applied = pull_changes()
+        except (PrimaryError, sqlite3.Error) as e:
+            failures += 1
+            backoff = min(MAX_BACKOFF, POLL_INTERVAL * 2 ** failures)
+            logger.warning(f"Replication failed ({failures} in a row): {e}, retrying in {backoff:.0f}s")
+            stop.wait(backoff)
+            continue
+        except Exception as e:
+            failures += 1
+            logger.error(f"Replication error: {e}", exc_info=True)
+            stop.wait(min(MAX_BACKOFF, POLL_INTERVAL * 2 ** failures))
+            continue
+        
+        failures = 0
+        if applied:
+            logger.info(f"Applied {applied} change(s) from the primary")
+        
+        stop.wait(POLL_INTERVAL)
+    
+    session.close()
+    db_pool.close()
+    logger.info("Replication follower stopped")
+
+
+def main():
+    """Main function - catch up once or daemon mode"""
+    parser = argparse.ArgumentParser(description='Replicate vouchers from a primary RadTik RADIUS server')
+    parser.add_argument('--daemon', action='store_true', help='Run continuously (systemd service)')
+    args = parser.parse_args()
+    
+    if args.daemon:
+        run_daemon()
+        return
+    
+    try:
+        applied = pull_changes()
+        
+        with db_pool.connection() as conn:
+            status = change_log.follower_status(conn)
+        
+        logger.info(f"Replication caught up: {applied} change(s) applied, cursor {status['cursor']}")
+    except PrimaryError as e:
+        logger.error(f"Replication failed: {e}")
+        sys.exit(1)
+    except Exception as e:
+        logger.error(f"Fatal error: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
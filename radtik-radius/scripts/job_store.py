@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+RadTik Async Job Store
+Durable job table for asynchronous voucher syncs.
+
+Payloads are stored in a separate SQLite database (not radius.db) in chunks,
+so large batches never sit in memory and survive API restarts. A runner
+thread in every API worker claims queued jobs atomically and applies them
+chunk by chunk through the single writer, recording progress and per-item
+failures as it goes. The runner refreshes the job's heartbeat while it
+works on it (also while a chunk waits for the write lock); jobs whose worker
+died are re-queued after `stale_seconds` and resume from the first
+unfinished chunk. Progress is only recorded by the worker that owns the job,
+and only once per chunk.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from db_pool import ConnectionPool
+
+logger = logging.getLogger('job-store')
+
+# Job type -> (writer operation, payload key for the chunk items)
+JOB_TYPES = {
+    'sync_vouchers': ('insert_vouchers', 'vouchers'),
+}
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS sync_jobs (
+        id TEXT PRIMARY KEY,
+        type TEXT NOT NULL,
+        status TEXT NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0,
+        processed INTEGER NOT NULL DEFAULT 0,
+        synced INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        chunks INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        error TEXT,
+        created_at TEXT NOT NULL,
+        started_at TEXT,
+        finished_at TEXT,
+        heartbeat REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_sync_jobs_status ON sync_jobs(status, created_at)",
+    """
+    CREATE TABLE IF NOT EXISTS sync_job_chunks (
+        job_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        items INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (job_id, seq)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sync_job_errors (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_id TEXT NOT NULL,
+        message TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_sync_job_errors_job ON sync_job_errors(job_id, id)",
+]
+
+
+def _now() -> str:
+    return datetime.now().isoformat()
+
+
+class JobStore:
+    """Durable storage for async sync jobs"""
+
+    def __init__(self, db_path: str, chunk_size: int = 2000, stale_seconds: float = 120.0):
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self.stale_seconds = stale_seconds
+        self.pool = ConnectionPool(db_path, size=2)
+
+        with self.pool.connection() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+
+    def create_job(self, job_type: str, items: Iterable) -> str:
+        """
+        Store a job's items in chunks and queue it
+
+        Items are consumed incrementally, so `items` may be a generator over
+        a streamed request body.
+
+        Returns:
+            The new job ID
+        """
+        if job_type not in JOB_TYPES:
+            raise ValueError(f"Unknown job type: {job_type}")
+
+        job_id = uuid.uuid4().hex
+        total = 0
+        seq = 0
+        chunk = []
+
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO sync_jobs (id, type, status, created_at) VALUES (?, ?, 'receiving', ?)",
+                (job_id, job_type, _now())
+            )
+            conn.commit()
+
+            def store_chunk():
+                nonlocal seq
+                conn.execute(
+                    "INSERT INTO sync_job_chunks (job_id, seq, items, payload) VALUES (?, ?, ?, ?)",
+                    (job_id, seq, len(chunk), json.dumps(chunk))
+                )
+                conn.commit()
+                seq += 1
+                chunk.clear()
+
+            try:
+                for item in items:
+                    chunk.append(item)
+                    total += 1
+                    if len(chunk) >= self.chunk_size:
+                        store_chunk()
+                if chunk:
+                    store_chunk()
+            except Exception as e:
+                conn.rollback()
+                conn.execute(
+                    "UPDATE sync_jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                    (f"Upload failed: {e}", _now(), job_id)
+                )
+                conn.commit()
+                raise
+
+            conn.execute(
+                "UPDATE sync_jobs SET status = 'queued', total = ?, chunks = ? WHERE id = ?",
+                (total, seq, job_id)
+            )
+            conn.commit()
+
+        return job_id
+
+    def claim_next(self, worker: str) -> Optional[Dict]:
+        """Atomically claim the oldest queued job, re-queuing stale running ones first"""
+        with self.pool.connection() as conn:
+            conn.execute(
+                "UPDATE sync_jobs SET status = 'queued', worker = NULL "
+                "WHERE status = 'running' AND heartbeat < ?",
+                (time.time() - self.stale_seconds,)
+            )
+            conn.commit()
+
+            row = conn.execute(
+                "SELECT id, type FROM sync_jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+
+            # Only one worker wins the status transition
+            cursor = conn.execute(
+                """
+                UPDATE sync_jobs
+                SET status = 'running', worker = ?, heartbeat = ?,
+                    started_at = COALESCE(started_at, ?)
+                WHERE id = ? AND status = 'queued'
+                """,
+                (worker, time.time(), _now(), row['id'])
+            )
+            conn.commit()
+
+            return dict(row) if cursor.rowcount == 1 else None
+
+    def next_chunk(self, job_id: str) -> Optional[tuple]:
+        """Return (seq, items) of the first unfinished chunk"""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT seq, payload FROM sync_job_chunks WHERE job_id = ? AND done = 0 ORDER BY seq LIMIT 1",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row['seq'], json.loads(row['payload'])
+
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        """Refresh a running job's heartbeat; False if the worker no longer owns it"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE sync_jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time(), job_id, worker)
+            )
+            conn.commit()
+        return cursor.rowcount == 1
+
+    def complete_chunk(self, job_id: str, seq: int, items: int, result: Dict, worker: str) -> bool:
+        """
+        Record a chunk's result, drop its payload and refresh the heartbeat
+
+        Returns:
+            False (nothing recorded) if the worker no longer owns the job or
+            the chunk was already completed
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE sync_job_chunks SET done = 1, payload = ''
+                WHERE job_id = ? AND seq = ? AND done = 0
+                  AND EXISTS (SELECT 1 FROM sync_jobs WHERE id = ? AND worker = ? AND status = 'running')
+                """,
+                (job_id, seq, job_id, worker)
+            )
+            if cursor.rowcount != 1:
+                conn.rollback()
+                return False
+
+            conn.execute(
+                """
+                UPDATE sync_jobs
+                SET processed = processed + ?, synced = synced + ?, failed = failed + ?, heartbeat = ?
+                WHERE id = ?
+                """,
+                (items, result['synced'], result['failed'], time.time(), job_id)
+            )
+            if result['errors']:
+                conn.executemany(
+                    "INSERT INTO sync_job_errors (job_id, message) VALUES (?, ?)",
+                    [(job_id, message) for message in result['errors']]
+                )
+            conn.commit()
+
+        return True
+
+    def finish(self, job_id: str, status: str, worker: str, error: Optional[str] = None) -> bool:
+        """Set the final status; False if the worker no longer owns the job"""
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                "UPDATE sync_jobs SET status = ?, error = ?, finished_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (status, error, _now(), job_id, worker)
+            )
+            conn.commit()
+        return cursor.rowcount == 1
+
+    def get(self, job_id: str, errors_offset: int = 0, errors_limit: int = 100) -> Optional[Dict]:
+        """Return job progress and a page of per-item failures"""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT id, type, status, total, processed, synced, failed, chunks, error, "
+                "created_at, started_at, finished_at FROM sync_jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            errors = [r[0] for r in conn.execute(
+                "SELECT message FROM sync_job_errors WHERE job_id = ? ORDER BY id LIMIT ? OFFSET ?",
+                (job_id, errors_limit, errors_offset)
+            )]
+
+        job = dict(row)
+        job['job_id'] = job.pop('id')
+        job['progress'] = round(job['processed'] / job['total'], 4) if job['total'] else 0
+        job['errors'] = errors
+        job['errors_offset'] = errors_offset
+        return job
+
+    def purge(self, retention_hours: float) -> int:
+        """Delete finished (or abandoned uploads) jobs older than the retention window"""
+        cutoff = (datetime.now() - timedelta(hours=retention_hours)).isoformat()
+
+        with self.pool.connection() as conn:
+            job_ids = [r[0] for r in conn.execute(
+                "SELECT id FROM sync_jobs WHERE (status IN ('completed', 'failed') AND finished_at < ?) "
+                "OR (status = 'receiving' AND created_at < ?)",
+                (cutoff, cutoff)
+            )]
+            for job_id in job_ids:
+                conn.execute("DELETE FROM sync_job_chunks WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM sync_job_errors WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM sync_jobs WHERE id = ?", (job_id,))
+            conn.commit()
+
+        return len(job_ids)
+
+
+class JobRunner:
+    """Background thread that applies queued jobs through the single writer"""
+
+    def __init__(self, store: JobStore, writer, poll_interval: float = 1.0,
+                 retention_hours: float = 72.0):
+        self.store = store
+        self.writer = writer
+        self.poll_interval = poll_interval
+        self.retention_hours = retention_hours
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self._last_purge = 0.0
+        self._thread = threading.Thread(target=self._run, name='radius-job-runner', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.store.claim_next(self.worker)
+                if job is None:
+                    self._maybe_purge()
+                    time.sleep(self.poll_interval)
+                    continue
+                self._process(job)
+            except Exception as e:
+                logger.error(f"Job runner error: {e}")
+                time.sleep(self.poll_interval)
+
+    def _keep_alive(self, job_id: str, stop: threading.Event):
+        """Refresh the heartbeat while a job runs, so a chunk waiting for the write lock is not re-queued"""
+        interval = max(1.0, self.store.stale_seconds / 4)
+        while not stop.wait(interval):
+            try:
+                if not self.store.heartbeat(job_id, self.worker):
+                    return
+            except Exception as e:
+                logger.warning(f"Job {job_id} heartbeat failed: {e}")
+
+    def _process(self, job: Dict):
+        job_id = job['id']
+        op, key = JOB_TYPES[job['type']]
+        logger.info(f"Processing job {job_id} ({job['type']})")
+
+        stop = threading.Event()
+        threading.Thread(target=self._keep_alive, args=(job_id, stop),
+                         name='radius-job-heartbeat', daemon=True).start()
+
+        try:
+            while True:
+                chunk = self.store.next_chunk(job_id)
+                if chunk is None:
+                    break
+                seq, items = chunk
+                if not self.store.heartbeat(job_id, self.worker):
+                    logger.warning(f"Job {job_id} was re-queued and taken over, stopping")
+                    return
+                result = self.writer.submit(op, {key: items})
+                if not self.store.complete_chunk(job_id, seq, len(items), result, self.worker):
+                    logger.warning(f"Job {job_id} chunk {seq} was already recorded by another worker, stopping")
+                    return
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            self.store.finish(job_id, 'failed', self.worker, str(e))
+            return
+        finally:
+            stop.set()
+
+        if self.store.finish(job_id, 'completed', self.worker):
+            logger.info(f"Job {job_id} completed")
+
+    def _maybe_purge(self):
+        if time.monotonic() - self._last_purge < 3600:
+            return
+        self._last_purge = time.monotonic()
+        purged = self.store.purge(self.retention_hours)
+        if purged:
+            logger.info(f"Purged {purged} finished job(s)")
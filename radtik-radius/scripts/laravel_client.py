@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+RadTik Laravel API Client
+Shared HTTP client for the sync scripts' calls to the Laravel API.
+
+- One requests.Session per process with a pool of keep-alive connections,
+  so consecutive calls reuse the TCP/TLS connection instead of doing a new
+  handshake per batch
+- JSON bodies larger than `gzip_min_bytes` are gzip-compressed
+  (Content-Encoding: gzip, inflated by Laravel's DecompressRequestBody
+  middleware, which marks its responses with X-Request-Body-Inflated).
+  Only if a server that predates the middleware rejects the first
+  compressed body (400/415/422 without that header) is the request
+  repeated as plain JSON, with compression off for the rest of the
+  process; a validation error from an up-to-date Laravel keeps gzip on
+- iter_chunks() splits a list into chunks of at most `max_body_bytes` of
+  JSON (and optionally a maximum item count), so a large payload is never
+  sent as one huge POST
+- Connection errors, timeouts, 429 and 502/503/504 responses are retried
+  with exponential backoff and full jitter (Retry-After is honoured)
+- Each call's duration, status, attempts and bytes are logged at debug
+  level and summed in stats()
+"""
+
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('laravel-client')
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Responses of a Laravel without DecompressRequestBody to a gzip body
+# (it sees an empty or unreadable body)
+GZIP_REJECTED_STATUSES = (400, 415, 422)
+
+# Set by DecompressRequestBody on every response to a gzip body
+GZIP_INFLATED_HEADER = 'X-Request-Body-Inflated'
+
+
+class LaravelClient:
+    """Pooled, compressing, retrying JSON client for the Laravel API"""
+
+    def __init__(self, base_url: str, token: str, timeout: float = 30.0,
+                 gzip_requests: bool = True, gzip_min_bytes: int = 1024,
+                 max_body_bytes: int = 1048576, retries: int = 3,
+                 retry_backoff: float = 0.5, retry_max_backoff: float = 10.0,
+                 pool_size: int = 4):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.gzip_requests = gzip_requests
+        self.gzip_min_bytes = gzip_min_bytes
+        self.max_body_bytes = max_body_bytes
+        self.retries = max(0, retries)
+        self.retry_backoff = retry_backoff
+        self.retry_max_backoff = retry_max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {token}',
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip',
+        })
+
+        self._gzip_confirmed = False
+        self._lock = threading.Lock()
+        self._stats = {
+            'calls': 0,
+            'attempts': 0,
+            'retries': 0,
+            'failures': 0,
+            'bytes_raw': 0,
+            'bytes_sent': 0,
+            'seconds': 0.0,
+        }
+
+    def _record(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+    def _encode(self, raw: bytes) -> Optional[bytes]:
+        """Compressed body, or None to send the raw JSON"""
+        if not self.gzip_requests or len(raw) < self.gzip_min_bytes:
+            return None
+        return gzip.compress(raw, compresslevel=6)
+
+    def _backoff(self, attempt: int, response: Optional[requests.Response]) -> float:
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(self.retry_max_backoff, float(retry_after))
+        return random.uniform(0, min(self.retry_max_backoff, self.retry_backoff * 2 ** attempt))
+
+    def post(self, path: str, payload: Dict, timeout: Optional[float] = None) -> requests.Response:
+        """
+        POST a JSON payload, retrying transient failures
+
+        Args:
+            path: API path (e.g. /api/radius/activations)
+            payload: JSON-serialisable request body
+            timeout: Per-attempt timeout (defaults to the client timeout)
+
+        Returns:
+            The final response (any status)
+
+        Raises:
+            requests.exceptions.RequestException if every attempt failed
+            without a response
+        """
+        url = f"{self.base_url}{path}"
+        raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        compressed = self._encode(raw)
+        started = time.monotonic()
+        attempt = 0
+        sent = 0
+
+        try:
+            while True:
+                attempt += 1
+                body = raw if compressed is None else compressed
+                headers = {} if compressed is None else {'Content-Encoding': 'gzip'}
+                response = None
+                error = None
+                sent += len(body)
+
+                try:
+                    response = self.session.post(url, data=body, headers=headers,
+                                                 timeout=timeout or self.timeout)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    error = e
+
+                if response is not None and compressed is not None and not self._gzip_confirmed:
+                    if GZIP_INFLATED_HEADER in response.headers:
+                        self._gzip_confirmed = True
+                    elif response.status_code in GZIP_REJECTED_STATUSES:
+                        logger.warning(f"Laravel did not inflate a gzip request body ({response.status_code}), "
+                                       "sending plain JSON from now on")
+                        self.gzip_requests = False
+                        compressed = None
+                        continue
+
+                retryable = error is not None or response.status_code in RETRY_STATUSES
+                if not retryable or attempt > self.retries:
+                    if error is not None:
+                        raise error
+                    return response
+
+                delay = self._backoff(attempt - 1, response)
+                reason = error.__class__.__name__ if error is not None else f"HTTP {response.status_code}"
+                logger.warning(f"POST {path} failed ({reason}), retry {attempt}/{self.retries} in {delay:.1f}s")
+                self._record(retries=1)
+                time.sleep(delay)
+        except Exception:
+            self._record(failures=1)
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            self._record(calls=1, attempts=attempt, bytes_raw=len(raw), bytes_sent=sent, seconds=elapsed)
+            logger.debug(f"POST {path}: {elapsed * 1000:.0f} ms, {attempt} attempt(s), "
+                         f"{len(raw)} bytes JSON, {sent} bytes sent")
+
+    def iter_chunks(self, items: Iterable, max_items: Optional[int] = None) -> Iterator[List]:
+        """
+        Split items into lists whose JSON encoding stays within max_body_bytes
+
+        An item larger than the limit on its own is sent as a chunk of one.
+        """
+        chunk = []
+        size = 0
+
+        for item in items:
+            item_size = len(json.dumps(item, separators=(',', ':'))) + 1
+            if chunk and (size + item_size > self.max_body_bytes or
+                          (max_items and len(chunk) >= max_items)):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(item)
+            size += item_size
+
+        if chunk:
+            yield chunk
+
+    def stats(self) -> Dict:
+        """Totals for this process (bytes_sent counts compressed bodies and retries)"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['seconds'] = round(stats['seconds'], 3)
+        return stats
+
+    def log_stats(self):
+        stats = self.stats()
+        if not stats['calls']:
+            return
+        saved = 100 - (100 * stats['bytes_sent'] / stats['bytes_raw']) if stats['bytes_raw'] else 0
+        logger.info(f"Laravel API: {stats['calls']} call(s) in {stats['seconds']:.2f}s, "
+                    f"{stats['retries']} retr{'y' if stats['retries'] == 1 else 'ies'}, "
+                    f"{stats['bytes_sent']} bytes sent for {stats['bytes_raw']} bytes JSON ({saved:.0f}% saved)")
+
+    def close(self):
+        self.session.close()
+
+
+def client_from_config(config, min_pool_size: int = 1) -> LaravelClient:
+    """
+    Build the client from the [laravel] section of config.ini
+
+    Args:
+        min_pool_size: Lower bound for pool_size (callers that keep several
+            requests in flight need one connection per request)
+    """
+    return LaravelClient(
+        config.get('laravel', 'api_url', fallback=''),
+        config.get('api', 'auth_token', fallback=''),
+        timeout=config.getfloat('laravel', 'timeout', fallback=30),
+        gzip_requests=config.getboolean('laravel', 'gzip_requests', fallback=True),
+        gzip_min_bytes=config.getint('laravel', 'gzip_min_bytes', fallback=1024),
+        max_body_bytes=config.getint('laravel', 'max_body_bytes', fallback=1048576),
+        retries=config.getint('laravel', 'retries', fallback=3),
+        retry_backoff=config.getfloat('laravel', 'retry_backoff', fallback=0.5),
+        retry_max_backoff=config.getfloat('laravel', 'retry_max_backoff', fallback=10),
+        pool_size=max(min_pool_size, config.getint('laravel', 'pool_size', fallback=4))
+    )
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+RadTik Metrics
+Prometheus-style counters and histograms aggregated across API workers.
+
+Every process records into its own in-memory registry. A flusher thread
+writes a snapshot to `<directory>/<pid>.json` (atomic rename) every
+`flush_interval` seconds; GET /metrics merges the snapshots of all workers,
+so any worker can answer a scrape. Snapshots of exited workers are kept so
+counters never go backwards while the service runs (the directory lives in
+/run/radtik-radius and is cleared on restart).
+
+Recording is a dict update under a lock and never touches the disk, so it
+is safe to call from hot paths and from the cron scripts (which simply
+never flush).
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger('metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# name -> (type, help, label names, buckets)
+METRICS = {
+    'radtik_http_requests_total': (
+        'counter', 'HTTP requests by route, method and status', ('route', 'method', 'status'), None),
+    'radtik_http_request_duration_seconds': (
+        'histogram', 'HTTP request latency by route', ('route',), LATENCY_BUCKETS),
+    'radtik_http_request_size_bytes': (
+        'histogram', 'HTTP request body size by route (Content-Length)', ('route',), SIZE_BUCKETS),
+    'radtik_vouchers_written_total': (
+        'counter', 'Voucher rows changed in RADIUS by operation', ('op',), None),
+    'radtik_mac_bindings_written_total': (
+        'counter', 'MAC bindings inserted or updated', (), None),
+    'radtik_sqlite_lock_wait_seconds': (
+        'histogram', 'Time spent acquiring the SQLite write lock (BEGIN IMMEDIATE)', (), DB_BUCKETS),
+    'radtik_sqlite_busy_total': (
+        'counter', 'SQLite operations that failed with database locked/busy', (), None),
+    'radtik_sqlite_pool_waits_total': (
+        'counter', 'Connection pool acquisitions that had to wait for a free connection', (), None),
+    'radtik_sqlite_pool_wait_seconds_total': (
+        'counter', 'Total time spent waiting for a pooled connection', (), None),
+    'radtik_sqlite_commit_duration_seconds': (
+        'histogram', 'Duration of COMMIT for group-committed write batches', (), DB_BUCKETS),
+    'radtik_writer_batch_size': (
+        'histogram', 'Mutations per group commit', (), BATCH_BUCKETS),
+    'radtik_errors_total': (
+        'counter', 'Errors by type', ('type',), None),
+}
+
+_LabelKey = Tuple[str, ...]
+
+
+class Registry:
+    """In-memory metric values for one process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._values: Dict[str, Dict[_LabelKey, object]] = {}
+
+    def _check_process(self):
+        """Forked child: start from zero, the parent keeps its own snapshot"""
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._values = {}
+
+    def _series(self, name: str) -> Dict:
+        self._check_process()
+        return self._values.setdefault(name, {})
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Increment a counter"""
+        key = tuple(str(labels.get(label, '')) for label in METRICS[name][2])
+        with self._lock:
+            series = self._series(name)
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        """Record a histogram observation"""
+        buckets = METRICS[name][3]
+        key = tuple(str(labels.get(label, '')) for label in METRICS[name][2])
+        with self._lock:
+            series = self._series(name)
+            # [per-bucket counts..., +Inf count, sum]
+            values = series.get(key)
+            if values is None:
+                values = series[key] = [0] * (len(buckets) + 1) + [0.0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    values[index] += 1
+                    break
+            else:
+                values[len(buckets)] += 1
+            values[-1] += value
+
+    def snapshot(self) -> Dict:
+        """Return a JSON-serialisable copy of all values"""
+        with self._lock:
+            self._check_process()
+            return {
+                name: [[list(key), list(value) if isinstance(value, list) else value]
+                       for key, value in series.items()]
+                for name, series in self._values.items()
+            }
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+
+
+class MetricsExporter:
+    """Flushes this worker's registry and merges all workers' snapshots"""
+
+    def __init__(self, directory: str, flush_interval: float = 1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._shared = False
+
+    def start(self):
+        """Start the flusher (once per worker process)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                self._shared = True
+            except OSError as e:
+                # e.g. development server without /run/radtik-radius
+                logger.warning(f"Metrics directory unavailable ({e}), exporting this process only")
+                self._shared = False
+                return
+
+            threading.Thread(target=self._run, name='radius-metrics-flush', daemon=True).start()
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def flush(self):
+        """Atomically write this worker's snapshot"""
+        if not self._shared:
+            return
+        path = self._path(os.getpid())
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Metrics flush failed: {e}")
+
+    def collect(self) -> Dict:
+        """Merge the snapshots of all workers (this worker's is always fresh)"""
+        self.start()
+
+        snapshots = [registry.snapshot()]
+        if self._shared:
+            own_path = self._path(os.getpid())
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                if path == own_path:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Skipping metrics snapshot {path}: {e}")
+
+        merged: Dict[str, Dict[_LabelKey, object]] = {}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                if name not in METRICS:
+                    continue
+                target = merged.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(key)
+                    if isinstance(value, list):
+                        current = target.get(key)
+                        target[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        target[key] = target.get(key, 0) + value
+        return merged
+
+    def render(self) -> str:
+        """Render merged metrics in the Prometheus text exposition format"""
+        merged = self.collect()
+        lines = []
+
+        for name, (kind, help_text, label_names, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for key, value in sorted(merged.get(name, {}).items()):
+                labels = list(zip(label_names, key))
+                if kind == 'counter':
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    le = ('le', _format_value(bound))
+                    lines.append(f"{name}_bucket{_format_labels(labels + [le])} {cumulative}")
+                cumulative += value[len(buckets)]
+                lines.append(f"{name}_bucket{_format_labels(labels + [('le', '+Inf')])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def exporter_from_config(config) -> Optional[MetricsExporter]:
+    """Build the exporter from the [metrics] section (None if disabled)"""
+    if not config.getboolean('metrics', 'enabled', fallback=True):
+        return None
+    return MetricsExporter(
+        config.get('metrics', 'directory', fallback='/run/radtik-radius/metrics'),
+        flush_interval=config.getfloat('metrics', 'flush_interval', fallback=1.0)
+    )
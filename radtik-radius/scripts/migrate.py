@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+"""
+RadTik RADIUS Schema Migrations
+Versioned, idempotent schema migrations for the FreeRADIUS SQLite database.
+
+The applied version is stored in PRAGMA user_version. Each migration runs in
+its own BEGIN IMMEDIATE transaction, so it is safe to apply to a live
+install while FreeRADIUS and the API are running (writers wait on
+busy_timeout while an index is built).
+
+After migrating, hot queries are checked with EXPLAIN QUERY PLAN and the
+script exits non-zero if one of them no longer uses the expected index.
+
+Usage:
+    python3 migrate.py            # apply pending migrations + verify plans
+    python3 migrate.py --status   # show current / latest version
+    python3 migrate.py --check    # only verify query plans
+"""
+
+import argparse
+import configparser
+import logging
+import os
+import sqlite3
+import sys
+from typing import List, Tuple
+
+logger = logging.getLogger('migrate')
+
+# (version, description, statements) - never edit an applied migration, add a new one
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, 'Composite/covering indexes for hot queries, drop duplicate username indexes', [
+        # (username, attribute) existence checks, MAC lookups and Auth-Type checks
+        # are answered from the index alone (value is included for covering)
+        "CREATE INDEX IF NOT EXISTS idx_radcheck_username_attribute ON radcheck(username, attribute, value)",
+        # Activation sync: filter on reply/authdate, group on the remaining columns
+        "CREATE INDEX IF NOT EXISTS idx_radpostauth_activation ON radpostauth(reply, authdate, username, nas_identifier, calling_station_id)",
+        # Exact duplicates of the stock FreeRADIUS indexes (check_username,
+        # reply_username, radpostauth_username), which are kept
+        "DROP INDEX IF EXISTS idx_radcheck_username",
+        "DROP INDEX IF EXISTS idx_radreply_username",
+        "DROP INDEX IF EXISTS idx_radpostauth_username",
+    ]),
+    (2, 'Incrementally maintained counters for GET /stats (summary tables + triggers)', [
+        """
+        CREATE TABLE IF NOT EXISTS radius_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            vouchers INTEGER NOT NULL DEFAULT 0,
+            disabled_vouchers INTEGER NOT NULL DEFAULT 0,
+            mac_bindings INTEGER NOT NULL DEFAULT 0,
+            radcheck_records INTEGER NOT NULL DEFAULT 0,
+            radreply_records INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS radius_nas_stats (
+            nas_identifier TEXT PRIMARY KEY,
+            vouchers INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        # Seed from the current data (under the migration's write lock)
+        """
+        INSERT OR REPLACE INTO radius_stats
+            (id, vouchers, disabled_vouchers, mac_bindings, radcheck_records, radreply_records)
+        SELECT 1,
+            (SELECT COUNT(*) FROM radcheck WHERE attribute = 'Cleartext-Password'),
+            (SELECT COUNT(*) FROM radcheck WHERE attribute = 'Auth-Type' AND value = 'Reject'),
+            (SELECT COUNT(*) FROM radcheck WHERE attribute = 'Calling-Station-Id'),
+            (SELECT COUNT(*) FROM radcheck),
+            (SELECT COUNT(*) FROM radreply)
+        """,
+        "DELETE FROM radius_nas_stats",
+        """
+        INSERT INTO radius_nas_stats (nas_identifier, vouchers)
+        SELECT value, COUNT(*) FROM radcheck WHERE attribute = 'NAS-Identifier' GROUP BY value
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radcheck_stats_insert AFTER INSERT ON radcheck
+        BEGIN
+            UPDATE radius_stats SET
+                radcheck_records = radcheck_records + 1,
+                vouchers = vouchers + (NEW.attribute = 'Cleartext-Password'),
+                disabled_vouchers = disabled_vouchers + (NEW.attribute = 'Auth-Type' AND NEW.value = 'Reject'),
+                mac_bindings = mac_bindings + (NEW.attribute = 'Calling-Station-Id')
+            WHERE id = 1;
+            INSERT INTO radius_nas_stats (nas_identifier, vouchers)
+            SELECT NEW.value, 1 WHERE NEW.attribute = 'NAS-Identifier'
+            ON CONFLICT (nas_identifier) DO UPDATE SET vouchers = vouchers + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radcheck_stats_delete AFTER DELETE ON radcheck
+        BEGIN
+            UPDATE radius_stats SET
+                radcheck_records = radcheck_records - 1,
+                vouchers = vouchers - (OLD.attribute = 'Cleartext-Password'),
+                disabled_vouchers = disabled_vouchers - (OLD.attribute = 'Auth-Type' AND OLD.value = 'Reject'),
+                mac_bindings = mac_bindings - (OLD.attribute = 'Calling-Station-Id')
+            WHERE id = 1;
+            UPDATE radius_nas_stats SET vouchers = vouchers - 1
+            WHERE OLD.attribute = 'NAS-Identifier' AND nas_identifier = OLD.value;
+            DELETE FROM radius_nas_stats
+            WHERE OLD.attribute = 'NAS-Identifier' AND nas_identifier = OLD.value AND vouchers <= 0;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radcheck_stats_update AFTER UPDATE OF attribute, value ON radcheck
+        WHEN OLD.attribute IN ('Cleartext-Password', 'Auth-Type', 'Calling-Station-Id', 'NAS-Identifier')
+          OR NEW.attribute IN ('Cleartext-Password', 'Auth-Type', 'Calling-Station-Id', 'NAS-Identifier')
+        BEGIN
+            UPDATE radius_stats SET
+                vouchers = vouchers + (NEW.attribute = 'Cleartext-Password') - (OLD.attribute = 'Cleartext-Password'),
+                disabled_vouchers = disabled_vouchers
+                    + (NEW.attribute = 'Auth-Type' AND NEW.value = 'Reject')
+                    - (OLD.attribute = 'Auth-Type' AND OLD.value = 'Reject'),
+                mac_bindings = mac_bindings
+                    + (NEW.attribute = 'Calling-Station-Id') - (OLD.attribute = 'Calling-Station-Id')
+            WHERE id = 1;
+            UPDATE radius_nas_stats SET vouchers = vouchers - 1
+            WHERE OLD.attribute = 'NAS-Identifier' AND nas_identifier = OLD.value;
+            DELETE FROM radius_nas_stats
+            WHERE OLD.attribute = 'NAS-Identifier' AND nas_identifier = OLD.value AND vouchers <= 0;
+            INSERT INTO radius_nas_stats (nas_identifier, vouchers)
+            SELECT NEW.value, 1 WHERE NEW.attribute = 'NAS-Identifier'
+            ON CONFLICT (nas_identifier) DO UPDATE SET vouchers = vouchers + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radreply_stats_insert AFTER INSERT ON radreply
+        BEGIN
+            UPDATE radius_stats SET radreply_records = radreply_records + 1 WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radreply_stats_delete AFTER DELETE ON radreply
+        BEGIN
+            UPDATE radius_stats SET radreply_records = radreply_records - 1 WHERE id = 1;
+        END
+        """,
+    ]),
+    (3, 'Drop idx_radpostauth_activation (activation sync uses the processed flag)', [
+        # Activation sync now reads unprocessed rows via idx_radpostauth_processed;
+        # the 24h window index only added cost to every FreeRADIUS post-auth insert
+        "DROP INDEX IF EXISTS idx_radpostauth_activation",
+    ]),
+    (4, 'Key/value state for the sync scripts (feed cursors, last reconciliation)', [
+        """
+        CREATE TABLE IF NOT EXISTS radtik_sync_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (5, 'Usernames changed in radcheck/radreply, for the in-memory authorize index', [
+        # Append-only (AUTOINCREMENT keeps seq monotonic across trims); API
+        # workers read rows after their cursor and reload those usernames
+        """
+        CREATE TABLE IF NOT EXISTS radtik_authorize_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radcheck_authorize_insert AFTER INSERT ON radcheck
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (NEW.username);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radcheck_authorize_delete AFTER DELETE ON radcheck
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (OLD.username);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radcheck_authorize_update AFTER UPDATE ON radcheck
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (NEW.username);
+            INSERT INTO radtik_authorize_changes (username)
+            SELECT OLD.username WHERE OLD.username != NEW.username;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radreply_authorize_insert AFTER INSERT ON radreply
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (NEW.username);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radreply_authorize_delete AFTER DELETE ON radreply
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (OLD.username);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radreply_authorize_update AFTER UPDATE ON radreply
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (NEW.username);
+            INSERT INTO radtik_authorize_changes (username)
+            SELECT OLD.username WHERE OLD.username != NEW.username;
+        END
+        """,
+    ]),
+    (6, 'Change log of voucher mutations for replication to follower servers', [
+        # seq is the replication cursor: AUTOINCREMENT never reuses a value
+        # after trimming; created_at (unix time) drives retention
+        """
+        CREATE TABLE IF NOT EXISTS radtik_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_radtik_changes_created ON radtik_changes (created_at)",
+    ]),
+    (7, 'Authorize index change tracking for group memberships and group attributes', [
+        # Rate-limit profiles (radius_store.PROFILE_PREFIX) move the rate limit
+        # from radreply to radusergroup + radgroupreply
+        """
+        CREATE TRIGGER IF NOT EXISTS radusergroup_authorize_insert AFTER INSERT ON radusergroup
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (NEW.username);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radusergroup_authorize_delete AFTER DELETE ON radusergroup
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (OLD.username);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radusergroup_authorize_update AFTER UPDATE ON radusergroup
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES (NEW.username);
+            INSERT INTO radtik_authorize_changes (username)
+            SELECT OLD.username WHERE OLD.username != NEW.username;
+        END
+        """,
+        # Group attributes are shared by many users: an empty username tells
+        # the index to reload the (small) group tables
+        """
+        CREATE TRIGGER IF NOT EXISTS radgroupcheck_authorize_insert AFTER INSERT ON radgroupcheck
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES ('');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radgroupcheck_authorize_delete AFTER DELETE ON radgroupcheck
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES ('');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radgroupcheck_authorize_update AFTER UPDATE ON radgroupcheck
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES ('');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radgroupreply_authorize_insert AFTER INSERT ON radgroupreply
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES ('');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radgroupreply_authorize_delete AFTER DELETE ON radgroupreply
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES ('');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radgroupreply_authorize_update AFTER UPDATE ON radgroupreply
+        BEGIN
+            INSERT INTO radtik_authorize_changes (username) VALUES ('');
+        END
+        """,
+    ]),
+    (8, 'Daily usage rollups of closed radacct sessions (per username/NAS and per NAS)', [
+        # Queue of sessions closed since the last rollup (usage_rollup.py
+        # consumes it in id order); only the Stop / Accounting-On update that
+        # sets acctstoptime is recorded, not interim updates
+        """
+        CREATE TABLE IF NOT EXISTS radtik_acct_closed (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            radacctid INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radacct_usage_insert AFTER INSERT ON radacct
+        WHEN NEW.acctstoptime IS NOT NULL
+        BEGIN
+            INSERT INTO radtik_acct_closed (radacctid) VALUES (NEW.radacctid);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS radacct_usage_stop AFTER UPDATE OF acctstoptime ON radacct
+        WHEN OLD.acctstoptime IS NULL AND NEW.acctstoptime IS NOT NULL
+        BEGIN
+            INSERT INTO radtik_acct_closed (radacctid) VALUES (NEW.radacctid);
+        END
+        """,
+        # seq is the export cursor: every insert or update of a rollup row
+        # gets the next value of the 'usage.seq' state counter
+        """
+        CREATE TABLE IF NOT EXISTS radtik_usage_daily (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            day TEXT NOT NULL,
+            username TEXT NOT NULL,
+            nasipaddress TEXT NOT NULL,
+            sessions INTEGER NOT NULL DEFAULT 0,
+            session_time INTEGER NOT NULL DEFAULT 0,
+            input_octets INTEGER NOT NULL DEFAULT 0,
+            output_octets INTEGER NOT NULL DEFAULT 0,
+            seq INTEGER NOT NULL,
+            UNIQUE (day, username, nasipaddress)
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_radtik_usage_daily_seq ON radtik_usage_daily (seq)",
+        """
+        CREATE TABLE IF NOT EXISTS radtik_usage_nas_daily (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            day TEXT NOT NULL,
+            nasipaddress TEXT NOT NULL,
+            users INTEGER NOT NULL DEFAULT 0,
+            sessions INTEGER NOT NULL DEFAULT 0,
+            session_time INTEGER NOT NULL DEFAULT 0,
+            input_octets INTEGER NOT NULL DEFAULT 0,
+            output_octets INTEGER NOT NULL DEFAULT 0,
+            seq INTEGER NOT NULL,
+            UNIQUE (day, nasipaddress)
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_radtik_usage_nas_daily_seq ON radtik_usage_nas_daily (seq)",
+        # Sessions closed before this migration are rolled up by the first runs
+        """
+        INSERT INTO radtik_acct_closed (radacctid)
+        SELECT radacctid FROM radacct WHERE acctstoptime IS NOT NULL ORDER BY radacctid
+        """,
+    ]),
+]
+
+SCHEMA_VERSION = max(version for version, _, _ in MIGRATIONS)
+
+# (name, query, expected fragment of EXPLAIN QUERY PLAN output)
+HOT_QUERIES = [
+    (
+        'voucher existence check',
+        "SELECT COUNT(*) FROM radcheck WHERE username = 'x' AND attribute = 'Cleartext-Password'",
+        'COVERING INDEX idx_radcheck_username_attribute'
+    ),
+    (
+        'MAC binding lookup',
+        "SELECT id, value FROM radcheck WHERE username = 'x' AND attribute = 'Calling-Station-Id'",
+        'COVERING INDEX idx_radcheck_username_attribute'
+    ),
+    (
+        'Auth-Type reject check',
+        "SELECT COUNT(*) FROM radcheck WHERE username = 'x' AND attribute = 'Auth-Type' AND value = 'Reject'",
+        'COVERING INDEX idx_radcheck_username_attribute'
+    ),
+    (
+        'cleanup keyset page of usernames',
+        """SELECT DISTINCT username FROM radcheck
+           WHERE attribute = 'Cleartext-Password' AND username > 'x'
+           ORDER BY username LIMIT 5000""",
+        'COVERING INDEX idx_radcheck_username_attribute'
+    ),
+    (
+        'replication snapshot page of usernames',
+        "SELECT DISTINCT username FROM radcheck WHERE username > 'x' ORDER BY username LIMIT 5000",
+        'COVERING INDEX'
+    ),
+    (
+        'replication change log trim',
+        "SELECT seq FROM radtik_changes WHERE created_at < 0 ORDER BY created_at DESC, seq DESC LIMIT 1",
+        'INDEX idx_radtik_changes_created'
+    ),
+    (
+        'FreeRADIUS authorize check',
+        "SELECT id, username, attribute, value, op FROM radcheck WHERE username = 'x' ORDER BY id",
+        'INDEX'
+    ),
+    (
+        'FreeRADIUS authorize reply',
+        "SELECT id, username, attribute, value, op FROM radreply WHERE username = 'x' ORDER BY id",
+        'INDEX reply_username'
+    ),
+    (
+        'FreeRADIUS group membership',
+        "SELECT groupname FROM radusergroup WHERE username = 'x' ORDER BY priority",
+        'INDEX usergroup_username'
+    ),
+    (
+        'FreeRADIUS group reply',
+        "SELECT id, groupname, attribute, value, op FROM radgroupreply WHERE groupname = 'x' ORDER BY id",
+        'INDEX reply_groupname'
+    ),
+    (
+        'rate-limit profile conversion page',
+        """SELECT DISTINCT username FROM radreply
+           WHERE attribute = 'Mikrotik-Rate-Limit' AND op = ':=' AND username > 'x'
+           ORDER BY username LIMIT 5000""",
+        'INDEX reply_username'
+    ),
+    (
+        'usage rollup queue page',
+        """SELECT q.seq, a.username, a.nasipaddress, a.acctstoptime, a.acctsessiontime,
+                  a.acctinputoctets, a.acctoutputoctets
+           FROM radtik_acct_closed q LEFT JOIN radacct a ON a.radacctid = q.radacctid
+           ORDER BY q.seq LIMIT 5000""",
+        'USING INTEGER PRIMARY KEY'
+    ),
+    (
+        'usage export page',
+        "SELECT * FROM radtik_usage_daily WHERE seq > 0 ORDER BY seq LIMIT 1000",
+        'INDEX idx_radtik_usage_daily_seq'
+    ),
+    (
+        'activation sync unprocessed rows',
+        """SELECT id, reply, username, nas_identifier, calling_station_id, authdate
+           FROM radpostauth
+           WHERE processed = 0 AND authdate > '2000-01-01 00:00:00'
+           ORDER BY authdate, id LIMIT 1000""",
+        'INDEX idx_radpostauth_processed'
+    ),
+]
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    """Return the applied schema version"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    """
+    Apply all pending migrations
+
+    Returns:
+        Number of migrations applied
+    """
+    applied = 0
+    previous = conn.isolation_level
+    conn.isolation_level = None
+
+    try:
+        for version, description, statements in MIGRATIONS:
+            if version <= get_version(conn):
+                continue
+
+            logger.info(f"Applying migration {version}: {description}")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Re-check under the write lock in case another process migrated
+                if version <= get_version(conn):
+                    conn.execute("ROLLBACK")
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+            applied += 1
+
+        if applied:
+            # Refresh planner statistics for the new indexes (sampled, so
+            # this stays cheap on large live databases)
+            conn.execute("PRAGMA analysis_limit=1000")
+            conn.execute("ANALYZE")
+    finally:
+        conn.isolation_level = previous
+
+    return applied
+
+
+def check_query_plans(conn: sqlite3.Connection) -> List[str]:
+    """
+    Verify hot queries use the expected indexes
+
+    Returns:
+        List of failure messages (empty if all plans are as expected)
+    """
+    failures = []
+
+    for name, query, expected in HOT_QUERIES:
+        plan = ' | '.join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}"))
+        if expected not in plan:
+            failures.append(f"{name}: expected '{expected}', got '{plan}'")
+        else:
+            logger.info(f"  ✓ {name}: {plan}")
+
+    return failures
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Apply RadTik RADIUS schema migrations')
+    parser.add_argument('--db', help='Path to radius.db (default: [radius] db_path from config.ini)')
+    parser.add_argument('--status', action='store_true', help='Show schema version and exit')
+    parser.add_argument('--check', action='store_true', help='Only verify query plans')
+    args = parser.parse_args()
+
+    db_path = args.db
+    if not db_path:
+        config = configparser.ConfigParser()
+        config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'))
+        db_path = config.get('radius', 'db_path', fallback='/etc/freeradius/3.0/sqlite/radius.db')
+
+    if not os.path.exists(db_path):
+        logger.error(f"RADIUS database not found: {db_path}")
+        sys.exit(1)
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA busy_timeout=30000")
+
+    try:
+        current = get_version(conn)
+
+        if args.status:
+            logger.info(f"Schema version: {current} (latest: {SCHEMA_VERSION})")
+            return
+
+        if not args.check:
+            applied = apply_migrations(conn)
+            logger.info(f"Applied {applied} migration(s), schema version now {get_version(conn)}")
+
+        logger.info("Verifying query plans...")
+        failures = check_query_plans(conn)
+        if failures:
+            for failure in failures:
+                logger.error(f"  ✗ {failure}")
+            sys.exit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+RadTik Post-Auth Archive
+Retention for FreeRADIUS's radpostauth table, which gets one row per
+authentication attempt and was only ever trimmed by voucher deletes.
+
+Rows older than `retention_hours` are moved out of radius.db into a
+separate SQLite database (not radius.db), so the hot table - read by the
+activation sync and written by every Access-Request - stays about one
+retention window in size:
+
+- mode = archive: the rows are copied (without the `pass` column) and
+  kept for `archive_retention_days`
+- mode = summary: only per day / username / NAS / reply counts are kept
+- daily summaries are written in both modes and kept for
+  `summary_retention_days`
+
+Rows are moved in id order (radpostauth is append-only, so that is also
+authdate order) in slices: each slice is committed to the archive first,
+together with the highest archived id, and then deleted from radpostauth
+with one `DELETE ... WHERE id <= ?`. The slice size adapts so the delete
+holds radius.db's write lock for at most `slice_budget_ms`, with a pause
+in between for FreeRADIUS's own inserts. A run that is interrupted between
+the two commits finishes the delete on the next run without archiving the
+rows twice.
+"""
+
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from db_pool import ConnectionPool
+
+logger = logging.getLogger('postauth-archive')
+
+MODES = ('archive', 'summary')
+
+# radpostauth columns that are archived (pass is never copied)
+COLUMNS = ('id', 'username', 'reply', 'authdate', 'class', 'calling_station_id', 'nas_identifier')
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS radpostauth_archive (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL,
+        reply TEXT NOT NULL,
+        authdate TEXT NOT NULL,
+        class TEXT,
+        calling_station_id TEXT,
+        nas_identifier TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_radpostauth_archive_username ON radpostauth_archive(username, id)",
+    "CREATE INDEX IF NOT EXISTS idx_radpostauth_archive_authdate ON radpostauth_archive(authdate)",
+    """
+    CREATE TABLE IF NOT EXISTS radpostauth_daily (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        day TEXT NOT NULL,
+        username TEXT NOT NULL,
+        nas_identifier TEXT NOT NULL,
+        reply TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        first_at TEXT NOT NULL,
+        last_at TEXT NOT NULL,
+        UNIQUE (day, username, nas_identifier, reply)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_radpostauth_daily_username ON radpostauth_daily(username, day)",
+    """
+    CREATE TABLE IF NOT EXISTS radpostauth_archive_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        archived_id INTEGER NOT NULL DEFAULT 0,
+        archived_rows INTEGER NOT NULL DEFAULT 0,
+        last_run_at TEXT,
+        last_run_rows INTEGER NOT NULL DEFAULT 0,
+        last_run_seconds REAL NOT NULL DEFAULT 0
+    )
+    """,
+    "INSERT OR IGNORE INTO radpostauth_archive_state (id) VALUES (1)",
+]
+
+
+def _timestamp(when: datetime) -> str:
+    """radpostauth.authdate format (local time, as FreeRADIUS writes it)"""
+    return when.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class PostauthArchive:
+    """Moves old radpostauth rows to the archive database and answers archive queries"""
+
+    def __init__(self, db_path: str, mode: str = 'archive', retention_hours: float = 168.0,
+                 archive_retention_days: float = 90.0, summary_retention_days: float = 730.0,
+                 slice_size: int = 5000, slice_budget_ms: float = 25.0, slice_pause_ms: float = 10.0,
+                 max_run_seconds: float = 240.0):
+        if mode not in MODES:
+            raise ValueError(f"Invalid archive mode '{mode}'. Must be one of: {', '.join(MODES)}")
+
+        self.db_path = db_path
+        self.mode = mode
+        self.retention_hours = retention_hours
+        self.archive_retention_days = archive_retention_days
+        self.summary_retention_days = summary_retention_days
+        self.max_slice_size = max(1, slice_size)
+        self.slice_budget = slice_budget_ms / 1000.0
+        self.slice_pause = slice_pause_ms / 1000.0
+        self.max_run_seconds = max_run_seconds
+        self.pool = ConnectionPool(db_path, size=1)
+
+        with self.pool.connection() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+
+    def archived_id(self) -> int:
+        """Highest radpostauth id that has been archived"""
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT archived_id FROM radpostauth_archive_state WHERE id = 1").fetchone()[0]
+
+    def _store(self, rows: List) -> None:
+        """Archive / summarize a slice of radpostauth rows and advance the watermark in one transaction"""
+        daily: Dict[tuple, list] = {}
+        for row in rows:
+            _, username, reply, authdate, _, _, nas_identifier = row
+            key = (authdate[:10], username, nas_identifier or '', reply)
+            summary = daily.get(key)
+            if summary is None:
+                daily[key] = [1, authdate, authdate]
+            else:
+                summary[0] += 1
+                summary[1] = min(summary[1], authdate)
+                summary[2] = max(summary[2], authdate)
+
+        with self.pool.connection() as conn:
+            try:
+                if self.mode == 'archive':
+                    # OR IGNORE: rows of an interrupted run may already be here
+                    conn.executemany(
+                        f"INSERT OR IGNORE INTO radpostauth_archive ({', '.join(COLUMNS)}) "
+                        f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                        rows
+                    )
+                conn.executemany("""
+                    INSERT INTO radpostauth_daily (day, username, nas_identifier, reply, attempts, first_at, last_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (day, username, nas_identifier, reply) DO UPDATE SET
+                        attempts = attempts + excluded.attempts,
+                        first_at = MIN(first_at, excluded.first_at),
+                        last_at = MAX(last_at, excluded.last_at)
+                """, [(*key, *summary) for key, summary in daily.items()])
+                conn.execute(
+                    "UPDATE radpostauth_archive_state SET archived_id = ?, archived_rows = archived_rows + ? WHERE id = 1",
+                    (rows[-1][0], len(rows))
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    @staticmethod
+    def _delete_archived(radius_conn, archived_id: int) -> int:
+        """Delete archived rows from radpostauth (one short write transaction)"""
+        radius_conn.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = radius_conn.execute("DELETE FROM radpostauth WHERE id <= ?", (archived_id,)).rowcount
+            radius_conn.commit()
+        except Exception:
+            radius_conn.rollback()
+            raise
+        return deleted
+
+    def rotate(self, radius_pool, now: Optional[datetime] = None) -> Dict:
+        """
+        Move radpostauth rows older than the retention window to the archive
+
+        Stops after max_run_seconds; the next run continues where it stopped.
+
+        Args:
+            radius_pool: Connection pool of radius.db
+            now: Current time (for tests)
+
+        Returns:
+            Dictionary with 'archived', 'deleted', 'slices', 'cutoff' and
+            'complete' (False if the run stopped before reaching the cutoff)
+        """
+        now = now or datetime.now()
+        cutoff = _timestamp(now - timedelta(hours=self.retention_hours))
+        started = time.monotonic()
+        archived_id = self.archived_id()
+        slice_size = self.max_slice_size
+        result = {'archived': 0, 'deleted': 0, 'slices': 0, 'cutoff': cutoff, 'complete': True}
+
+        with radius_pool.connection() as radius_conn:
+            # Rows archived by an interrupted run but still in radpostauth
+            result['deleted'] += self._delete_archived(radius_conn, archived_id)
+
+            while True:
+                if time.monotonic() - started > self.max_run_seconds:
+                    result['complete'] = False
+                    break
+
+                rows = radius_conn.execute(
+                    f"SELECT {', '.join(COLUMNS)} FROM radpostauth WHERE id > ? ORDER BY id LIMIT ?",
+                    (archived_id, slice_size)
+                ).fetchall()
+
+                # Oldest rows first; stop at the first row inside the retention window
+                expired = []
+                for row in rows:
+                    if str(row[3]) >= cutoff:
+                        break
+                    expired.append(tuple(row))
+
+                if not expired:
+                    break
+
+                self._store(expired)
+                archived_id = expired[-1][0]
+                result['archived'] += len(expired)
+
+                delete_started = time.monotonic()
+                result['deleted'] += self._delete_archived(radius_conn, archived_id)
+                elapsed = time.monotonic() - delete_started
+                result['slices'] += 1
+
+                # Halve the slice when the delete held the lock too long, grow it back when cheap
+                if elapsed > self.slice_budget and slice_size > 1:
+                    slice_size = max(1, slice_size // 2)
+                elif elapsed < self.slice_budget / 2:
+                    slice_size = min(self.max_slice_size, slice_size * 2)
+
+                if len(expired) < len(rows):
+                    break
+                time.sleep(self.slice_pause)
+
+        with self.pool.connection() as conn:
+            conn.execute(
+                "UPDATE radpostauth_archive_state SET last_run_at = ?, last_run_rows = ?, last_run_seconds = ? "
+                "WHERE id = 1",
+                (now.isoformat(), result['archived'], round(time.monotonic() - started, 3))
+            )
+            conn.commit()
+
+        return result
+
+    def prune(self, now: Optional[datetime] = None) -> Dict:
+        """
+        Delete archived rows and daily summaries past their retention
+
+        Returns:
+            Rows deleted per table
+        """
+        now = now or datetime.now()
+        result = {'radpostauth_archive': 0, 'radpostauth_daily': 0}
+
+        with self.pool.connection() as conn:
+            if self.archive_retention_days > 0:
+                row = conn.execute(
+                    "SELECT id FROM radpostauth_archive WHERE authdate < ? ORDER BY authdate DESC LIMIT 1",
+                    (_timestamp(now - timedelta(days=self.archive_retention_days)),)
+                ).fetchone()
+                if row is not None:
+                    result['radpostauth_archive'] = conn.execute(
+                        "DELETE FROM radpostauth_archive WHERE id <= ?", (row[0],)
+                    ).rowcount
+            if self.summary_retention_days > 0:
+                result['radpostauth_daily'] = conn.execute(
+                    "DELETE FROM radpostauth_daily WHERE day < ?",
+                    ((now - timedelta(days=self.summary_retention_days)).strftime('%Y-%m-%d'),)
+                ).rowcount
+            conn.commit()
+
+        return result
+
+    def query_rows(self, username: Optional[str] = None, since: Optional[str] = None,
+                   until: Optional[str] = None, reply: Optional[str] = None,
+                   after: int = 0, limit: int = 1000) -> Dict:
+        """
+        Keyset page of archived authentication attempts, in id order
+
+        Args:
+            username: Only this username
+            since: authdate >= since ('YYYY-MM-DD[ HH:MM:SS]')
+            until: authdate < until
+            reply: Only this reply (e.g. 'Access-Reject')
+            after: Last id of the previous page
+            limit: Maximum rows
+
+        Returns:
+            Dictionary with 'rows', 'cursor' (last id, pass back as after)
+            and 'has_more'
+        """
+        conditions = ['id > ?']
+        params: List = [after]
+
+        with self.pool.connection() as conn:
+            if since:
+                # Start at the first id in range instead of filtering older rows
+                first = conn.execute(
+                    "SELECT id FROM radpostauth_archive WHERE authdate >= ? ORDER BY authdate LIMIT 1", (since,)
+                ).fetchone()
+                if first is None:
+                    return {'rows': [], 'cursor': after, 'has_more': False}
+                conditions.append('id >= ?')
+                params.append(first[0])
+                conditions.append('authdate >= ?')
+                params.append(since)
+            for column, value in (('username', username), ('reply', reply)):
+                if value:
+                    conditions.append(f'{column} = ?')
+                    params.append(value)
+            if until:
+                conditions.append('authdate < ?')
+                params.append(until)
+
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM radpostauth_archive WHERE {' AND '.join(conditions)} "
+                f"ORDER BY id LIMIT ?",
+                (*params, limit + 1)
+            ).fetchall()
+
+        has_more = len(rows) > limit
+        rows = [dict(zip(COLUMNS, row)) for row in rows[:limit]]
+
+        return {'rows': rows, 'cursor': rows[-1]['id'] if rows else after, 'has_more': has_more}
+
+    def query_daily(self, username: Optional[str] = None, nas_identifier: Optional[str] = None,
+                    since: Optional[str] = None, until: Optional[str] = None,
+                    after: int = 0, limit: int = 1000) -> Dict:
+        """
+        Keyset page of daily summaries (day, username, nas_identifier, reply,
+        attempts, first_at, last_at)
+
+        Args:
+            username: Only this username
+            nas_identifier: Only this NAS
+            since: day >= since ('YYYY-MM-DD')
+            until: day < until
+            after: Last id of the previous page
+            limit: Maximum rows
+
+        Returns:
+            Dictionary with 'rows', 'cursor' and 'has_more'
+        """
+        columns = ('id', 'day', 'username', 'nas_identifier', 'reply', 'attempts', 'first_at', 'last_at')
+        conditions = ['id > ?']
+        params: List = [after]
+
+        for condition, value in (('username = ?', username), ('nas_identifier = ?', nas_identifier),
+                                 ('day >= ?', since), ('day < ?', until)):
+            if value:
+                conditions.append(condition)
+                params.append(value)
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(columns)} FROM radpostauth_daily WHERE {' AND '.join(conditions)} "
+                f"ORDER BY id LIMIT ?",
+                (*params, limit + 1)
+            ).fetchall()
+
+        has_more = len(rows) > limit
+        rows = [dict(zip(columns, row)) for row in rows[:limit]]
+
+        return {'rows': rows, 'cursor': rows[-1]['id'] if rows else after, 'has_more': has_more}
+
+    def stats(self) -> Dict:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT archived_id, archived_rows, last_run_at, last_run_rows, last_run_seconds "
+                "FROM radpostauth_archive_state WHERE id = 1"
+            ).fetchone()
+
+        return {
+            'mode': self.mode,
+            'retention_hours': self.retention_hours,
+            'archived_id': row[0],
+            'archived_rows': row[1],
+            'last_run_at': row[2],
+            'last_run_rows': row[3],
+            'last_run_seconds': row[4],
+        }
+
+    def close(self):
+        self.pool.close()
+
+
+def archive_from_config(config) -> PostauthArchive:
+    """Build the archive from the [archive] section of config.ini"""
+    retention_hours = config.getfloat('archive', 'retention_hours', fallback=168)
+    activation_window = config.getfloat('sync', 'activation_window_hours', fallback=24)
+
+    # Rows the activation sync may still have to read stay in radpostauth
+    if retention_hours < activation_window:
+        logger.warning(f"[archive] retention_hours {retention_hours:g} is shorter than "
+                       f"[sync] activation_window_hours, using {activation_window:g}")
+        retention_hours = activation_window
+
+    return PostauthArchive(
+        config.get('archive', 'db_path', fallback='/var/lib/radtik-radius/postauth-archive.db'),
+        mode=config.get('archive', 'mode', fallback='archive').strip().lower(),
+        retention_hours=retention_hours,
+        archive_retention_days=config.getfloat('archive', 'archive_retention_days', fallback=90),
+        summary_retention_days=config.getfloat('archive', 'summary_retention_days', fallback=730),
+        slice_size=config.getint('archive', 'slice_size', fallback=5000),
+        slice_budget_ms=config.getfloat('archive', 'slice_budget_ms', fallback=25),
+        slice_pause_ms=config.getfloat('archive', 'slice_pause_ms', fallback=10),
+        max_run_seconds=config.getfloat('archive', 'max_run_seconds', fallback=240)
+    )
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+RadTik RADIUS Statistics
+Cheap voucher/record counters for GET /stats.
+
+Counters live in the radius_stats and radius_nas_stats summary tables
+(migration 2) and are kept up to date by triggers on radcheck/radreply, so
+every writer - the API, the cron scripts or a manual sqlite3 session - is
+accounted for and reading them is O(1). Results are cached for a few seconds
+per worker so dashboard polling does not touch the database at all.
+
+On a database that has not been migrated yet the counters are computed with
+full scans, as before.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger('radius-stats')
+
+
+def _read_counters(conn: sqlite3.Connection) -> Optional[Dict]:
+    """Read the trigger-maintained counters, or None if they do not exist"""
+    try:
+        row = conn.execute(
+            "SELECT vouchers, disabled_vouchers, mac_bindings, radcheck_records, radreply_records "
+            "FROM radius_stats WHERE id = 1"
+        ).fetchone()
+        if row is None:
+            return None
+        nas = conn.execute(
+            "SELECT nas_identifier, vouchers FROM radius_nas_stats ORDER BY nas_identifier"
+        ).fetchall()
+    except sqlite3.OperationalError as e:
+        if 'no such table' in str(e):
+            return None
+        raise
+
+    return {
+        'total_users': row[0],
+        'disabled_vouchers': row[1],
+        'mac_bindings': row[2],
+        'radcheck_records': row[3],
+        'radreply_records': row[4],
+        'nas': {name: count for name, count in nas},
+        'source': 'counters',
+    }
+
+
+def _scan_counters(conn: sqlite3.Connection) -> Dict:
+    """Compute the same counters with full scans (un-migrated database)"""
+    cursor = conn.cursor()
+
+    cursor.execute("""
+        SELECT
+            COALESCE(SUM(attribute = 'Cleartext-Password'), 0),
+            COALESCE(SUM(attribute = 'Auth-Type' AND value = 'Reject'), 0),
+            COALESCE(SUM(attribute = 'Calling-Station-Id'), 0),
+            COUNT(*)
+        FROM radcheck
+    """)
+    vouchers, disabled, mac_bindings, radcheck_records = cursor.fetchone()
+
+    cursor.execute("SELECT COUNT(*) FROM radreply")
+    radreply_records = cursor.fetchone()[0]
+
+    cursor.execute(
+        "SELECT value, COUNT(*) FROM radcheck WHERE attribute = 'NAS-Identifier' GROUP BY value ORDER BY value"
+    )
+    nas = {name: count for name, count in cursor.fetchall()}
+
+    return {
+        'total_users': vouchers,
+        'disabled_vouchers': disabled,
+        'mac_bindings': mac_bindings,
+        'radcheck_records': radcheck_records,
+        'radreply_records': radreply_records,
+        'nas': nas,
+        'source': 'scan',
+    }
+
+
+def read_stats(conn: sqlite3.Connection) -> Dict:
+    """
+    Read RADIUS statistics
+
+    Returns:
+        Dictionary with voucher/record counts, per-NAS voucher counts ('nas')
+        and 'source' ('counters' or 'scan')
+    """
+    stats = _read_counters(conn)
+    if stats is None:
+        logger.warning("Stats counters missing (run migrate.py), falling back to full scans")
+        stats = _scan_counters(conn)
+    return stats
+
+
+class StatsCache:
+    """Per-process TTL cache in front of read_stats()"""
+
+    def __init__(self, pool, ttl: float = 5.0):
+        self.pool = pool
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = None
+        self._expires = 0.0
+
+    def get(self) -> Dict:
+        """Return cached statistics, refreshing them once the TTL expired"""
+        with self._lock:
+            if self._stats is None or time.monotonic() >= self._expires:
+                with self.pool.connection() as conn:
+                    stats = read_stats(conn)
+                stats['generated_at'] = datetime.now().isoformat()
+                self._stats = stats
+                self._expires = time.monotonic() + self.ttl
+            return dict(self._stats)
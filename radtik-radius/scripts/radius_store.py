@@ -0,0 +1,934 @@
+#!/usr/bin/env python3
+"""
+RadTik RADIUS Store
+Set-based write operations against the FreeRADIUS SQLite tables.
+
+Functions in this module never commit - the caller owns the transaction, so
+several operations can share a single commit. A returned dict containing
+'database_error' tells the caller to roll the operation back.
+"""
+
+import hashlib
+import logging
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('radius-store')
+
+# Fields every voucher in a sync payload must carry
+VOUCHER_FIELDS = ['username', 'password', 'mikrotik_rate_limit', 'nas_identifier']
+
+# Operations accepted by apply_mutations()
+MUTATION_OPS = ('create', 'delete', 'enable', 'disable', 'rebind_mac')
+
+# Tables cleared by delete_vouchers() (all indexed on username)
+VOUCHER_TABLES = ('radcheck', 'radreply', 'radusergroup', 'radpostauth', 'radacct')
+
+# Rate-limit profiles: radtik_sync_state key holding the mode ('1' = on),
+# prefix of the profile group names and radusergroup priority of the
+# membership (0, so groups added by hand are still applied after it)
+PROFILE_MODE_KEY = 'rate_limit.profiles'
+PROFILE_PREFIX = 'radtik-rl-'
+PROFILE_PRIORITY = 0
+
+
+def _ensure_voucher_stage(cursor: sqlite3.Cursor):
+    """Create (or empty) the per-connection staging table for voucher batches"""
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS voucher_stage (
+            pos INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            rate_limit TEXT NOT NULL,
+            nas_identifier TEXT NOT NULL,
+            profile TEXT NOT NULL DEFAULT ''
+        )
+    """)
+    cursor.execute("DELETE FROM voucher_stage")
+
+
+def _ensure_mutation_stage(cursor: sqlite3.Cursor):
+    """Create (or empty) the per-connection staging table for mixed mutations"""
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS mutation_stage (
+            pos INTEGER PRIMARY KEY,
+            op TEXT NOT NULL,
+            username TEXT NOT NULL,
+            value TEXT NOT NULL DEFAULT ''
+        )
+    """)
+    cursor.execute("DELETE FROM mutation_stage")
+
+
+def _ensure_mac_stage(cursor: sqlite3.Cursor):
+    """Create (or empty) the per-connection staging table for MAC bindings"""
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS mac_stage (
+            username TEXT PRIMARY KEY,
+            mac_address TEXT NOT NULL
+        )
+    """)
+    cursor.execute("DELETE FROM mac_stage")
+
+
+def _ensure_delete_stage(cursor: sqlite3.Cursor):
+    """Create (or empty) the per-connection staging table for bulk deletes"""
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS delete_stage (
+            username TEXT PRIMARY KEY
+        )
+    """)
+    cursor.execute("DELETE FROM delete_stage")
+
+
+def _ensure_profile_stage(cursor: sqlite3.Cursor):
+    """Create (or empty) the per-connection staging table for profile conversion"""
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS profile_stage (
+            username TEXT NOT NULL,
+            profile TEXT NOT NULL,
+            rate_limit TEXT NOT NULL
+        )
+    """)
+    cursor.execute("DELETE FROM profile_stage")
+
+
+def profile_name(rate_limit: str) -> str:
+    """
+    Group name of the rate-limit profile for a Mikrotik-Rate-Limit value
+
+    Derived from the value itself, so every server (and every run of the
+    conversion) maps the same rate limit to the same group.
+    """
+    return PROFILE_PREFIX + hashlib.sha1(rate_limit.encode('utf-8')).hexdigest()[:12]
+
+
+def profiles_enabled(conn: sqlite3.Connection) -> bool:
+    """Whether new vouchers get a rate-limit profile instead of a radreply row"""
+    return get_state(conn, PROFILE_MODE_KEY, '0') == '1'
+
+
+def validate_voucher(voucher) -> str:
+    """
+    Validate a single voucher payload entry
+
+    Returns:
+        Error message, or empty string if the voucher is valid
+    """
+    if not isinstance(voucher, dict):
+        return "Voucher must be an object"
+
+    missing_fields = [field for field in VOUCHER_FIELDS if field not in voucher]
+    if missing_fields:
+        return f"Missing required fields: {', '.join(missing_fields)}"
+
+    for field in VOUCHER_FIELDS:
+        value = voucher[field]
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            return f"Invalid value for {field}"
+
+    return ''
+
+
+def _insert_profiles(cursor: sqlite3.Cursor, stage: str):
+    """Add the radgroupreply row of every staged profile that does not exist yet"""
+    cursor.execute(f"""
+        INSERT INTO radgroupreply (groupname, attribute, op, value)
+        SELECT profile, 'Mikrotik-Rate-Limit', ':=', MIN(rate_limit)
+        FROM {stage} s
+        WHERE NOT EXISTS (SELECT 1 FROM radgroupreply g WHERE g.groupname = s.profile)
+        GROUP BY profile
+        ORDER BY profile
+    """)
+
+
+def insert_vouchers(conn: sqlite3.Connection, vouchers: List) -> Dict:
+    """
+    Insert a batch of vouchers into radcheck/radreply using set-based SQL
+
+    The whole payload is validated first, valid entries are staged in a
+    temporary table, existing usernames are found with a single join and the
+    remaining vouchers are written with one INSERT ... SELECT per row type.
+
+    With rate-limit profiles enabled (profiles_enabled()) the rate limit is
+    not written to radreply: each distinct value is stored once in
+    radgroupreply and the voucher joins that group through radusergroup.
+
+    Args:
+        conn: Open database connection (not committed here)
+        vouchers: List of voucher dicts from the sync payload
+
+    Returns:
+        Dictionary with 'synced', 'failed', 'errors' and 'inserted' (list of
+        usernames written), errors in payload order
+    """
+    # Per-position error message; positions without an entry were synced
+    position_errors = {}
+    staged = []
+    seen = set()
+    profiles = bool(vouchers) and profiles_enabled(conn)
+
+    # Step 1: Validate the whole payload up front
+    for pos, voucher in enumerate(vouchers):
+        error = validate_voucher(voucher)
+        if error:
+            username = voucher.get('username', 'unknown') if isinstance(voucher, dict) else 'unknown'
+            position_errors[pos] = f"{username}: {error}"
+            continue
+
+        username = str(voucher['username'])
+
+        # Later duplicates inside the same payload behave as already existing
+        if username in seen:
+            position_errors[pos] = f"{username}: Already exists"
+            continue
+        seen.add(username)
+
+        rate_limit = str(voucher['mikrotik_rate_limit'])
+        staged.append((
+            pos,
+            username,
+            str(voucher['password']),
+            rate_limit,
+            str(voucher['nas_identifier']),
+            profile_name(rate_limit) if profiles else ''
+        ))
+
+    inserted = []
+
+    if staged:
+        cursor = conn.cursor()
+
+        # Step 2: Stage valid vouchers
+        _ensure_voucher_stage(cursor)
+        cursor.executemany(
+            "INSERT INTO voucher_stage (pos, username, password, rate_limit, nas_identifier, profile) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            staged
+        )
+
+        # Step 3: Find existing usernames with a single query
+        cursor.execute("""
+            SELECT s.pos, s.username
+            FROM voucher_stage s
+            WHERE EXISTS (
+                SELECT 1 FROM radcheck r
+                WHERE r.username = s.username
+                  AND r.attribute = 'Cleartext-Password'
+            )
+        """)
+        existing = cursor.fetchall()
+
+        if existing:
+            for pos, username in existing:
+                position_errors[pos] = f"{username}: Already exists"
+            cursor.executemany(
+                "DELETE FROM voucher_stage WHERE pos = ?",
+                [(pos,) for pos, _ in existing]
+            )
+
+        # Step 4: Write radcheck (password + NAS binding) and the rate limit
+        try:
+            cursor.execute("""
+                INSERT INTO radcheck (username, attribute, op, value)
+                SELECT username, 'Cleartext-Password', ':=', password
+                FROM voucher_stage ORDER BY pos
+            """)
+            cursor.execute("""
+                INSERT INTO radcheck (username, attribute, op, value)
+                SELECT username, 'NAS-Identifier', '==', nas_identifier
+                FROM voucher_stage ORDER BY pos
+            """)
+            if profiles:
+                _insert_profiles(cursor, 'voucher_stage')
+                cursor.execute("""
+                    INSERT INTO radusergroup (username, groupname, priority)
+                    SELECT username, profile, ?
+                    FROM voucher_stage ORDER BY pos
+                """, (PROFILE_PRIORITY,))
+            else:
+                cursor.execute("""
+                    INSERT INTO radreply (username, attribute, op, value)
+                    SELECT username, 'Mikrotik-Rate-Limit', ':=', rate_limit
+                    FROM voucher_stage ORDER BY pos
+                """)
+            cursor.execute("SELECT username FROM voucher_stage ORDER BY pos")
+            inserted = [row[0] for row in cursor.fetchall()]
+
+        except sqlite3.Error as e:
+            # The batch shares one statement per row type, so it fails as a unit.
+            # The caller must roll back to discard any partially written rows.
+            cursor.execute("SELECT pos, username FROM voucher_stage")
+            for pos, username in cursor.fetchall():
+                position_errors[pos] = f"{username}: Database error - {str(e)}"
+            cursor.execute("DELETE FROM voucher_stage")
+
+            return {
+                'synced': 0,
+                'failed': len(position_errors),
+                'errors': [position_errors[pos] for pos in sorted(position_errors)],
+                'inserted': [],
+                'database_error': str(e)
+            }
+
+        cursor.execute("DELETE FROM voucher_stage")
+
+    return {
+        'synced': len(inserted),
+        'failed': len(position_errors),
+        'errors': [position_errors[pos] for pos in sorted(position_errors)],
+        'inserted': inserted
+    }
+
+
+def delete_voucher(conn: sqlite3.Connection, username: str) -> Dict:
+    """
+    Delete all RADIUS rows for a single voucher
+
+    Returns:
+        Dictionary with deleted row counts per table
+    """
+    cursor = conn.cursor()
+
+    cursor.execute("DELETE FROM radcheck WHERE username = ?", (username,))
+    radcheck_deleted = cursor.rowcount
+
+    cursor.execute("DELETE FROM radreply WHERE username = ?", (username,))
+    radreply_deleted = cursor.rowcount
+
+    cursor.execute("DELETE FROM radusergroup WHERE username = ?", (username,))
+    radusergroup_deleted = cursor.rowcount
+
+    cursor.execute("DELETE FROM radpostauth WHERE username = ?", (username,))
+    radpostauth_deleted = cursor.rowcount
+
+    return {
+        'radcheck': radcheck_deleted,
+        'radreply': radreply_deleted,
+        'radusergroup': radusergroup_deleted,
+        'radpostauth': radpostauth_deleted
+    }
+
+
+def delete_vouchers(conn: sqlite3.Connection, usernames: List[str], tables=VOUCHER_TABLES) -> Dict:
+    """
+    Delete all RADIUS rows of many vouchers with one statement per table
+
+    Usernames are staged in a temporary table and every table is cleared
+    with a single DELETE ... WHERE username IN (SELECT ...) that uses its
+    username index. Callers that delete large sets should pass slices and
+    commit between them so the write lock is released regularly.
+
+    Args:
+        conn: Open database connection (not committed here)
+        usernames: Usernames to delete
+        tables: Tables to clear (default: radcheck, radreply, radusergroup,
+                radpostauth, radacct)
+
+    Returns:
+        Dictionary with 'vouchers' (usernames that had radcheck, radreply or
+        radusergroup rows) and the number of rows deleted per table
+    """
+    cursor = conn.cursor()
+    _ensure_delete_stage(cursor)
+    cursor.executemany(
+        "INSERT OR IGNORE INTO delete_stage (username) VALUES (?)",
+        [(str(username),) for username in usernames]
+    )
+
+    cursor.execute("""
+        SELECT COUNT(*) FROM delete_stage s
+        WHERE EXISTS (SELECT 1 FROM radcheck r WHERE r.username = s.username)
+           OR EXISTS (SELECT 1 FROM radreply r WHERE r.username = s.username)
+           OR EXISTS (SELECT 1 FROM radusergroup r WHERE r.username = s.username)
+    """)
+    result = {'vouchers': cursor.fetchone()[0]}
+
+    for table in tables:
+        cursor.execute(f"DELETE FROM {table} WHERE username IN (SELECT username FROM delete_stage)")
+        result[table] = cursor.rowcount
+
+    cursor.execute("DELETE FROM delete_stage")
+    return result
+
+
+def set_voucher_status(conn: sqlite3.Connection, username: str, status: str) -> Dict:
+    """
+    Enable or disable a voucher via an Auth-Type := Reject check row
+
+    Args:
+        conn: Open database connection (not committed here)
+        username: Voucher username
+        status: 'active' or 'disabled'
+
+    Returns:
+        Dictionary with 'found' (voucher exists) and 'changed' flags
+    """
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT COUNT(*) FROM radcheck WHERE username = ? AND attribute = 'Cleartext-Password'",
+        (username,)
+    )
+    if cursor.fetchone()[0] == 0:
+        return {'found': False, 'changed': False}
+
+    if status == 'disabled':
+        # Add Auth-Type = Reject unless already present
+        cursor.execute("""
+            INSERT INTO radcheck (username, attribute, op, value)
+            SELECT ?, 'Auth-Type', ':=', 'Reject'
+            WHERE NOT EXISTS (
+                SELECT 1 FROM radcheck
+                WHERE username = ? AND attribute = 'Auth-Type' AND value = 'Reject'
+            )
+        """, (username, username))
+    else:
+        # Remove Auth-Type = Reject to enable authentication
+        cursor.execute(
+            "DELETE FROM radcheck WHERE username = ? AND attribute = 'Auth-Type' AND value = 'Reject'",
+            (username,)
+        )
+
+    return {'found': True, 'changed': cursor.rowcount > 0}
+
+
+def sync_mac_bindings(conn: sqlite3.Connection, bindings: List) -> Dict:
+    """
+    Add or update Calling-Station-Id check rows for MAC-bound vouchers
+
+    Valid bindings are staged in a temporary table (a username repeated in
+    the payload keeps its last MAC address) and applied with one UPDATE of
+    changed rows and one INSERT of missing rows. Shared by the API
+    (POST /sync-mac-bindings) and activation-sync.py.
+
+    Args:
+        conn: Open database connection (not committed here)
+        bindings: List of {"username": ..., "mac_address": ...} dicts
+
+    Returns:
+        Dictionary with 'inserted', 'updated', 'unchanged' (per username),
+        'synced' (inserted + unchanged, as before), 'failed' and 'errors'
+    """
+    errors = []
+    staged = {}
+
+    for binding in bindings:
+        if not isinstance(binding, dict) or 'username' not in binding or 'mac_address' not in binding:
+            username = binding.get('username', 'unknown') if isinstance(binding, dict) else 'unknown'
+            errors.append(f"{username}: Missing username or mac_address")
+            continue
+
+        mac_address = binding['mac_address']
+        if not isinstance(mac_address, str) or not mac_address:
+            errors.append(f"{binding['username']}: Invalid value for mac_address")
+            continue
+
+        staged[str(binding['username'])] = mac_address
+
+    inserted = updated = unchanged = 0
+
+    if staged:
+        cursor = conn.cursor()
+        _ensure_mac_stage(cursor)
+        cursor.executemany(
+            "INSERT INTO mac_stage (username, mac_address) VALUES (?, ?)",
+            staged.items()
+        )
+
+        try:
+            # Classify before writing: no binding yet / bound to another MAC
+            cursor.execute("""
+                SELECT
+                    COALESCE(SUM(NOT EXISTS (
+                        SELECT 1 FROM radcheck r
+                        WHERE r.username = s.username AND r.attribute = 'Calling-Station-Id'
+                    )), 0),
+                    COALESCE(SUM(EXISTS (
+                        SELECT 1 FROM radcheck r
+                        WHERE r.username = s.username AND r.attribute = 'Calling-Station-Id'
+                          AND r.value <> s.mac_address
+                    )), 0)
+                FROM mac_stage s
+            """)
+            inserted, updated = cursor.fetchone()
+            unchanged = len(staged) - inserted - updated
+
+            cursor.execute("""
+                UPDATE radcheck
+                SET value = (SELECT s.mac_address FROM mac_stage s WHERE s.username = radcheck.username)
+                WHERE attribute = 'Calling-Station-Id'
+                  AND EXISTS (
+                      SELECT 1 FROM mac_stage s
+                      WHERE s.username = radcheck.username AND s.mac_address <> radcheck.value
+                  )
+            """)
+            cursor.execute("""
+                INSERT INTO radcheck (username, attribute, op, value)
+                SELECT s.username, 'Calling-Station-Id', '==', s.mac_address
+                FROM mac_stage s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM radcheck r
+                    WHERE r.username = s.username AND r.attribute = 'Calling-Station-Id'
+                )
+            """)
+
+        except sqlite3.Error as e:
+            # The caller must roll back to discard any partially written rows
+            logger.error(f"Database error syncing {len(staged)} MAC binding(s): {e}")
+            cursor.execute("DELETE FROM mac_stage")
+            errors.extend(f"{username}: Database error - {str(e)}" for username in staged)
+            return {
+                'inserted': 0,
+                'updated': 0,
+                'unchanged': 0,
+                'synced': 0,
+                'failed': len(errors),
+                'errors': errors,
+                'database_error': str(e)
+            }
+
+        cursor.execute("DELETE FROM mac_stage")
+
+    for error in errors:
+        logger.error(f"Validation error: {error}")
+
+    return {
+        'inserted': inserted,
+        'updated': updated,
+        'unchanged': unchanged,
+        'synced': inserted + unchanged,
+        'failed': len(errors),
+        'errors': errors
+    }
+
+
+def validate_mutation(mutation) -> str:
+    """
+    Validate a single entry of a mixed mutation batch
+
+    Returns:
+        Error message, or empty string if the mutation is valid
+    """
+    if not isinstance(mutation, dict):
+        return "Operation must be an object"
+
+    op = mutation.get('op')
+    if op not in MUTATION_OPS:
+        return f"Invalid op. Must be one of: {', '.join(MUTATION_OPS)}"
+
+    if op == 'create':
+        return validate_voucher(mutation)
+
+    username = mutation.get('username')
+    if isinstance(username, bool) or not isinstance(username, (str, int)) or str(username) == '':
+        return "Missing username"
+
+    if op == 'rebind_mac':
+        if 'mac_address' not in mutation:
+            return "Missing mac_address"
+        mac_address = mutation['mac_address']
+        if mac_address is not None and not isinstance(mac_address, str):
+            return "Invalid value for mac_address"
+
+    return ''
+
+
+def _apply_mutation_wave(conn: sqlite3.Connection, wave: List, results: List):
+    """
+    Apply one wave of mutations (each username appears at most once)
+
+    Raises:
+        sqlite3.Error if a statement failed (the caller rolls back)
+    """
+    creates = [(pos, mutation) for pos, mutation in wave if mutation['op'] == 'create']
+    others = [(pos, mutation) for pos, mutation in wave if mutation['op'] != 'create']
+
+    if creates:
+        created = insert_vouchers(conn, [mutation for _, mutation in creates])
+        if 'database_error' in created:
+            raise sqlite3.OperationalError(created['database_error'])
+
+        # Errors are in payload order, one per voucher that was not inserted
+        inserted = set(created['inserted'])
+        errors = iter(created['errors'])
+        for pos, mutation in creates:
+            if str(mutation['username']) in inserted:
+                results[pos].update({'success': True, 'changed': True})
+            else:
+                results[pos]['error'] = next(errors).split(': ', 1)[-1]
+
+    if not others:
+        return
+
+    cursor = conn.cursor()
+    _ensure_mutation_stage(cursor)
+    cursor.executemany(
+        "INSERT INTO mutation_stage (pos, op, username, value) VALUES (?, ?, ?, ?)",
+        [
+            (pos, mutation['op'], str(mutation['username']), mutation.get('mac_address') or '')
+            for pos, mutation in others
+        ]
+    )
+
+    # Vouchers that do not exist fail; deletes only need some RADIUS row
+    cursor.execute("""
+        SELECT s.pos FROM mutation_stage s
+        WHERE CASE WHEN s.op = 'delete' THEN
+                  NOT EXISTS (SELECT 1 FROM radcheck r WHERE r.username = s.username)
+                  AND NOT EXISTS (SELECT 1 FROM radreply r WHERE r.username = s.username)
+                  AND NOT EXISTS (SELECT 1 FROM radusergroup r WHERE r.username = s.username)
+              ELSE
+                  NOT EXISTS (
+                      SELECT 1 FROM radcheck r
+                      WHERE r.username = s.username AND r.attribute = 'Cleartext-Password'
+                  )
+              END
+    """)
+    missing = [row[0] for row in cursor.fetchall()]
+    if missing:
+        for pos in missing:
+            results[pos]['error'] = 'Voucher not found'
+        cursor.executemany("DELETE FROM mutation_stage WHERE pos = ?", [(pos,) for pos in missing])
+
+    # Work out which mutations change anything before applying them
+    cursor.execute("""
+        SELECT s.pos,
+               CASE s.op
+                   WHEN 'delete' THEN 1
+                   WHEN 'disable' THEN NOT EXISTS (
+                       SELECT 1 FROM radcheck r
+                       WHERE r.username = s.username AND r.attribute = 'Auth-Type' AND r.value = 'Reject'
+                   )
+                   WHEN 'enable' THEN EXISTS (
+                       SELECT 1 FROM radcheck r
+                       WHERE r.username = s.username AND r.attribute = 'Auth-Type' AND r.value = 'Reject'
+                   )
+                   ELSE CASE WHEN s.value = '' THEN EXISTS (
+                       SELECT 1 FROM radcheck r
+                       WHERE r.username = s.username AND r.attribute = 'Calling-Station-Id'
+                   ) ELSE NOT EXISTS (
+                       SELECT 1 FROM radcheck r
+                       WHERE r.username = s.username AND r.attribute = 'Calling-Station-Id'
+                         AND r.value = s.value
+                   ) END
+               END
+        FROM mutation_stage s
+    """)
+    for pos, changed in cursor.fetchall():
+        results[pos].update({'success': True, 'changed': bool(changed)})
+
+    # delete: all RADIUS rows for the voucher
+    for table in ('radcheck', 'radreply', 'radusergroup', 'radpostauth'):
+        cursor.execute(f"""
+            DELETE FROM {table}
+            WHERE username IN (SELECT username FROM mutation_stage WHERE op = 'delete')
+        """)
+
+    # disable: add Auth-Type := Reject unless already present
+    cursor.execute("""
+        INSERT INTO radcheck (username, attribute, op, value)
+        SELECT s.username, 'Auth-Type', ':=', 'Reject'
+        FROM mutation_stage s
+        WHERE s.op = 'disable'
+          AND NOT EXISTS (
+              SELECT 1 FROM radcheck r
+              WHERE r.username = s.username AND r.attribute = 'Auth-Type' AND r.value = 'Reject'
+          )
+        ORDER BY s.pos
+    """)
+
+    # enable: remove Auth-Type := Reject
+    cursor.execute("""
+        DELETE FROM radcheck
+        WHERE attribute = 'Auth-Type' AND value = 'Reject'
+          AND username IN (SELECT username FROM mutation_stage WHERE op = 'enable')
+    """)
+
+    # rebind_mac: empty/null mac_address removes the binding
+    cursor.execute("""
+        DELETE FROM radcheck
+        WHERE attribute = 'Calling-Station-Id'
+          AND username IN (SELECT username FROM mutation_stage WHERE op = 'rebind_mac' AND value = '')
+    """)
+    cursor.execute("""
+        UPDATE radcheck
+        SET value = (
+            SELECT s.value FROM mutation_stage s
+            WHERE s.op = 'rebind_mac' AND s.username = radcheck.username
+        )
+        WHERE attribute = 'Calling-Station-Id'
+          AND username IN (SELECT username FROM mutation_stage WHERE op = 'rebind_mac' AND value <> '')
+    """)
+    cursor.execute("""
+        INSERT INTO radcheck (username, attribute, op, value)
+        SELECT s.username, 'Calling-Station-Id', '==', s.value
+        FROM mutation_stage s
+        WHERE s.op = 'rebind_mac' AND s.value <> ''
+          AND NOT EXISTS (
+              SELECT 1 FROM radcheck r
+              WHERE r.username = s.username AND r.attribute = 'Calling-Station-Id'
+          )
+        ORDER BY s.pos
+    """)
+
+    cursor.execute("DELETE FROM mutation_stage")
+
+
+def apply_mutations(conn: sqlite3.Connection, mutations: List) -> Dict:
+    """
+    Apply a mixed batch of voucher mutations using set-based SQL
+
+    Supported ops: create (voucher fields as in a sync payload), delete,
+    enable, disable and rebind_mac (mac_address, null/empty to unbind).
+
+    Mutations are applied in payload order: the batch is split into waves in
+    which every username appears at most once, and each wave is applied with
+    one statement per operation type. All waves share the caller's
+    transaction, so a database error rolls back the whole batch.
+
+    Args:
+        conn: Open database connection (not committed here)
+        mutations: List of mutation dicts ({"op": ..., "username": ...})
+
+    Returns:
+        Dictionary with 'succeeded', 'failed' and 'results' (one entry per
+        mutation, in payload order)
+    """
+    results = []
+    waves = [[]]
+    wave_usernames = set()
+
+    for pos, mutation in enumerate(mutations):
+        error = validate_mutation(mutation)
+        op = mutation.get('op') if isinstance(mutation, dict) else None
+        username = mutation.get('username') if isinstance(mutation, dict) else None
+
+        result = {
+            'index': pos,
+            'op': op,
+            'username': str(username) if username is not None else None,
+            'success': False,
+            'changed': False,
+        }
+        results.append(result)
+
+        if error:
+            result['error'] = error
+            continue
+
+        # A repeated username starts a new wave so payload order is preserved
+        if result['username'] in wave_usernames:
+            waves.append([])
+            wave_usernames = set()
+        wave_usernames.add(result['username'])
+        waves[-1].append((pos, mutation))
+
+    try:
+        for wave in waves:
+            if wave:
+                _apply_mutation_wave(conn, wave, results)
+    except sqlite3.Error as e:
+        logger.error(f"Database error applying mutation batch: {e}")
+        for result in results:
+            if result['success'] or 'error' not in result:
+                result.update({'success': False, 'changed': False, 'error': f"Database error - {str(e)}"})
+        return {
+            'succeeded': 0,
+            'failed': len(results),
+            'results': results,
+            'database_error': str(e)
+        }
+
+    succeeded = sum(1 for result in results if result['success'])
+
+    return {
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'results': results
+    }
+
+
+def get_state(conn: sqlite3.Connection, name: str, default: Optional[str] = None) -> Optional[str]:
+    """
+    Read a value from radtik_sync_state (migration 4)
+
+    Args:
+        conn: Open database connection
+        name: State key (e.g. 'cleanup.tombstone_cursor')
+        default: Returned when the key has never been set
+
+    Returns:
+        Stored value or default
+    """
+    row = conn.execute("SELECT value FROM radtik_sync_state WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else default
+
+
+def set_state(conn: sqlite3.Connection, name: str, value) -> None:
+    """
+    Store a value in radtik_sync_state (not committed here)
+
+    Args:
+        conn: Open database connection
+        name: State key
+        value: Value to store (converted to str)
+    """
+    conn.execute("""
+        INSERT INTO radtik_sync_state (name, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+    """, (name, str(value)))
+
+
+def trim_authorize_changes(conn: sqlite3.Connection, keep: int) -> int:
+    """
+    Delete all but the newest `keep` rows of radtik_authorize_changes
+    (migration 5, not committed here)
+
+    The triggers log every radcheck/radreply change whether or not the
+    authorize index is enabled, so both the index and cleanup-orphaned.py
+    trim it.
+
+    Args:
+        conn: Open database connection
+        keep: Number of most recent changes to keep
+
+    Returns:
+        Number of rows deleted
+    """
+    newest = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM radtik_authorize_changes").fetchone()[0]
+    if newest <= keep:
+        return 0
+
+    return conn.execute("DELETE FROM radtik_authorize_changes WHERE seq <= ?", (newest - keep,)).rowcount
+
+
+def _username_page(conn: sqlite3.Connection, query: str, params: tuple, after: str, limit: int) -> Optional[str]:
+    """Last username of a keyset page (query selects DISTINCT username ... ORDER BY username), None if empty"""
+    rows = conn.execute(f"{query} AND username > ? ORDER BY username LIMIT ?", (*params, after, limit)).fetchall()
+    return rows[-1][0] if rows else None
+
+
+def convert_to_profiles(conn: sqlite3.Connection, after: str, limit: int) -> Tuple[int, Optional[str]]:
+    """
+    Move the Mikrotik-Rate-Limit radreply rows of a keyset page of usernames
+    to rate-limit profiles (not committed here)
+
+    Args:
+        conn: Open database connection
+        after: Last username of the previous page ('' for the first page)
+        limit: Usernames per page
+
+    Returns:
+        (vouchers converted, last username of the page or None when done)
+    """
+    until = _username_page(
+        conn,
+        "SELECT DISTINCT username FROM radreply WHERE attribute = 'Mikrotik-Rate-Limit' AND op = ':='",
+        (), after, limit
+    )
+    if until is None:
+        return 0, None
+
+    # A repeated := row overrides the earlier ones, keep the last value
+    rate_limits = {}
+    for username, value in conn.execute("""
+        SELECT username, value FROM radreply
+        WHERE attribute = 'Mikrotik-Rate-Limit' AND op = ':=' AND username > ? AND username <= ?
+        ORDER BY username, id
+    """, (after, until)):
+        rate_limits[username] = value
+
+    cursor = conn.cursor()
+    _ensure_profile_stage(cursor)
+    cursor.executemany(
+        "INSERT INTO profile_stage (username, profile, rate_limit) VALUES (?, ?, ?)",
+        [(username, profile_name(value), value) for username, value in rate_limits.items()]
+    )
+
+    _insert_profiles(cursor, 'profile_stage')
+    cursor.execute("""
+        INSERT INTO radusergroup (username, groupname, priority)
+        SELECT s.username, s.profile, ?
+        FROM profile_stage s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM radusergroup u WHERE u.username = s.username AND u.groupname = s.profile
+        )
+    """, (PROFILE_PRIORITY,))
+    cursor.execute("""
+        DELETE FROM radreply
+        WHERE attribute = 'Mikrotik-Rate-Limit' AND op = ':='
+          AND username IN (SELECT username FROM profile_stage)
+    """)
+    cursor.execute("DELETE FROM profile_stage")
+
+    return len(rate_limits), until
+
+
+def convert_to_rate_limits(conn: sqlite3.Connection, after: str, limit: int) -> Tuple[int, Optional[str]]:
+    """
+    Replace the rate-limit profile memberships of a keyset page of usernames
+    with per-voucher Mikrotik-Rate-Limit radreply rows (not committed here)
+
+    Args:
+        conn: Open database connection
+        after: Last username of the previous page ('' for the first page)
+        limit: Usernames per page
+
+    Returns:
+        (vouchers converted, last username of the page or None when done)
+    """
+    pattern = PROFILE_PREFIX + '%'
+    until = _username_page(
+        conn, "SELECT DISTINCT username FROM radusergroup WHERE groupname LIKE ?", (pattern,), after, limit
+    )
+    if until is None:
+        return 0, None
+
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO radreply (username, attribute, op, value)
+        SELECT u.username, g.attribute, g.op, g.value
+        FROM radusergroup u
+        JOIN radgroupreply g ON g.groupname = u.groupname
+        WHERE u.groupname LIKE ? AND u.username > ? AND u.username <= ?
+        ORDER BY u.username, u.priority, g.id
+    """, (pattern, after, until))
+    cursor.execute(
+        "DELETE FROM radusergroup WHERE groupname LIKE ? AND username > ? AND username <= ?",
+        (pattern, after, until)
+    )
+
+    return cursor.rowcount, until
+
+
+def prune_profiles(conn: sqlite3.Connection) -> int:
+    """
+    Delete the radgroupreply rows of rate-limit profiles no voucher belongs
+    to any more (not committed here, scans radusergroup once)
+
+    Returns:
+        Number of rows deleted
+    """
+    return conn.execute("""
+        DELETE FROM radgroupreply
+        WHERE groupname LIKE ?
+          AND groupname NOT IN (SELECT DISTINCT groupname FROM radusergroup)
+    """, (PROFILE_PREFIX + '%',)).rowcount
+
+
+def profile_status(conn: sqlite3.Connection) -> Dict:
+    """Rate-limit profile mode and how many vouchers use each layout"""
+    pattern = PROFILE_PREFIX + '%'
+    return {
+        'enabled': profiles_enabled(conn),
+        'profiles': conn.execute(
+            "SELECT COUNT(DISTINCT groupname) FROM radgroupreply WHERE groupname LIKE ?", (pattern,)
+        ).fetchone()[0],
+        'profile_vouchers': conn.execute(
+            "SELECT COUNT(*) FROM radusergroup WHERE groupname LIKE ?", (pattern,)
+        ).fetchone()[0],
+        'radreply_vouchers': conn.execute(
+            "SELECT COUNT(*) FROM radreply WHERE attribute = 'Mikrotik-Rate-Limit'"
+        ).fetchone()[0],
+    }
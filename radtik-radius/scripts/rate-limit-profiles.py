@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+RadTik Rate-Limit Profiles
+Switches how voucher rate limits are stored, and converts existing vouchers.
+
+Without profiles (the default) every voucher has its own radreply row
+(Mikrotik-Rate-Limit := <value>). With profiles each distinct rate limit is
+stored once in radgroupreply, in a group named after the value
+(radtik-rl-<hash>), and a voucher only gets a small radusergroup row that
+points at it. FreeRADIUS reads group replies with its stock rlm_sql group
+queries (read_groups = yes), so the Access-Accept is the same.
+
+The mode is stored in the database (radtik_sync_state), so the API, the
+cron scripts and a replication follower's writer all follow it as soon as it
+is switched. Existing vouchers are then converted in keyset pages of
+usernames, one short transaction per page, so the conversion runs safely on
+a live server and can simply be started again if it was interrupted. Run it
+on every server (a follower converts its own copy).
+
+Usage:
+    python3 rate-limit-profiles.py              # show mode and counts
+    python3 rate-limit-profiles.py --enable     # switch to profiles, convert radreply rows
+    python3 rate-limit-profiles.py --disable    # switch back, convert memberships to radreply rows
+"""
+
+import argparse
+import configparser
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import radius_store
+from migrate import SCHEMA_VERSION, get_version
+
+logger = logging.getLogger('rate-limit-profiles')
+
+
+def set_mode(conn: sqlite3.Connection, enabled: bool):
+    """Store the mode; writers read it inside their own transaction"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        radius_store.set_state(conn, radius_store.PROFILE_MODE_KEY, '1' if enabled else '0')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def convert(conn: sqlite3.Connection, step, batch_size: int) -> int:
+    """
+    Run a conversion step page by page, committing after every page
+    
+    Args:
+        conn: Open database connection
+        step: radius_store.convert_to_profiles or convert_to_rate_limits
+        batch_size: Usernames per page
+    
+    Returns:
+        Number of vouchers converted
+    """
+    after = ''
+    converted = 0
+    started = time.monotonic()
+    
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            count, until = step(conn, after, batch_size)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        if until is None:
+            break
+        
+        converted += count
+        after = until
+        logger.info(f"  {converted} voucher(s) converted (up to '{until}')")
+    
+    logger.info(f"Converted {converted} voucher(s) in {time.monotonic() - started:.1f}s")
+    return converted
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    parser = argparse.ArgumentParser(description='Store RadTik voucher rate limits as shared profiles')
+    parser.add_argument('--db', help='Path to radius.db (default: [radius] db_path from config.ini)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--enable', action='store_true', help='Use profiles and convert existing vouchers')
+    mode.add_argument('--disable', action='store_true', help='Use radreply rows and convert existing vouchers')
+    parser.add_argument('--batch-size', type=int, default=5000, help='Usernames per transaction (default: 5000)')
+    args = parser.parse_args()
+    
+    db_path = args.db
+    if not db_path:
+        config = configparser.ConfigParser()
+        config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini'))
+        db_path = config.get('radius', 'db_path', fallback='/etc/freeradius/3.0/sqlite/radius.db')
+    
+    if not os.path.exists(db_path):
+        logger.error(f"RADIUS database not found: {db_path}")
+        sys.exit(1)
+    
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA busy_timeout=30000")
+    
+    try:
+        if get_version(conn) < SCHEMA_VERSION:
+            logger.error(f"Schema version {get_version(conn)}, expected {SCHEMA_VERSION} (run migrate.py first)")
+            sys.exit(1)
+        
+        if args.enable:
+            set_mode(conn, True)
+            logger.info("Rate-limit profiles enabled, converting radreply rate limits...")
+            convert(conn, radius_store.convert_to_profiles, args.batch_size)
+        elif args.disable:
+            set_mode(conn, False)
+            logger.info("Rate-limit profiles disabled, converting profile memberships...")
+            convert(conn, radius_store.convert_to_rate_limits, args.batch_size)
+            with conn:
+                pruned = radius_store.prune_profiles(conn)
+            logger.info(f"Removed {pruned} unused profile row(s)")
+        
+        status = radius_store.profile_status(conn)
+        logger.info(f"Rate-limit profiles: {'enabled' if status['enabled'] else 'disabled'}, "
+                    f"{status['profiles']} profile(s), {status['profile_vouchers']} voucher(s) in a profile, "
+                    f"{status['radreply_vouchers']} voucher(s) with a radreply rate limit")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
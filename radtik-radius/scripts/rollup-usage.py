@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+RadTik Usage Rollup
+Aggregates closed radacct sessions into daily usage per username / NAS and
+per NAS (see usage_rollup.py), for GET /usage/daily and GET /usage/nas.
+
+This script runs via cron every minute and:
+1. Rolls up the sessions closed since the last run, in batches of
+   [usage] batch_size with one short transaction each
+2. Deletes rollup rows older than [usage] retention_days
+
+Each batch only reads the sessions queued by the radacct triggers, so a run
+costs O(new sessions). A run stops after [usage] max_run_seconds; the next
+run continues with the rest of the queue (e.g. the backfill of sessions
+closed before migration 8).
+
+Usage:
+    python3 rollup-usage.py            # roll up + prune
+    python3 rollup-usage.py --status   # show backlog and export position
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import sys
+import time
+
+import usage_rollup
+from db_pool import pool_from_config
+from migrate import SCHEMA_VERSION, get_version
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('/var/log/radtik-rollup-usage.log'),
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger('rollup-usage')
+
+# Load configuration
+config = configparser.ConfigParser()
+config_path = os.path.join(os.path.dirname(__file__), 'config.ini')
+
+if not os.path.exists(config_path):
+    logger.error(f"Configuration file not found: {config_path}")
+    sys.exit(1)
+
+config.read(config_path)
+
+# Configuration variables
+RADIUS_DB_PATH = config.get('radius', 'db_path', fallback='/etc/freeradius/3.0/sqlite/radius.db')
+BATCH_SIZE = config.getint('usage', 'batch_size', fallback=5000)
+BATCH_PAUSE = config.getfloat('usage', 'batch_pause_ms', fallback=10) / 1000.0
+MAX_RUN_SECONDS = config.getfloat('usage', 'max_run_seconds', fallback=50)
+RETENTION_DAYS = config.getfloat('usage', 'retention_days', fallback=400)
+
+if not os.path.exists(RADIUS_DB_PATH):
+    logger.error(f"RADIUS database not found: {RADIUS_DB_PATH}")
+    sys.exit(1)
+
+
+def run(conn) -> dict:
+    """Roll up queued sessions batch by batch until the queue is empty or the time budget is spent"""
+    started = time.monotonic()
+    totals = {'sessions': 0, 'skipped': 0, 'rows': 0, 'batches': 0, 'complete': True}
+    
+    while True:
+        if time.monotonic() - started > MAX_RUN_SECONDS:
+            totals['complete'] = False
+            break
+        
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = usage_rollup.rollup(conn, BATCH_SIZE)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        if not result['sessions'] and not result['skipped']:
+            break
+        
+        for key in ('sessions', 'skipped', 'rows'):
+            totals[key] += result[key]
+        totals['batches'] += 1
+        
+        # Let FreeRADIUS write accounting between batches
+        time.sleep(BATCH_PAUSE)
+    
+    return totals
+
+
+def main():
+    """Main function - roll up new radacct sessions"""
+    parser = argparse.ArgumentParser(description='Roll up closed radacct sessions into daily usage')
+    parser.add_argument('--status', action='store_true', help='Show backlog and export position and exit')
+    args = parser.parse_args()
+    
+    db_pool = pool_from_config(config, RADIUS_DB_PATH, size=1)
+    
+    try:
+        with db_pool.connection() as conn:
+            if get_version(conn) < SCHEMA_VERSION:
+                logger.error(f"Schema version {get_version(conn)}, expected {SCHEMA_VERSION} (run migrate.py first)")
+                sys.exit(1)
+            
+            if args.status:
+                logger.info(json.dumps(usage_rollup.usage_status(conn)))
+                return
+            
+            started = time.monotonic()
+            totals = run(conn)
+            
+            with conn:
+                pruned = usage_rollup.prune(conn, RETENTION_DAYS)
+            
+            if totals['sessions'] or totals['skipped'] or pruned:
+                logger.info(f"Rolled up {totals['sessions']} session(s) into {totals['rows']} row update(s) "
+                            f"in {totals['batches']} batch(es), {time.monotonic() - started:.1f}s; "
+                            f"skipped {totals['skipped']}, pruned {pruned} row(s)")
+            if not totals['complete']:
+                logger.info("Time budget reached, the next run continues")
+    except Exception as e:
+        logger.error(f"Fatal error: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        sys.exit(1)
+    finally:
+        db_pool.close()
+
+
+if __name__ == '__main__':
+    main()
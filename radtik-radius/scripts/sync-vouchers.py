@@ -5,20 +5,52 @@ Flask-based API server for syncing vouchers from Laravel to FreeRADIUS SQLite da
 
 Endpoints:
 - POST /sync/vouchers - Sync batch of vouchers to RADIUS database
+- POST /sync/vouchers/stream - Stream vouchers as newline-delimited JSON
+  (both accept ?async=1 to queue a background job)
+- GET /jobs/<job_id> - Progress of an async sync job
+- POST /batch/vouchers - Mixed create/delete/enable/disable/rebind_mac batch
 - DELETE /delete/voucher - Delete a voucher from RADIUS database
-- GET /health - Health check endpoint
+- GET /health - Liveness check (connection + schema version)
+- GET /health/deep - Rate-limited deep health check
+- GET /metrics - Prometheus metrics aggregated across workers
+- POST /authorize - FreeRADIUS rlm_rest authorize from an in-memory index
+  (enabled with [authorize] enabled = true, see authorize_index.py)
+- GET /changes?since=<seq> - Replication change log page (see change_log.py)
+- GET /changes/snapshot - Keyset page of the voucher set for follower bootstrap
+- GET /archive/postauth - Archived authentication attempts (see postauth_archive.py)
+- GET /archive/postauth/daily - Daily authentication summaries
+- GET /usage/daily?after=<seq> - Daily usage per username and NAS (see usage_rollup.py)
+- GET /usage/nas?after=<seq> - Daily usage per NAS
 
-Authentication: Bearer token (configured in config.ini)
+Authentication: Bearer token (configured in config.ini); /authorize also
+accepts HTTP Basic auth with the token as password (rlm_rest)
 """
 
-import sqlite3
+import base64
 import configparser
+import hmac
+import io
+import json
 import logging
 import os
 import sys
+import threading
+import time
 from datetime import datetime
 from functools import wraps
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
+
+import change_log
+import metrics
+import radius_store
+import usage_rollup
+from authorize_index import UnsupportedOperator, index_from_config
+from db_pool import pool_from_config
+from job_store import JobRunner, JobStore
+from migrate import SCHEMA_VERSION
+from postauth_archive import archive_from_config
+from radius_stats import StatsCache
+from write_queue import WriteCoordinator
 
 # Configure logging
 logging.basicConfig(
@@ -49,6 +81,23 @@ AUTH_TOKEN = config.get('api', 'auth_token')
 API_HOST = config.get('api', 'host', fallback='0.0.0.0')
 API_PORT = config.getint('api', 'port', fallback=5000)
 DEBUG_MODE = config.getboolean('api', 'debug', fallback=False)
+STREAM_BATCH_SIZE = config.getint('api', 'stream_batch_size', fallback=2000)
+STREAM_MAX_ERRORS = config.getint('api', 'stream_max_errors', fallback=100)
+STREAM_MAX_LINE_BYTES = 65536
+BATCH_MAX_OPERATIONS = config.getint('api', 'batch_max_operations', fallback=10000)
+STATS_CACHE_TTL = config.getfloat('api', 'stats_cache_ttl', fallback=5.0)
+DEEP_HEALTH_INTERVAL = config.getfloat('api', 'deep_health_interval', fallback=10.0)
+JOBS_ENABLED = config.getboolean('jobs', 'enabled', fallback=True)
+JOBS_DB_PATH = config.get('jobs', 'db_path', fallback='/var/lib/radtik-radius/jobs.db')
+AUTHORIZE_ENABLED = config.getboolean('authorize', 'enabled', fallback=False)
+CHANGELOG_ENABLED = change_log.changelog_enabled(config)
+FOLLOWER = change_log.is_follower(config)
+CHANGES_MAX_LIMIT = 5000
+CHANGES_MAX_BYTES = config.getint('replication', 'changes_max_bytes', fallback=8 * 1024 * 1024)
+SNAPSHOT_MAX_LIMIT = 20000
+ARCHIVE_ENABLED = config.getboolean('archive', 'enabled', fallback=True)
+ARCHIVE_MAX_LIMIT = 10000
+USAGE_MAX_LIMIT = 10000
 
 # Validate configuration
 if not AUTH_TOKEN or AUTH_TOKEN == 'your-secure-token-here':
@@ -60,15 +109,206 @@ if not os.path.exists(DB_PATH):
     sys.exit(1)
 
 
-def get_db_connection():
-    """Get SQLite database connection"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
-    except sqlite3.Error as e:
-        logger.error(f"Database connection error: {e}")
-        raise
+# Per-worker connection pool (PRAGMA profile from [database] section)
+db_pool = pool_from_config(config, DB_PATH)
+
+# All mutations go through the single group-commit writer (see write_queue.py)
+writer = WriteCoordinator(config, DB_PATH)
+
+# Trigger-maintained /stats counters with a short per-worker TTL cache
+stats_cache = StatsCache(db_pool, ttl=STATS_CACHE_TTL)
+
+# Last /health/deep result (rate-limited per worker)
+_deep_health = {'lock': threading.Lock(), 'result': None, 'expires': 0.0}
+
+# Prometheus metrics, merged across workers on scrape (see metrics.py)
+metrics_exporter = metrics.exporter_from_config(config)
+
+# Async job store and runner, created per worker process on first request
+_jobs = {'pid': None, 'store': None, 'error': None}
+
+# radpostauth archive (read side), opened per worker process on first request
+_archive = {'pid': None, 'archive': None, 'error': None}
+
+
+def get_job_store():
+    """Return this worker's job store, starting its runner thread if needed"""
+    if _jobs['pid'] != os.getpid():
+        _jobs.update({'pid': os.getpid(), 'store': None, 'error': None})
+        
+        if not JOBS_ENABLED:
+            _jobs['error'] = 'Async jobs are disabled'
+            return None
+        
+        try:
+            store = JobStore(
+                JOBS_DB_PATH,
+                chunk_size=config.getint('jobs', 'chunk_size', fallback=2000),
+                stale_seconds=config.getfloat('jobs', 'stale_seconds', fallback=120)
+            )
+            JobRunner(
+                store,
+                writer,
+                poll_interval=config.getfloat('jobs', 'poll_interval', fallback=1.0),
+                retention_hours=config.getfloat('jobs', 'retention_hours', fallback=72)
+            )
+            _jobs['store'] = store
+        except Exception as e:
+            logger.error(f"Async job store unavailable ({JOBS_DB_PATH}): {e}")
+            _jobs['error'] = f"Async job store unavailable: {e}"
+    
+    return _jobs['store']
+
+
+def get_postauth_archive():
+    """Return this worker's handle on the radpostauth archive, or None if unavailable"""
+    if _archive['pid'] != os.getpid():
+        _archive.update({'pid': os.getpid(), 'archive': None, 'error': None})
+        
+        if not ARCHIVE_ENABLED:
+            _archive['error'] = 'Post-auth archive is disabled ([archive] enabled)'
+            return None
+        
+        try:
+            _archive['archive'] = archive_from_config(config)
+        except Exception as e:
+            logger.error(f"Post-auth archive unavailable: {e}")
+            _archive['error'] = f"Post-auth archive unavailable: {e}"
+    
+    return _archive['archive']
+
+
+# In-memory authorize index, created per worker process on first request
+_authorize = {'pid': None, 'index': None}
+
+
+def get_authorize_index():
+    """Return this worker's authorize index (loading in the background), or None if disabled"""
+    if not AUTHORIZE_ENABLED:
+        return None
+    
+    if _authorize['pid'] != os.getpid():
+        _authorize.update({'pid': os.getpid(), 'index': index_from_config(config, db_pool)})
+    
+    return _authorize['index']
+
+
+def submit_write(op, payload):
+    """Apply a mutation through the single writer and refresh this worker's authorize index"""
+    result = writer.submit(op, payload)
+    
+    index = _authorize['index'] if _authorize['pid'] == os.getpid() else None
+    if index is not None:
+        try:
+            index.refresh(force=True)
+        except Exception as e:
+            logger.error(f"Authorize index refresh after {op} failed: {e}")
+    
+    return result
+
+
+@app.before_request
+def start_job_runner():
+    """Make sure every worker resumes queued jobs after a restart"""
+    get_job_store()
+    get_authorize_index()
+
+
+@app.before_request
+def start_request_timer():
+    """Record request start time and payload size for /metrics"""
+    g.request_started = time.monotonic()
+    if metrics_exporter is not None:
+        metrics_exporter.start()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Observe per-route latency, payload size and status"""
+    started = g.get('request_started')
+    if started is None:
+        return response
+    
+    # Use the route pattern, not the raw path, to keep label cardinality bounded
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    
+    metrics.observe('radtik_http_request_duration_seconds', time.monotonic() - started, route=route)
+    if request.content_length:
+        metrics.observe('radtik_http_request_size_bytes', request.content_length, route=route)
+    metrics.inc('radtik_http_requests_total', route=route, method=request.method, status=response.status_code)
+    if response.status_code >= 500:
+        metrics.inc('radtik_errors_total', type=f"http_{response.status_code}")
+    
+    return response
+
+
+def iter_ndjson(stream):
+    """
+    Parse a newline-delimited JSON body incrementally
+    
+    Yields:
+        (line_number, item, error) - item is None when the line was rejected
+    """
+    # Buffer the raw WSGI stream so readline() does not read byte by byte
+    stream = io.BufferedReader(stream, buffer_size=STREAM_MAX_LINE_BYTES)
+    line_number = 0
+    
+    while True:
+        raw = stream.readline(STREAM_MAX_LINE_BYTES)
+        if not raw:
+            break
+        line_number += 1
+        
+        if len(raw) >= STREAM_MAX_LINE_BYTES and not raw.endswith(b'\n'):
+            # Discard the rest of the oversized line
+            while raw and not raw.endswith(b'\n'):
+                raw = stream.readline(STREAM_MAX_LINE_BYTES)
+            yield line_number, None, f"line {line_number}: Line too long"
+            continue
+        
+        line = raw.strip()
+        if not line:
+            continue
+        
+        try:
+            yield line_number, json.loads(line), None
+        except ValueError:
+            yield line_number, None, f"line {line_number}: Invalid JSON"
+
+
+def queue_sync_job(items, summary=None):
+    """
+    Store vouchers as an async job and return the 202 response
+    
+    Args:
+        items: Voucher list or generator (consumed incrementally)
+        summary: Optional callable returning extra response fields, evaluated
+                 after all items were consumed
+    """
+    store = get_job_store()
+    
+    if store is None:
+        return jsonify({
+            'success': False,
+            'error': _jobs['error']
+        }), 503
+    
+    job_id = store.create_job('sync_vouchers', items)
+    job = store.get(job_id, errors_limit=0)
+    
+    logger.info(f"Queued sync job {job_id} with {job['total']} vouchers from {request.remote_addr}")
+    
+    response = {
+        'success': True,
+        'job_id': job_id,
+        'status': job['status'],
+        'total': job['total'],
+        'status_url': f"/jobs/{job_id}"
+    }
+    if summary is not None:
+        response.update(summary())
+    
+    return jsonify(response), 202
 
 
 def require_auth(f):
@@ -96,23 +336,47 @@ def require_auth(f):
     return decorated_function
 
 
+def require_primary(f):
+    """Decorator for endpoints that modify vouchers: a replication follower only takes changes from its primary"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if FOLLOWER:
+            return jsonify({
+                'success': False,
+                'error': 'This RADIUS server is a replication follower, send changes to its primary'
+            }), 409
+        
+        return f(*args, **kwargs)
+    
+    return decorated_function
+
+
 @app.route('/health', methods=['GET'])
 @require_auth
 def health_check():
-    """Health check endpoint"""
+    """
+    Liveness probe
+    
+    Constant time: only checks that a pooled connection works and the
+    database is at the schema version this API expects.
+    """
     try:
-        # Test database connection
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM radcheck")
-        count = cursor.fetchone()[0]
-        conn.close()
+        with db_pool.connection() as conn:
+            schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        
+        if schema_version != SCHEMA_VERSION:
+            logger.error(f"Schema version {schema_version}, expected {SCHEMA_VERSION}")
+            return jsonify({
+                'status': 'unhealthy',
+                'error': f'Schema version {schema_version}, expected {SCHEMA_VERSION} (run migrate.py)',
+                'schema_version': schema_version
+            }), 503
         
         return jsonify({
             'status': 'healthy',
             'timestamp': datetime.now().isoformat(),
             'database': 'connected',
-            'radcheck_records': count
+            'schema_version': schema_version
         }), 200
     except Exception as e:
         logger.error(f"Health check failed: {e}")
@@ -122,8 +386,80 @@ def health_check():
         }), 500
 
 
+def run_deep_health_check():
+    """Collect WAL, checkpoint, lock wait and counter details"""
+    wal_path = DB_PATH + '-wal'
+    
+    with db_pool.connection() as conn:
+        schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        # PASSIVE never blocks readers or the writer
+        busy, wal_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    
+    checkpoint = {
+        'at': datetime.now().isoformat(),
+        'mode': 'PASSIVE',
+        'busy': bool(busy),
+        'wal_frames': wal_frames,
+        'checkpointed_frames': checkpointed
+    }
+    
+    pool_stats = db_pool.stats()
+    status = 'healthy' if schema_version == SCHEMA_VERSION else 'unhealthy'
+    
+    return {
+        'status': status,
+        'timestamp': datetime.now().isoformat(),
+        'database': {
+            'path': DB_PATH,
+            'schema_version': schema_version,
+            'expected_schema_version': SCHEMA_VERSION,
+            'journal_mode': journal_mode,
+            'size_bytes': os.path.getsize(DB_PATH),
+            'wal_size_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        },
+        'last_checkpoint': checkpoint,
+        'lock_waits': {
+            'pool_waits': pool_stats['waits'],
+            'pool_wait_seconds': pool_stats['wait_seconds'],
+            'writer': writer.stats()
+        },
+        'counters': stats_cache.get()
+    }
+
+
+@app.route('/health/deep', methods=['GET'])
+@require_auth
+def deep_health_check():
+    """
+    Deep health check
+    
+    Rate-limited: the result is computed at most once every
+    [api] deep_health_interval seconds per worker and served from cache
+    in between.
+    """
+    try:
+        with _deep_health['lock']:
+            if _deep_health['result'] is None or time.monotonic() >= _deep_health['expires']:
+                _deep_health['result'] = run_deep_health_check()
+                _deep_health['expires'] = time.monotonic() + DEEP_HEALTH_INTERVAL
+                cached = False
+            else:
+                cached = True
+            result = dict(_deep_health['result'], cached=cached)
+        
+        return jsonify(result), 200 if result['status'] == 'healthy' else 503
+    except Exception as e:
+        logger.error(f"Deep health check failed: {e}")
+        return jsonify({
+            'status': 'unhealthy',
+            'error': str(e)
+        }), 500
+
+
 @app.route('/sync/vouchers', methods=['POST'])
 @require_auth
+@require_primary
 def sync_vouchers():
     """
     Sync batch of vouchers to RADIUS database
@@ -147,6 +483,9 @@ def sync_vouchers():
         "failed": 0,
         "errors": []
     }
+    
+    With ?async=1 the payload is stored as a durable job and applied in the
+    background; returns 202 with a job_id to poll at GET /jobs/<job_id>.
     """
     try:
         data = request.get_json()
@@ -174,100 +513,203 @@ def sync_vouchers():
                 'errors': []
             }), 200
         
+        if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+            return queue_sync_job(vouchers)
+        
         logger.info(f"Received sync request for {len(vouchers)} vouchers from {request.remote_addr}")
         
+        # Validate, stage and insert the whole batch with set-based SQL
+        # (applied by the single writer as part of a group commit)
+        result = submit_write('insert_vouchers', {'vouchers': vouchers})
+        
+        if 'database_error' in result:
+            logger.error(f"Database error during voucher sync: {result['database_error']}")
+        
+        synced = result['synced']
+        failed = result['failed']
+        errors = result['errors']
+        
+        if failed:
+            logger.warning(f"{failed} voucher(s) rejected, first: {errors[0]}")
+        
+        success = failed == 0
+        
+        logger.info(f"Sync completed: {synced} synced, {failed} failed")
+        
+        return jsonify({
+            'success': success,
+            'synced': synced,
+            'failed': failed,
+            'errors': errors
+        }), 200 if success else 207  # 207 Multi-Status for partial success
+        
+    except Exception as e:
+        logger.error(f"Sync endpoint error: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/sync/vouchers/stream', methods=['POST'])
+@require_auth
+@require_primary
+def sync_vouchers_stream():
+    """
+    Stream vouchers to RADIUS database as newline-delimited JSON
+    
+    The body (plain or chunked transfer encoding) contains one voucher object
+    per line, same fields as POST /sync/vouchers:
+    {"username": "ABC12345", "password": "pass123", "mikrotik_rate_limit": "512k/512k", "nas_identifier": "mikrotik-router-1"}
+    
+    Lines are parsed incrementally and written in sub-batches of
+    stream_batch_size, so memory use stays flat regardless of body size.
+    Only the first stream_max_errors error messages are returned.
+    
+    With ?async=1 the lines are stored as a durable job instead (202 with
+    job_id); unparseable lines are reported as 'rejected'.
+    
+    Returns:
+    {
+        "success": true,
+        "received": 100000,
+        "synced": 100000,
+        "failed": 0,
+        "batches": 50,
+        "errors": [],
+        "errors_truncated": 0
+    }
+    """
+    try:
+        received = 0
         synced = 0
         failed = 0
+        batches = 0
         errors = []
+        errors_truncated = 0
+        batch = []
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        def record_errors(messages):
+            nonlocal errors_truncated
+            room = max(0, STREAM_MAX_ERRORS - len(errors))
+            errors.extend(messages[:room])
+            errors_truncated += max(0, len(messages) - room)
         
-        for voucher in vouchers:
-            try:
-                # Validate required fields
-                required_fields = ['username', 'password', 'mikrotik_rate_limit', 'nas_identifier']
-                missing_fields = [field for field in required_fields if field not in voucher]
-                
-                if missing_fields:
-                    raise ValueError(f"Missing required fields: {', '.join(missing_fields)}")
-                
-                username = voucher['username']
-                password = voucher['password']
-                rate_limit = voucher['mikrotik_rate_limit']
-                nas_identifier = voucher['nas_identifier']
-                
-                # Check if voucher already exists
-                cursor.execute(
-                    "SELECT COUNT(*) FROM radcheck WHERE username = ? AND attribute = 'Cleartext-Password'",
-                    (username,)
-                )
-                exists = cursor.fetchone()[0] > 0
-                
-                if exists:
-                    logger.warning(f"Voucher {username} already exists, skipping")
-                    errors.append(f"{username}: Already exists")
-                    failed += 1
-                    continue
-                
-                # Insert into radcheck table (2 rows per voucher)
-                # Row 1: Password
-                cursor.execute(
-                    "INSERT INTO radcheck (username, attribute, op, value) VALUES (?, ?, ?, ?)",
-                    (username, 'Cleartext-Password', ':=', password)
-                )
-                
-                # Row 2: NAS Identifier (for router binding)
-                cursor.execute(
-                    "INSERT INTO radcheck (username, attribute, op, value) VALUES (?, ?, ?, ?)",
-                    (username, 'NAS-Identifier', '==', nas_identifier)
-                )
-                
-                # Insert into radreply table (1 row per voucher)
-                # MikroTik rate limit
-                cursor.execute(
-                    "INSERT INTO radreply (username, attribute, op, value) VALUES (?, ?, ?, ?)",
-                    (username, 'Mikrotik-Rate-Limit', ':=', rate_limit)
-                )
-                
-                synced += 1
-                logger.debug(f"Successfully synced voucher: {username}")
-                
-            except ValueError as e:
-                failed += 1
-                error_msg = f"{voucher.get('username', 'unknown')}: {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"Validation error: {error_msg}")
-                
-            except sqlite3.Error as e:
-                failed += 1
-                error_msg = f"{username}: Database error - {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"Database error for {username}: {e}")
-                
-            except Exception as e:
+        def flush():
+            nonlocal synced, failed, batches
+            result = submit_write('insert_vouchers', {'vouchers': batch})
+            if 'database_error' in result:
+                logger.error(f"Database error during streamed voucher sync: {result['database_error']}")
+            synced += result['synced']
+            failed += result['failed']
+            batches += 1
+            record_errors(result['errors'])
+            batch.clear()
+        
+        if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+            def accepted_items():
+                nonlocal received, failed
+                for _, item, error in iter_ndjson(request.stream):
+                    received += 1
+                    if error:
+                        failed += 1
+                        record_errors([error])
+                    else:
+                        yield item
+            
+            # Lines that could not be parsed never reach the job
+            return queue_sync_job(accepted_items(), summary=lambda: {
+                'rejected': failed,
+                'errors': errors,
+                'errors_truncated': errors_truncated
+            })
+        
+        for _, item, error in iter_ndjson(request.stream):
+            received += 1
+            
+            if error:
                 failed += 1
-                error_msg = f"{voucher.get('username', 'unknown')}: {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"Unexpected error: {error_msg}")
+                record_errors([error])
+                continue
+            
+            batch.append(item)
+            
+            if len(batch) >= STREAM_BATCH_SIZE:
+                flush()
         
-        # Commit all changes
-        conn.commit()
-        conn.close()
+        if batch:
+            flush()
         
         success = failed == 0
         
-        logger.info(f"Sync completed: {synced} synced, {failed} failed")
+        logger.info(f"Streamed sync completed from {request.remote_addr}: {received} received, {synced} synced, {failed} failed in {batches} batch(es)")
         
         return jsonify({
             'success': success,
+            'received': received,
             'synced': synced,
             'failed': failed,
-            'errors': errors
+            'batches': batches,
+            'errors': errors,
+            'errors_truncated': errors_truncated
         }), 200 if success else 207  # 207 Multi-Status for partial success
         
     except Exception as e:
-        logger.error(f"Sync endpoint error: {e}")
+        logger.error(f"Stream sync endpoint error: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@require_auth
+def get_job(job_id):
+    """
+    Get progress of an async sync job
+    
+    Query parameters:
+    - errors_offset: Skip this many per-item errors (default 0)
+    - errors_limit: Return at most this many per-item errors (default 100, max 1000)
+    
+    Returns:
+    {
+        "job_id": "4f0c...",
+        "type": "sync_vouchers",
+        "status": "running",  // receiving, queued, running, completed, failed
+        "total": 100000,
+        "processed": 42000,
+        "synced": 41990,
+        "failed": 10,
+        "progress": 0.42,
+        "errors": ["ABC12345: Already exists"],
+        ...
+    }
+    """
+    try:
+        store = get_job_store()
+        
+        if store is None:
+            return jsonify({
+                'success': False,
+                'error': _jobs['error']
+            }), 503
+        
+        errors_offset = max(0, request.args.get('errors_offset', 0, type=int))
+        errors_limit = min(1000, max(0, request.args.get('errors_limit', 100, type=int)))
+        
+        job = store.get(job_id, errors_offset=errors_offset, errors_limit=errors_limit)
+        
+        if job is None:
+            return jsonify({
+                'success': False,
+                'error': 'Job not found'
+            }), 404
+        
+        return jsonify(job), 200
+        
+    except Exception as e:
+        logger.error(f"Job status endpoint error: {e}")
         return jsonify({
             'success': False,
             'error': str(e)
@@ -276,6 +718,7 @@ def sync_vouchers():
 
 @app.route('/delete/voucher', methods=['DELETE'])
 @require_auth
+@require_primary
 def delete_voucher():
     """
     Delete a voucher from RADIUS database
@@ -304,25 +747,14 @@ def delete_voucher():
         
         logger.info(f"Deleting voucher: {username}")
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Delete from radcheck
-        cursor.execute("DELETE FROM radcheck WHERE username = ?", (username,))
-        radcheck_deleted = cursor.rowcount
-        
-        # Delete from radreply
-        cursor.execute("DELETE FROM radreply WHERE username = ?", (username,))
-        radreply_deleted = cursor.rowcount
-        
-        # Delete from radpostauth
-        cursor.execute("DELETE FROM radpostauth WHERE username = ?", (username,))
-        radpostauth_deleted = cursor.rowcount
+        # Delete from radcheck, radreply, radusergroup and radpostauth
+        deleted = submit_write('delete_voucher', {'username': username})
+        radcheck_deleted = deleted['radcheck']
+        radreply_deleted = deleted['radreply']
+        radusergroup_deleted = deleted['radusergroup']
+        radpostauth_deleted = deleted['radpostauth']
         
-        conn.commit()
-        conn.close()
-        
-        if radcheck_deleted == 0 and radreply_deleted == 0:
+        if radcheck_deleted == 0 and radreply_deleted == 0 and radusergroup_deleted == 0:
             logger.warning(f"Voucher not found: {username}")
             return jsonify({
                 'success': False,
@@ -337,6 +769,7 @@ def delete_voucher():
             'deleted': {
                 'radcheck': radcheck_deleted,
                 'radreply': radreply_deleted,
+                'radusergroup': radusergroup_deleted,
                 'radpostauth': radpostauth_deleted
             }
         }), 200
@@ -351,6 +784,7 @@ def delete_voucher():
 
 @app.route('/toggle/voucher-status', methods=['POST'])
 @require_auth
+@require_primary
 def toggle_voucher_status():
     """
     Enable or disable a voucher in RADIUS database
@@ -391,58 +825,25 @@ def toggle_voucher_status():
         
         logger.info(f"Toggling voucher status: {username} → {status}")
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Check if voucher exists
-        cursor.execute(
-            "SELECT COUNT(*) FROM radcheck WHERE username = ? AND attribute = 'Cleartext-Password'",
-            (username,)
-        )
-        exists = cursor.fetchone()[0] > 0
+        result = submit_write('set_voucher_status', {'username': username, 'status': status})
         
-        if not exists:
-            conn.close()
+        if not result['found']:
             return jsonify({
                 'success': False,
                 'error': 'Voucher not found in RADIUS database'
             }), 404
         
         if status == 'disabled':
-            # Check if Auth-Type Reject already exists
-            cursor.execute(
-                "SELECT COUNT(*) FROM radcheck WHERE username = ? AND attribute = 'Auth-Type' AND value = 'Reject'",
-                (username,)
-            )
-            reject_exists = cursor.fetchone()[0] > 0
-            
-            if not reject_exists:
-                # Add Auth-Type = Reject to disable authentication
-                cursor.execute(
-                    "INSERT INTO radcheck (username, attribute, op, value) VALUES (?, ?, ?, ?)",
-                    (username, 'Auth-Type', ':=', 'Reject')
-                )
-                conn.commit()
+            if result['changed']:
                 logger.info(f"Voucher disabled: {username} (Auth-Type = Reject added)")
             else:
                 logger.info(f"Voucher already disabled: {username}")
         else:
-            # status == 'active'
-            # Remove Auth-Type = Reject to enable authentication
-            cursor.execute(
-                "DELETE FROM radcheck WHERE username = ? AND attribute = 'Auth-Type' AND value = 'Reject'",
-                (username,)
-            )
-            deleted_count = cursor.rowcount
-            conn.commit()
-            
-            if deleted_count > 0:
+            if result['changed']:
                 logger.info(f"Voucher enabled: {username} (Auth-Type = Reject removed)")
             else:
                 logger.info(f"Voucher already enabled: {username}")
         
-        conn.close()
-        
         return jsonify({
             'success': True,
             'message': 'Voucher status updated successfully',
@@ -457,8 +858,105 @@ def toggle_voucher_status():
         }), 500
 
 
+@app.route('/batch/vouchers', methods=['POST'])
+@require_auth
+@require_primary
+def batch_vouchers():
+    """
+    Apply a mixed batch of voucher mutations in a single transaction
+    
+    Expected JSON payload:
+    {
+        "operations": [
+            {"op": "create", "username": "ABC12345", "password": "pass123",
+             "mikrotik_rate_limit": "512k/512k", "nas_identifier": "mikrotik-router-1"},
+            {"op": "delete", "username": "OLD00001"},
+            {"op": "disable", "username": "XYZ98765"},
+            {"op": "enable", "username": "XYZ11111"},
+            {"op": "rebind_mac", "username": "XYZ11111", "mac_address": "AA:BB:CC:DD:EE:FF"}
+        ]
+    }
+    
+    Returns:
+    {
+        "success": true,
+        "succeeded": 5,
+        "failed": 0,
+        "results": [
+            {"index": 0, "op": "create", "username": "ABC12345", "success": true, "changed": true},
+            ...
+        ]
+    }
+    """
+    try:
+        data = request.get_json()
+        
+        if not data or 'operations' not in data:
+            return jsonify({
+                'success': False,
+                'error': 'Missing operations array in request'
+            }), 400
+        
+        operations = data['operations']
+        
+        if not isinstance(operations, list):
+            return jsonify({
+                'success': False,
+                'error': 'operations must be an array'
+            }), 400
+        
+        if len(operations) > BATCH_MAX_OPERATIONS:
+            return jsonify({
+                'success': False,
+                'error': f'Too many operations (max {BATCH_MAX_OPERATIONS})'
+            }), 413
+        
+        if len(operations) == 0:
+            return jsonify({
+                'success': True,
+                'succeeded': 0,
+                'failed': 0,
+                'results': []
+            }), 200
+        
+        logger.info(f"Received batch of {len(operations)} operations from {request.remote_addr}")
+        
+        result = submit_write('apply_mutations', {'operations': operations})
+        
+        if 'database_error' in result:
+            logger.error(f"Database error during batch: {result['database_error']}")
+            return jsonify({
+                'success': False,
+                'error': f"Database error - {result['database_error']}",
+                'succeeded': 0,
+                'failed': result['failed'],
+                'results': result['results']
+            }), 500
+        
+        succeeded = result['succeeded']
+        failed = result['failed']
+        success = failed == 0
+        
+        logger.info(f"Batch completed: {succeeded} succeeded, {failed} failed")
+        
+        return jsonify({
+            'success': success,
+            'succeeded': succeeded,
+            'failed': failed,
+            'results': result['results']
+        }), 200 if success else 207  # 207 Multi-Status for partial success
+        
+    except Exception as e:
+        logger.error(f"Batch endpoint error: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
 @app.route('/sync-mac-bindings', methods=['POST'])
 @require_auth
+@require_primary
 def sync_mac_bindings():
     """
     Sync MAC address bindings from MikroTik to RADIUS database
@@ -474,11 +972,17 @@ def sync_mac_bindings():
         ]
     }
     
+    Bindings are applied with a set-based upsert (one UPDATE of changed
+    rows, one INSERT of missing rows). "synced" counts inserted plus
+    unchanged bindings.
+    
     Returns:
     {
         "success": true,
         "synced": 10,
+        "inserted": 8,
         "updated": 5,
+        "unchanged": 2,
         "failed": 0,
         "errors": []
     }
@@ -505,92 +1009,31 @@ def sync_mac_bindings():
             return jsonify({
                 'success': True,
                 'synced': 0,
+                'inserted': 0,
                 'updated': 0,
+                'unchanged': 0,
                 'failed': 0,
                 'errors': []
             }), 200
         
         logger.info(f"Received MAC binding sync request for {len(bindings)} users from {request.remote_addr}")
         
-        synced = 0  # New records inserted
-        updated = 0  # Existing records updated
-        failed = 0
-        errors = []
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        for binding in bindings:
-            try:
-                # Validate required fields
-                if 'username' not in binding or 'mac_address' not in binding:
-                    raise ValueError("Missing username or mac_address")
-                
-                username = binding['username']
-                mac_address = binding['mac_address']
-                
-                # Check if MAC binding already exists for this user
-                cursor.execute(
-                    "SELECT id, value FROM radcheck WHERE username = ? AND attribute = 'Calling-Station-Id'",
-                    (username,)
-                )
-                existing = cursor.fetchone()
-                
-                if existing:
-                    # Update existing MAC binding
-                    existing_mac = existing['value']
-                    
-                    if existing_mac != mac_address:
-                        cursor.execute(
-                            "UPDATE radcheck SET value = ? WHERE username = ? AND attribute = 'Calling-Station-Id'",
-                            (mac_address, username)
-                        )
-                        updated += 1
-                        logger.info(f"Updated MAC for {username}: {existing_mac} → {mac_address}")
-                    else:
-                        logger.debug(f"MAC binding unchanged for {username}: {mac_address}")
-                        synced += 1  # Count as synced even though no change
-                else:
-                    # Insert new MAC binding
-                    cursor.execute(
-                        "INSERT INTO radcheck (username, attribute, op, value) VALUES (?, ?, ?, ?)",
-                        (username, 'Calling-Station-Id', '==', mac_address)
-                    )
-                    synced += 1
-                    logger.info(f"Added MAC binding for {username}: {mac_address}")
-                
-            except ValueError as e:
-                failed += 1
-                error_msg = f"{binding.get('username', 'unknown')}: {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"Validation error: {error_msg}")
-                
-            except sqlite3.Error as e:
-                failed += 1
-                error_msg = f"{username}: Database error - {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"Database error for {username}: {e}")
-                
-            except Exception as e:
-                failed += 1
-                error_msg = f"{binding.get('username', 'unknown')}: {str(e)}"
-                errors.append(error_msg)
-                logger.error(f"Unexpected error: {error_msg}")
-        
-        # Commit all changes
-        conn.commit()
-        conn.close()
+        result = submit_write('sync_mac_bindings', {'bindings': bindings})
         
+        failed = result['failed']
         success = failed == 0
         
-        logger.info(f"MAC binding sync completed: {synced} new, {updated} updated, {failed} failed")
+        logger.info(f"MAC binding sync completed: {result['inserted']} new, {result['updated']} updated, "
+                    f"{result['unchanged']} unchanged, {failed} failed")
         
         return jsonify({
             'success': success,
-            'synced': synced,
-            'updated': updated,
+            'synced': result['synced'],
+            'inserted': result['inserted'],
+            'updated': result['updated'],
+            'unchanged': result['unchanged'],
             'failed': failed,
-            'errors': errors
+            'errors': result['errors']
         }), 200 if success else 207  # 207 Multi-Status for partial success
         
     except Exception as e:
@@ -601,41 +1044,435 @@ def sync_mac_bindings():
         }), 500
 
 
-@app.route('/stats', methods=['GET'])
-@require_auth
-def get_stats():
-    """Get RADIUS database statistics"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+def require_rest_auth(f):
+    """Decorator for rlm_rest calls: Bearer token or HTTP Basic auth with the token as password"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth_header = request.headers.get('Authorization', '')
+        token = ''
         
-        # Count unique users
-        cursor.execute("SELECT COUNT(DISTINCT username) FROM radcheck WHERE attribute = 'Cleartext-Password'")
-        total_users = cursor.fetchone()[0]
+        if auth_header.startswith('Bearer '):
+            token = auth_header.replace('Bearer ', '', 1)
+        elif auth_header.startswith('Basic '):
+            try:
+                token = base64.b64decode(auth_header[6:]).decode('utf-8').partition(':')[2]
+            except ValueError:
+                token = ''
         
-        # Count MAC bindings
-        cursor.execute("SELECT COUNT(*) FROM radcheck WHERE attribute = 'Calling-Station-Id'")
-        mac_bindings_count = cursor.fetchone()[0]
+        if not token or not hmac.compare_digest(token.encode('utf-8'), AUTH_TOKEN.encode('utf-8')):
+            logger.warning(f"Invalid authorize credentials from {request.remote_addr}")
+            return jsonify({'error': 'Invalid authentication token'}), 401
+        
+        return f(*args, **kwargs)
+    
+    return decorated_function
+
+
+def request_attributes(data):
+    """
+    Flatten an rlm_rest JSON body to attribute name -> first value
+    
+    Accepts rlm_rest's format ({"User-Name": {"type": "string", "value": ["x"]}})
+    as well as plain {"User-Name": "x"}.
+    """
+    attributes = {}
+    
+    for name, item in (data or {}).items():
+        if isinstance(item, dict):
+            item = item.get('value')
+        if isinstance(item, list):
+            item = item[0] if item else None
+        if item is not None:
+            attributes[name] = str(item)
+    
+    return attributes
+
+
+@app.route('/authorize', methods=['POST'])
+@require_rest_auth
+def authorize():
+    """
+    FreeRADIUS rlm_rest authorize
+    
+    Answers from the in-memory authorize index instead of SQLite. Check
+    items are evaluated like rlm_sql's authorize_check_query: ":=" items go
+    to the control list (Cleartext-Password, Auth-Type), "==" items
+    (NAS-Identifier, Calling-Station-Id) must match the request.
+    
+    Returns (rlm_rest maps the status to a module return code):
+    - 200 with control/reply attributes ("updated")
+    - 404 if the user is unknown or a check item did not match ("notfound")
+    - 503 while the index is loading, 500 for an unsupported check operator
+      ("fail", so the site config can fall back to SQL)
+    """
+    index = get_authorize_index()
+    
+    if index is None:
+        return jsonify({'error': 'Authorize index is disabled'}), 404
+    
+    if not index.loaded:
+        return jsonify({'error': 'Authorize index is loading'}), 503
+    
+    attributes = request_attributes(request.get_json(silent=True))
+    username = attributes.get('User-Name')
+    
+    if not username:
+        return jsonify({'error': 'Missing User-Name'}), 400
+    
+    try:
+        response = index.authorize(username, attributes)
+    except UnsupportedOperator as e:
+        logger.warning(f"Authorize index cannot evaluate check item for {username}: {e}")
+        return jsonify({'error': f'Unsupported check item: {e}'}), 500
+    
+    if response is None:
+        return jsonify({}), 404
+    
+    return jsonify(response), 200
+
+
+def query_int(name, default, minimum, maximum):
+    """Integer query parameter clamped to a range, or None if it is not a number"""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return min(max(int(value), minimum), maximum)
+    except ValueError:
+        return None
+
+
+@app.route('/changes', methods=['GET'])
+@require_auth
+def get_changes():
+    """
+    Replication change log page
+    
+    Query parameters: since (sequence number of the last change the caller
+    applied, required), limit (default and max 5000; the page is also capped
+    at [replication] changes_max_bytes of payload).
+    
+    Returns:
+    {
+        "success": true,
+        "cursor": 1042,
+        "latest": 1042,
+        "has_more": false,
+        "reset": false,
+        "changes": [
+            {"seq": 1041, "op": "insert_vouchers", "created_at": 1760000000, "payload": {...}}
+        ]
+    }
+    
+    "reset": true means changes after `since` were already trimmed (or the
+    caller is ahead of this log), the caller has to copy /changes/snapshot.
+    """
+    if not CHANGELOG_ENABLED:
+        return jsonify({
+            'success': False,
+            'error': 'Change log is disabled ([replication] changelog)'
+        }), 404
+    
+    since = query_int('since', None, 0, 2 ** 63 - 1)
+    limit = query_int('limit', CHANGES_MAX_LIMIT, 1, CHANGES_MAX_LIMIT)
+    
+    if since is None or limit is None:
+        return jsonify({
+            'success': False,
+            'error': 'since (required) and limit must be integers'
+        }), 400
+    
+    try:
+        with db_pool.connection() as conn:
+            page = change_log.read_changes(conn, since, limit, CHANGES_MAX_BYTES)
         
-        # Count total records
-        cursor.execute("SELECT COUNT(*) FROM radcheck")
-        radcheck_count = cursor.fetchone()[0]
+        # Payloads are stored as JSON text and passed through without decoding
+        changes = ','.join(
+            '{"seq":%d,"op":%s,"created_at":%d,"payload":%s}' % (seq, json.dumps(op), created_at, payload)
+            for seq, op, payload, created_at in page['changes']
+        )
+        body = '{"success":true,"cursor":%d,"latest":%d,"has_more":%s,"reset":%s,"changes":[%s]}' % (
+            page['cursor'],
+            page['latest'],
+            json.dumps(page['has_more']),
+            json.dumps(page['reset']),
+            changes
+        )
         
-        cursor.execute("SELECT COUNT(*) FROM radreply")
-        radreply_count = cursor.fetchone()[0]
+        return Response(body, mimetype='application/json')
+    except Exception as e:
+        logger.error(f"Change log read failed: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/changes/snapshot', methods=['GET'])
+@require_auth
+def get_changes_snapshot():
+    """
+    Keyset page of the voucher set (radcheck / radreply / radusergroup rows)
+    for a follower that starts replicating or was reset
+    
+    Query parameters: after (last username of the previous page, empty for
+    the first page), limit (usernames per page, default 5000, max 20000).
+    
+    Returns:
+    {
+        "success": true,
+        "seq": 1042,
+        "after": "",
+        "until": "ABC12345",
+        "radcheck": [["ABC12345", "Cleartext-Password", ":=", "pass123"], ...],
+        "radreply": [["ABC12345", "Mikrotik-Rate-Limit", ":=", "512k/512k"], ...],
+        "radusergroup": [["ABC12346", "radtik-rl-3f1c0e9a2b7d", 0], ...],
+        "profiles": [["radtik-rl-3f1c0e9a2b7d", "Mikrotik-Rate-Limit", ":=", "1M/1M"], ...]
+    }
+    
+    "until" is null on the last page. The follower replays /changes from the
+    "seq" of its first page once all pages are copied.
+    """
+    if not CHANGELOG_ENABLED:
+        return jsonify({
+            'success': False,
+            'error': 'Change log is disabled ([replication] changelog)'
+        }), 404
+    
+    limit = query_int('limit', 5000, 1, SNAPSHOT_MAX_LIMIT)
+    if limit is None:
+        return jsonify({
+            'success': False,
+            'error': 'limit must be an integer'
+        }), 400
+    
+    try:
+        with db_pool.connection() as conn:
+            page = change_log.read_snapshot(conn, request.args.get('after', ''), limit)
         
-        # Get NAS identifiers
-        cursor.execute("SELECT DISTINCT value FROM radcheck WHERE attribute = 'NAS-Identifier'")
-        nas_identifiers = [row[0] for row in cursor.fetchall()]
+        return jsonify(dict(page, success=True)), 200
+    except Exception as e:
+        logger.error(f"Snapshot read failed: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+def archive_query(query, **filters):
+    """Run an archive query with the after / limit keyset parameters of the request"""
+    archive = get_postauth_archive()
+    if archive is None:
+        return jsonify({
+            'success': False,
+            'error': _archive['error']
+        }), 404
+    
+    after = query_int('after', 0, 0, 2 ** 63 - 1)
+    limit = query_int('limit', 1000, 1, ARCHIVE_MAX_LIMIT)
+    if after is None or limit is None:
+        return jsonify({
+            'success': False,
+            'error': 'after and limit must be integers'
+        }), 400
+    
+    try:
+        page = query(archive, after=after, limit=limit, **filters)
+        return jsonify(dict(page, success=True, mode=archive.mode)), 200
+    except Exception as e:
+        logger.error(f"Archive query failed: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/archive/postauth', methods=['GET'])
+@require_auth
+def get_archived_postauth():
+    """
+    Archived authentication attempts (radpostauth rows moved out of
+    radius.db by archive-postauth.py), in id order
+    
+    Query parameters: username, reply, since / until (authdate range,
+    'YYYY-MM-DD[ HH:MM:SS]', until exclusive), after (cursor of the previous
+    page), limit (default 1000, max 10000). Always empty in [archive]
+    mode = summary.
+    
+    Returns:
+    {
+        "success": true,
+        "mode": "archive",
+        "rows": [{"id": 1201, "username": "ABC12345", "reply": "Access-Accept",
+                  "authdate": "2026-02-10 08:15:02.117", "class": null,
+                  "calling_station_id": "AA:BB:CC:DD:EE:FF", "nas_identifier": "mikrotik-router-1"}, ...],
+        "cursor": 1201,
+        "has_more": false
+    }
+    """
+    return archive_query(
+        lambda archive, **kwargs: archive.query_rows(**kwargs),
+        username=request.args.get('username'),
+        reply=request.args.get('reply'),
+        since=request.args.get('since'),
+        until=request.args.get('until')
+    )
+
+
+@app.route('/archive/postauth/daily', methods=['GET'])
+@require_auth
+def get_archived_postauth_daily():
+    """
+    Authentication attempts per day, username, NAS and reply for the
+    archived period
+    
+    Query parameters: username, nas_identifier, since / until (day,
+    'YYYY-MM-DD', until exclusive), after, limit (default 1000, max 10000).
+    
+    Returns:
+    {
+        "success": true,
+        "mode": "summary",
+        "rows": [{"id": 88, "day": "2026-02-10", "username": "ABC12345",
+                  "nas_identifier": "mikrotik-router-1", "reply": "Access-Accept",
+                  "attempts": 3, "first_at": "2026-02-10 08:15:02.117",
+                  "last_at": "2026-02-10 19:40:11.502"}, ...],
+        "cursor": 88,
+        "has_more": false
+    }
+    """
+    return archive_query(
+        lambda archive, **kwargs: archive.query_daily(**kwargs),
+        username=request.args.get('username'),
+        nas_identifier=request.args.get('nas_identifier'),
+        since=request.args.get('since'),
+        until=request.args.get('until')
+    )
+
+
+def usage_query(table):
+    """Page of a usage rollup table after the request's cursor"""
+    after = query_int('after', 0, 0, 2 ** 63 - 1)
+    limit = query_int('limit', 1000, 1, USAGE_MAX_LIMIT)
+    if after is None or limit is None:
+        return jsonify({
+            'success': False,
+            'error': 'after and limit must be integers'
+        }), 400
+    
+    try:
+        with db_pool.connection() as conn:
+            page = usage_rollup.read_usage(conn, table, after, limit)
         
-        conn.close()
+        return jsonify(dict(page, success=True)), 200
+    except Exception as e:
+        logger.error(f"Usage read failed: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/usage/daily', methods=['GET'])
+@require_auth
+def get_usage_daily():
+    """
+    Daily usage per username and NAS (closed radacct sessions, rolled up by
+    rollup-usage.py), rows inserted or updated after a cursor
+    
+    Query parameters: after (cursor of the previous page, 0 for everything),
+    limit (default 1000, max 10000).
+    
+    Returns:
+    {
+        "success": true,
+        "rows": [{"seq": 5120, "day": "2026-02-10", "username": "ABC12345",
+                  "nasipaddress": "10.0.0.1", "sessions": 2, "session_time": 5400,
+                  "input_octets": 104857600, "output_octets": 9437184}, ...],
+        "cursor": 5120,
+        "latest": 5121,
+        "has_more": false,
+        "reset": false
+    }
+    
+    Rows are totals, not deltas: upsert them by (day, username, nasipaddress).
+    "reset" means the cursor is ahead of this server; start again from 0.
+    """
+    return usage_query('radtik_usage_daily')
+
+
+@app.route('/usage/nas', methods=['GET'])
+@require_auth
+def get_usage_nas():
+    """
+    Daily usage per NAS (users, sessions, session time and octets), rows
+    inserted or updated after a cursor; same parameters and response as
+    /usage/daily, upsert by (day, nasipaddress)
+    """
+    return usage_query('radtik_usage_nas_daily')
+
+
+def replication_status():
+    """Role of this server and its change log / follower position"""
+    if FOLLOWER:
+        with db_pool.connection() as conn:
+            return dict(change_log.follower_status(conn), role='follower')
+    
+    if CHANGELOG_ENABLED:
+        with db_pool.connection() as conn:
+            return {'role': 'primary', 'latest': change_log.latest_seq(conn)}
+    
+    return {'role': 'standalone'}
+
+
+def rate_limit_profiles():
+    """Rate-limit profile mode and number of profiles (radgroupreply is tiny)"""
+    with db_pool.connection() as conn:
+        return {
+            'enabled': radius_store.profiles_enabled(conn),
+            'profiles': conn.execute(
+                "SELECT COUNT(DISTINCT groupname) FROM radgroupreply WHERE groupname LIKE ?",
+                (radius_store.PROFILE_PREFIX + '%',)
+            ).fetchone()[0],
+        }
+
+
+def usage_status():
+    """Sessions waiting for rollup-usage.py and the usage export position"""
+    with db_pool.connection() as conn:
+        return usage_rollup.usage_status(conn)
+
+
+@app.route('/stats', methods=['GET'])
+@require_auth
+def get_stats():
+    """
+    Get RADIUS database statistics
+    
+    Counts come from the trigger-maintained summary tables (O(1)) and are
+    cached for [api] stats_cache_ttl seconds per worker.
+    """
+    try:
+        stats = stats_cache.get()
+        archive = get_postauth_archive()
         
         return jsonify({
-            'total_users': total_users,
-            'mac_bindings': mac_bindings_count,
-            'radcheck_records': radcheck_count,
-            'radreply_records': radreply_count,
-            'nas_identifiers': nas_identifiers,
+            'total_users': stats['total_users'],
+            'disabled_vouchers': stats['disabled_vouchers'],
+            'mac_bindings': stats['mac_bindings'],
+            'radcheck_records': stats['radcheck_records'],
+            'radreply_records': stats['radreply_records'],
+            'rate_limit_profiles': rate_limit_profiles(),
+            'nas_identifiers': list(stats['nas']),
+            'nas': stats['nas'],
+            'counters_source': stats['source'],
+            'generated_at': stats['generated_at'],
+            'connection_pool': db_pool.stats(),
+            'writer': writer.stats(),
+            'authorize_index': _authorize['index'].stats() if _authorize['index'] is not None else None,
+            'replication': replication_status(),
+            'postauth_archive': archive.stats() if archive is not None else None,
+            'usage_rollup': usage_status(),
             'timestamp': datetime.now().isoformat()
         }), 200
         
@@ -647,6 +1484,29 @@ def get_stats():
         }), 500
 
 
+@app.route('/metrics', methods=['GET'])
+@require_auth
+def get_metrics():
+    """
+    Prometheus metrics (text exposition format), aggregated across all
+    gunicorn workers
+    """
+    if metrics_exporter is None:
+        return jsonify({
+            'success': False,
+            'error': 'Metrics are disabled'
+        }), 404
+    
+    try:
+        return Response(metrics_exporter.render(), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        logger.error(f"Metrics endpoint error: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
 @app.errorhandler(404)
 def not_found(e):
     """Handle 404 errors"""
@@ -654,10 +1514,22 @@ def not_found(e):
         'error': 'Endpoint not found',
         'available_endpoints': [
             'GET /health',
+            'GET /health/deep',
             'POST /sync/vouchers',
+            'POST /sync/vouchers/stream',
+            'GET /jobs/<job_id>',
+            'POST /batch/vouchers',
             'POST /sync-mac-bindings',
             'DELETE /delete/voucher',
-            'GET /stats'
+            'GET /stats',
+            'GET /metrics',
+            'POST /authorize',
+            'GET /changes?since=<seq>',
+            'GET /changes/snapshot',
+            'GET /archive/postauth',
+            'GET /archive/postauth/daily',
+            'GET /usage/daily?after=<seq>',
+            'GET /usage/nas?after=<seq>'
         ]
     }), 404
 
@@ -666,6 +1538,7 @@ def not_found(e):
 def internal_error(e):
     """Handle 500 errors"""
     logger.error(f"Internal server error: {e}")
+    metrics.inc('radtik_errors_total', type=type(getattr(e, 'original_exception', None) or e).__name__)
     return jsonify({
         'error': 'Internal server error',
         'message': str(e)
@@ -681,11 +1554,23 @@ def main():
     logger.info(f"Listening on: {API_HOST}:{API_PORT}")
     logger.info(f"Debug mode: {DEBUG_MODE}")
     logger.info("Endpoints:")
-    logger.info("  - GET  /health              (Health check)")
+    logger.info("  - GET  /health              (Liveness check)")
+    logger.info("  - GET  /health/deep         (Deep health check)")
     logger.info("  - POST /sync/vouchers       (Sync vouchers)")
+    logger.info("  - POST /sync/vouchers/stream (Stream vouchers as NDJSON)")
+    logger.info("  - GET  /jobs/<job_id>       (Async sync job progress)")
+    logger.info("  - POST /batch/vouchers      (Mixed mutation batch)")
     logger.info("  - POST /sync-mac-bindings   (Sync MAC bindings)")
     logger.info("  - DELETE /delete/voucher    (Delete voucher)")
     logger.info("  - GET  /stats               (Database stats)")
+    logger.info("  - GET  /metrics             (Prometheus metrics)")
+    logger.info("  - POST /authorize           (rlm_rest authorize, in-memory index)")
+    logger.info("  - GET  /changes             (Replication change log)")
+    logger.info("  - GET  /changes/snapshot    (Replication snapshot)")
+    logger.info("  - GET  /archive/postauth    (Archived authentication attempts)")
+    logger.info("  - GET  /archive/postauth/daily (Daily authentication summaries)")
+    logger.info("  - GET  /usage/daily         (Daily usage per username and NAS)")
+    logger.info("  - GET  /usage/nas           (Daily usage per NAS)")
     logger.info("=" * 60)
     
     # Run Flask app
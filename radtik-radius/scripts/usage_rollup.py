@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+RadTik Usage Rollup
+Daily data usage per username / NAS and per NAS, aggregated incrementally
+from FreeRADIUS's radacct table so Laravel never has to scan raw sessions.
+
+A session is counted once, when it is closed: triggers (migration 8) add
+its radacctid to radtik_acct_closed when acctstoptime is set (Stop,
+Accounting-On/Off, or a Stop without a Start). rollup() reads that queue in
+order, adds the sessions to the rollup rows of the day they ended and
+deletes the consumed entries, all in the caller's transaction - the queue
+itself is the watermark, so a session is never counted twice and radacct is
+never rescanned. Open sessions (interim updates) are not counted until they
+close.
+
+Rollup tables:
+- radtik_usage_daily: day, username, nasipaddress, sessions, session_time,
+  input_octets, output_octets
+- radtik_usage_nas_daily: day, nasipaddress, users, sessions, session_time,
+  input_octets, output_octets
+
+Every inserted or updated row gets the next value of one export sequence
+('usage.seq' in radtik_sync_state), so GET /usage/daily?after=<seq> returns
+only rows that changed since the caller's cursor. A row that changes again
+moves to the end of the sequence with its new totals; the caller upserts by
+(day, username, nasipaddress) / (day, nasipaddress).
+"""
+
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import radius_store
+
+logger = logging.getLogger('usage-rollup')
+
+# Export sequence, last value assigned (radtik_sync_state)
+SEQ_KEY = 'usage.seq'
+
+# Exported tables and their columns, in response order
+USAGE_TABLES = {
+    'radtik_usage_daily': ('seq', 'day', 'username', 'nasipaddress', 'sessions', 'session_time',
+                           'input_octets', 'output_octets'),
+    'radtik_usage_nas_daily': ('seq', 'day', 'nasipaddress', 'users', 'sessions', 'session_time',
+                               'input_octets', 'output_octets'),
+}
+
+
+def session_day(stop) -> Optional[str]:
+    """
+    Day ('YYYY-MM-DD', local time) a session ended
+
+    The stock SQLite queries store acctstoptime as unix time; a datetime
+    text value (other query sets) is used as is.
+    """
+    if stop is None:
+        return None
+    if isinstance(stop, (int, float)) or str(stop).isdigit():
+        return datetime.fromtimestamp(int(stop)).strftime('%Y-%m-%d')
+    return str(stop)[:10]
+
+
+def latest_seq(conn: sqlite3.Connection) -> int:
+    """Highest export sequence number assigned so far"""
+    return int(radius_store.get_state(conn, SEQ_KEY, '0'))
+
+
+def rollup(conn: sqlite3.Connection, batch_size: int) -> Dict:
+    """
+    Roll up the next batch of closed sessions (not committed here)
+
+    Args:
+        conn: Open database connection, inside a write transaction
+        batch_size: Maximum number of queued sessions to consume
+
+    Returns:
+        Dictionary with 'sessions' (rolled up), 'skipped' (deleted from
+        radacct before the rollup, or without a stop time) and 'rows'
+        (rollup rows inserted or updated); all 0 when the queue is empty
+    """
+    queued = conn.execute("""
+        SELECT q.seq, a.username, a.nasipaddress, a.acctstoptime, a.acctsessiontime,
+               a.acctinputoctets, a.acctoutputoctets
+        FROM radtik_acct_closed q LEFT JOIN radacct a ON a.radacctid = q.radacctid
+        ORDER BY q.seq LIMIT ?
+    """, (batch_size,)).fetchall()
+
+    result = {'sessions': 0, 'skipped': 0, 'rows': 0}
+    if not queued:
+        return result
+
+    # (day, username, nasipaddress) -> [sessions, session_time, input_octets, output_octets]
+    users: Dict = {}
+    for _, username, nas, stop, session_time, input_octets, output_octets in queued:
+        day = session_day(stop)
+        if username is None or day is None:
+            result['skipped'] += 1
+            continue
+
+        totals = users.setdefault((day, username, nas or ''), [0, 0, 0, 0])
+        totals[0] += 1
+        totals[1] += max(0, session_time or 0)
+        totals[2] += max(0, input_octets or 0)
+        totals[3] += max(0, output_octets or 0)
+        result['sessions'] += 1
+
+    seq = latest_seq(conn)
+
+    # (day, nasipaddress) -> [new users, sessions, session_time, input_octets, output_octets]
+    nas_totals: Dict = {}
+    for key, totals in users.items():
+        seq += 1
+        existing = conn.execute(
+            "SELECT id FROM radtik_usage_daily WHERE day = ? AND username = ? AND nasipaddress = ?", key
+        ).fetchone()
+
+        if existing is None:
+            conn.execute("""
+                INSERT INTO radtik_usage_daily
+                    (day, username, nasipaddress, sessions, session_time, input_octets, output_octets, seq)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (*key, *totals, seq))
+        else:
+            conn.execute("""
+                UPDATE radtik_usage_daily
+                SET sessions = sessions + ?, session_time = session_time + ?,
+                    input_octets = input_octets + ?, output_octets = output_octets + ?, seq = ?
+                WHERE id = ?
+            """, (*totals, seq, existing[0]))
+
+        nas = nas_totals.setdefault((key[0], key[2]), [0, 0, 0, 0, 0])
+        nas[0] += existing is None
+        for i, value in enumerate(totals):
+            nas[i + 1] += value
+
+    for key, totals in nas_totals.items():
+        seq += 1
+        conn.execute("""
+            INSERT INTO radtik_usage_nas_daily
+                (day, nasipaddress, users, sessions, session_time, input_octets, output_octets, seq)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (day, nasipaddress) DO UPDATE SET
+                users = users + excluded.users,
+                sessions = sessions + excluded.sessions,
+                session_time = session_time + excluded.session_time,
+                input_octets = input_octets + excluded.input_octets,
+                output_octets = output_octets + excluded.output_octets,
+                seq = excluded.seq
+        """, (*key, *totals, seq))
+
+    radius_store.set_state(conn, SEQ_KEY, seq)
+    conn.execute("DELETE FROM radtik_acct_closed WHERE seq <= ?", (queued[-1][0],))
+    result['rows'] = len(users) + len(nas_totals)
+
+    return result
+
+
+def prune(conn: sqlite3.Connection, retention_days: float, now: Optional[datetime] = None) -> int:
+    """
+    Delete rollup rows of days older than the retention (not committed here)
+
+    Laravel keeps the rows it already pulled; pruned rows are not exported
+    as deletions.
+
+    Returns:
+        Number of rows deleted
+    """
+    if retention_days <= 0:
+        return 0
+
+    cutoff = ((now or datetime.now()) - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+
+    return sum(
+        conn.execute(f"DELETE FROM {table} WHERE day < ?", (cutoff,)).rowcount
+        for table in USAGE_TABLES
+    )
+
+
+def read_usage(conn: sqlite3.Connection, table: str, after: int, limit: int) -> Dict:
+    """
+    Read rollup rows inserted or updated after a cursor
+
+    Args:
+        conn: Open database connection
+        table: 'radtik_usage_daily' or 'radtik_usage_nas_daily'
+        after: Export sequence number of the last row the caller stored
+        limit: Maximum number of rows
+
+    Returns:
+        Dictionary with 'rows', 'cursor', 'latest', 'has_more' and 'reset'
+        (the cursor is ahead of this server's sequence, e.g. after a
+        reinstall: start again from 0)
+    """
+    columns = USAGE_TABLES[table]
+
+    # One read transaction: latest and the page are consistent
+    conn.execute("BEGIN")
+    try:
+        latest = latest_seq(conn)
+        rows = conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE seq > ? ORDER BY seq LIMIT ?",
+            (after, limit + 1)
+        ).fetchall()
+    finally:
+        conn.rollback()
+
+    if after > latest:
+        return {'rows': [], 'cursor': after, 'latest': latest, 'has_more': False, 'reset': True}
+
+    has_more = len(rows) > limit
+    rows = [dict(zip(columns, row)) for row in rows[:limit]]
+
+    return {
+        'rows': rows,
+        'cursor': rows[-1]['seq'] if rows else after,
+        'latest': latest,
+        'has_more': has_more,
+        'reset': False,
+    }
+
+
+def usage_status(conn: sqlite3.Connection) -> Dict:
+    """Rollup backlog and export position (for /stats and rollup-usage.py --status)"""
+    # The queue is only ever consumed from the front, so its seq range is its size
+    first, last = conn.execute("SELECT MIN(seq), MAX(seq) FROM radtik_acct_closed").fetchone()
+
+    return {
+        'pending_sessions': last - first + 1 if first is not None else 0,
+        'latest_seq': latest_seq(conn),
+    }
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+RadTik Voucher Digests
+Bucketed, order-independent digests of a set of usernames, used to find
+which part of the voucher set differs between RADIUS and Laravel without
+sending every username.
+
+Each username is hashed with md5. The first 8 hex digits (mod the bucket
+count) select its bucket, the next 8 are summed (mod 2^32) and the
+following 8 are XORed into that bucket. A bucket digest is
+"count:<sum><xor>" and the root digest is the md5 of all bucket digests
+joined by newlines.
+
+The same scheme is implemented by Laravel's
+RadiusVoucherVerificationController::digests() - keep both in sync.
+"""
+
+import hashlib
+from typing import Iterable, List, Set
+
+
+def username_hash(username: str):
+    """(bucket hash, sum part, xor part) of a username"""
+    digest = hashlib.md5(str(username).encode('utf-8')).hexdigest()
+    return int(digest[0:8], 16), int(digest[8:16], 16), int(digest[16:24], 16)
+
+
+def bucket_of(username: str, buckets: int) -> int:
+    return username_hash(username)[0] % buckets
+
+
+class BucketDigests:
+    """Incrementally built digests of a username set"""
+
+    def __init__(self, buckets: int):
+        self.buckets = buckets
+        self._counts = [0] * buckets
+        self._sums = [0] * buckets
+        self._xors = [0] * buckets
+
+    def add(self, username: str):
+        bucket_hash, sum_part, xor_part = username_hash(username)
+        bucket = bucket_hash % self.buckets
+        self._counts[bucket] += 1
+        self._sums[bucket] = (self._sums[bucket] + sum_part) & 0xFFFFFFFF
+        self._xors[bucket] ^= xor_part
+
+    def update(self, usernames: Iterable[str]):
+        for username in usernames:
+            self.add(username)
+
+    @property
+    def total(self) -> int:
+        return sum(self._counts)
+
+    def digests(self) -> List[str]:
+        return [
+            f"{count}:{total:08x}{xor:08x}"
+            for count, total, xor in zip(self._counts, self._sums, self._xors)
+        ]
+
+    def root(self) -> str:
+        return hashlib.md5('\n'.join(self.digests()).encode('ascii')).hexdigest()
+
+    def differing(self, remote: List[str]) -> Set[int]:
+        """Buckets whose digest differs from the remote list"""
+        if len(remote) != self.buckets:
+            return set(range(self.buckets))
+        return {bucket for bucket, (local, other) in enumerate(zip(self.digests(), remote)) if local != other}
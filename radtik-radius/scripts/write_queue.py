@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+"""
+RadTik Single-Writer Queue
+Funnels every RADIUS database mutation from all API workers through one
+writer thread that coalesces them into group commits.
+
+How it works:
+1. The first gunicorn worker to take the writer lock file becomes the leader.
+   It runs the writer thread and listens on a Unix socket.
+2. Other workers send mutations (operation name + JSON payload) to the
+   leader over the socket and block until their own result comes back.
+3. The writer collects jobs for up to `max_delay_ms`, applies them inside a
+   single BEGIN IMMEDIATE transaction (one SAVEPOINT per job so a failing job
+   does not affect the others) and commits once.
+
+If the leader dies, its lock is released by the kernel and the next worker
+that fails to reach the socket takes over. If no writer can be reached at all,
+the mutation is applied directly so the API keeps working. Only a mutation
+that was never delivered is re-routed: once it has been sent, a missing
+reply (leader died or exceeded [writer] timeout) raises WriteError, since the
+leader may already have committed it.
+
+With [replication] changelog = true every job that changed something is
+also appended to radtik_changes inside its savepoint (see change_log.py).
+"""
+
+import fcntl
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import change_log
+import metrics
+import radius_store
+from db_pool import pool_from_config
+
+logger = logging.getLogger('write-queue')
+
+# Mutations the writer can apply: name -> function(conn, payload) -> dict
+OPERATIONS: Dict[str, Callable] = {
+    'insert_vouchers': lambda conn, p: radius_store.insert_vouchers(conn, p['vouchers']),
+    'delete_voucher': lambda conn, p: radius_store.delete_voucher(conn, p['username']),
+    'set_voucher_status': lambda conn, p: radius_store.set_voucher_status(conn, p['username'], p['status']),
+    'sync_mac_bindings': lambda conn, p: radius_store.sync_mac_bindings(conn, p['bindings']),
+    'apply_mutations': lambda conn, p: radius_store.apply_mutations(conn, p['operations']),
+    # Logged by cleanup-orphaned.py, applied by replication followers
+    'delete_vouchers': lambda conn, p: radius_store.delete_vouchers(conn, p['usernames']),
+}
+
+_HEADER = struct.Struct('!I')
+
+
+class WriteError(Exception):
+    """Raised when a mutation could not be applied"""
+
+
+class _Job:
+    """A single queued mutation and its result slot"""
+
+    __slots__ = ('op', 'payload', 'done', 'result', 'error')
+
+    def __init__(self, op: str, payload: Dict):
+        self.op = op
+        self.payload = payload
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _is_busy(error: Exception) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+def has_changes(op: str, result) -> bool:
+    """Whether a successful operation changed any row (and needs to be replicated)"""
+    if op == 'insert_vouchers':
+        return result['synced'] > 0
+    if op == 'delete_voucher':
+        return result['radcheck'] > 0 or result['radreply'] > 0 or result['radusergroup'] > 0
+    if op == 'set_voucher_status':
+        return result['changed']
+    if op == 'sync_mac_bindings':
+        return result['inserted'] + result['updated'] > 0
+    if op == 'apply_mutations':
+        return any(item['success'] and item['changed'] for item in result['results'])
+    if op == 'delete_vouchers':
+        return result['vouchers'] > 0
+    return True
+
+
+def _record_written(jobs: List[_Job]):
+    """Count rows changed by a committed batch"""
+    for job in jobs:
+        result = job.result
+        if job.error or not isinstance(result, dict) or 'database_error' in result:
+            continue
+
+        if job.op == 'insert_vouchers':
+            metrics.inc('radtik_vouchers_written_total', result['synced'], op='create')
+        elif job.op == 'delete_voucher':
+            if result['radcheck']:
+                metrics.inc('radtik_vouchers_written_total', op='delete')
+        elif job.op == 'set_voucher_status':
+            if result['changed']:
+                op = 'disable' if job.payload['status'] == 'disabled' else 'enable'
+                metrics.inc('radtik_vouchers_written_total', op=op)
+        elif job.op == 'sync_mac_bindings':
+            metrics.inc('radtik_mac_bindings_written_total', result['inserted'] + result['updated'])
+        elif job.op == 'apply_mutations':
+            for item in result['results']:
+                if not (item['success'] and item['changed']):
+                    continue
+                if item['op'] == 'rebind_mac':
+                    metrics.inc('radtik_mac_bindings_written_total')
+                else:
+                    metrics.inc('radtik_vouchers_written_total', op=item['op'])
+
+
+def apply_batch(conn: sqlite3.Connection, jobs: List[_Job], changelog: bool = False):
+    """
+    Apply a batch of jobs in one transaction and fill in their results
+
+    The connection must be in autocommit mode (isolation_level=None) so the
+    transaction and savepoints are controlled explicitly here.
+
+    Args:
+        conn: Connection in autocommit mode
+        jobs: Jobs to apply, in order
+        changelog: Append jobs that changed rows to the replication change log
+    """
+    metrics.observe('radtik_writer_batch_size', len(jobs))
+
+    started = time.monotonic()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.Error as e:
+        metrics.inc('radtik_errors_total', type='begin_failed')
+        if _is_busy(e):
+            metrics.inc('radtik_sqlite_busy_total')
+        raise
+    metrics.observe('radtik_sqlite_lock_wait_seconds', time.monotonic() - started)
+
+    try:
+        for index, job in enumerate(jobs):
+            savepoint = f"job_{index}"
+            conn.execute(f"SAVEPOINT {savepoint}")
+            try:
+                result = OPERATIONS[job.op](conn, job.payload)
+            except Exception as e:
+                conn.execute(f"ROLLBACK TO {savepoint}")
+                job.error = f"{type(e).__name__}: {e}"
+                metrics.inc('radtik_errors_total', type=type(e).__name__)
+                if _is_busy(e):
+                    metrics.inc('radtik_sqlite_busy_total')
+            else:
+                if isinstance(result, dict) and 'database_error' in result:
+                    conn.execute(f"ROLLBACK TO {savepoint}")
+                    metrics.inc('radtik_errors_total', type='database_error')
+                elif changelog and has_changes(job.op, result):
+                    change_log.record(conn, job.op, job.payload)
+                job.result = result
+            conn.execute(f"RELEASE {savepoint}")
+
+        started = time.monotonic()
+        conn.execute("COMMIT")
+        metrics.observe('radtik_sqlite_commit_duration_seconds', time.monotonic() - started)
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        metrics.inc('radtik_errors_total', type='commit_failed')
+        if _is_busy(e):
+            metrics.inc('radtik_sqlite_busy_total')
+        for job in jobs:
+            job.result = None
+            job.error = f"Commit failed: {e}"
+        return
+
+    _record_written(jobs)
+
+
+class GroupCommitWriter:
+    """Writer thread that batches queued jobs into group commits"""
+
+    def __init__(self, pool, max_batch: int = 64, max_delay_ms: float = 5.0, changelog: bool = False):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self.changelog = changelog
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'batches': 0,
+            'jobs': 0,
+            'failed_jobs': 0,
+            'largest_batch': 0,
+            'commit_seconds': 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, name='radius-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, op: str, payload: Dict) -> Dict:
+        """Queue a mutation and block until its group commit finished"""
+        if op not in OPERATIONS:
+            raise WriteError(f"Unknown operation: {op}")
+
+        job = _Job(op, payload)
+        self._queue.put(job)
+        job.done.wait()
+
+        if job.error:
+            raise WriteError(job.error)
+        return job.result
+
+    def _collect(self) -> List[_Job]:
+        """Block for the first job, then gather more within the latency window"""
+        jobs = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+
+        while len(jobs) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return jobs
+
+    def _run(self):
+        conn = self.pool.acquire()
+        conn.isolation_level = None
+
+        while True:
+            jobs = self._collect()
+            started = time.monotonic()
+
+            try:
+                apply_batch(conn, jobs, changelog=self.changelog)
+            except Exception as e:
+                logger.error(f"Writer batch failed: {e}")
+                for job in jobs:
+                    job.error = str(e)
+
+            elapsed = time.monotonic() - started
+            with self._stats_lock:
+                self._stats['batches'] += 1
+                self._stats['jobs'] += len(jobs)
+                self._stats['failed_jobs'] += sum(1 for job in jobs if job.error)
+                self._stats['largest_batch'] = max(self._stats['largest_batch'], len(jobs))
+                self._stats['commit_seconds'] += elapsed
+
+            for job in jobs:
+                job.done.set()
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['commit_seconds'] = round(stats['commit_seconds'], 6)
+        stats['queued'] = self._queue.qsize()
+        stats['avg_batch'] = round(stats['jobs'] / stats['batches'], 2) if stats['batches'] else 0
+        return stats
+
+
+def _send(sock: socket.socket, message: Dict):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Writer socket closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv(sock: socket.socket) -> Dict:
+    (length,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return json.loads(_recv_exact(sock, length))
+
+
+class WriteCoordinator:
+    """
+    Entry point used by the API: elects a leader and routes mutations
+    to the single writer
+    """
+
+    def __init__(self, config, db_path: str):
+        self.config = config
+        self.db_path = db_path
+        self.enabled = config.getboolean('writer', 'enabled', fallback=True)
+        self.socket_path = config.get('writer', 'socket_path', fallback='/run/radtik-radius/writer.sock')
+        self.max_batch = config.getint('writer', 'max_batch', fallback=64)
+        self.max_delay_ms = config.getfloat('writer', 'max_delay_ms', fallback=5.0)
+        # Below gunicorn's 30s worker timeout, so a wedged leader fails requests instead of workers
+        self.timeout = config.getfloat('writer', 'timeout', fallback=25.0)
+        self.changelog = change_log.changelog_enabled(config)
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = None
+        self._writer: Optional[GroupCommitWriter] = None
+        self._direct_pool = None
+        self._lock_file = None
+
+    def _ensure_process(self):
+        """Reset state after a fork so each worker runs its own election"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._writer = None
+            self._direct_pool = None
+            self._lock_file = None
+            self._local = threading.local()
+
+    def _start_writer(self):
+        self._writer = GroupCommitWriter(
+            pool_from_config(self.config, self.db_path, size=1),
+            max_batch=self.max_batch,
+            max_delay_ms=self.max_delay_ms,
+            changelog=self.changelog
+        )
+
+    def _try_become_leader(self) -> bool:
+        """Take the writer lock and start the writer + socket server"""
+        lock_path = self.socket_path + '.lock'
+
+        try:
+            lock_file = open(lock_path, 'a')
+        except OSError as e:
+            logger.warning(f"Cannot open writer lock {lock_path}: {e}")
+            return False
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        # We hold the lock, so any existing socket file is stale
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(128)
+
+        self._lock_file = lock_file
+        self._start_writer()
+        threading.Thread(target=self._serve, args=(server,), name='radius-writer-server', daemon=True).start()
+
+        logger.info(f"Worker {os.getpid()} is the RADIUS writer (socket: {self.socket_path})")
+        return True
+
+    def _serve(self, server: socket.socket):
+        while True:
+            client, _ = server.accept()
+            threading.Thread(target=self._handle_client, args=(client,), daemon=True).start()
+
+    def _handle_client(self, client: socket.socket):
+        with client:
+            while True:
+                try:
+                    request = _recv(client)
+                except (ConnectionError, OSError, ValueError):
+                    return
+
+                try:
+                    result = self._writer.submit(request['op'], request['payload'])
+                    response = {'ok': True, 'result': result}
+                except Exception as e:
+                    response = {'ok': False, 'error': str(e)}
+
+                try:
+                    _send(client, response)
+                except OSError:
+                    return
+
+    def _connection(self) -> socket.socket:
+        """This thread's connection to the leader, reconnecting if the leader closed it"""
+        sock = getattr(self._local, 'sock', None)
+
+        # The leader never sends unprompted: a readable idle socket is closed
+        if sock is not None and select.select([sock], [], [], 0)[0]:
+            self._close_connection()
+            sock = None
+
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+
+        return sock
+
+    def _close_connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def _remote_submit(self, op: str, payload: Dict) -> Dict:
+        """
+        Send a mutation to the leader over this thread's socket connection
+
+        Raises:
+            ConnectionError / OSError if the mutation was not delivered (the
+            caller may route it elsewhere), WriteError if it was delivered
+            but no reply came back
+        """
+        sock = self._connection()
+
+        try:
+            _send(sock, {'op': op, 'payload': payload})
+        except OSError:
+            self._close_connection()
+            raise
+
+        try:
+            response = _recv(sock)
+        except (OSError, ValueError) as e:
+            # The leader may have committed the job before failing: never re-apply it
+            self._close_connection()
+            raise WriteError(f"No reply from the writer for {op} ({e}), "
+                             "it may or may not have been applied")
+
+        if not response.get('ok'):
+            raise WriteError(response.get('error', 'Unknown writer error'))
+        return response['result']
+
+    def _direct_submit(self, op: str, payload: Dict) -> Dict:
+        """Apply a mutation on a private connection (no writer reachable)"""
+        with self._lock:
+            if self._direct_pool is None:
+                self._direct_pool = pool_from_config(self.config, self.db_path)
+
+        job = _Job(op, payload)
+        with self._direct_pool.connection() as conn:
+            previous = conn.isolation_level
+            conn.isolation_level = None
+            try:
+                apply_batch(conn, [job], changelog=self.changelog)
+            finally:
+                conn.isolation_level = previous
+
+        if job.error:
+            raise WriteError(job.error)
+        return job.result
+
+    def submit(self, op: str, payload: Dict) -> Dict:
+        """
+        Apply a mutation through the single writer
+
+        Returns:
+            The operation's result dict
+
+        Raises:
+            WriteError if the operation failed
+        """
+        if op not in OPERATIONS:
+            raise WriteError(f"Unknown operation: {op}")
+
+        if not self.enabled:
+            return self._direct_submit(op, payload)
+
+        with self._lock:
+            self._ensure_process()
+
+        if self._writer is not None:
+            return self._writer.submit(op, payload)
+
+        try:
+            return self._remote_submit(op, payload)
+        except (ConnectionError, OSError):
+            pass
+
+        # Leader unreachable - try to take over, otherwise write directly
+        with self._lock:
+            if self._writer is None:
+                if os.path.isdir(os.path.dirname(self.socket_path)):
+                    self._try_become_leader()
+                else:
+                    # No runtime directory (e.g. development server): batch in-process only
+                    logger.warning("Writer socket directory missing, using in-process writer")
+                    self._start_writer()
+
+        if self._writer is not None:
+            return self._writer.submit(op, payload)
+
+        try:
+            return self._remote_submit(op, payload)
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"Writer unreachable ({e}), applying {op} directly")
+            return self._direct_submit(op, payload)
+
+    def stats(self) -> Dict:
+        """Writer statistics (only populated in the leader worker)"""
+        return {
+            'enabled': self.enabled,
+            'changelog': self.changelog,
+            'leader': self._writer is not None and self._pid == os.getpid(),
+            'socket_path': self.socket_path,
+            'batch': self._writer.stats() if self._writer is not None else None,
+        }
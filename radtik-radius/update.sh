@@ -120,6 +120,8 @@ print_header "PHASE 2: Stopping Services"
 
 echo -e "${YELLOW}Stopping services...${NC}"
 systemctl stop radtik-radius-api || true
+systemctl stop radtik-activation-sync || true
+systemctl stop radtik-replication-follower 2>/dev/null || true
 systemctl stop freeradius || true
 print_info "Services stopped"
 echo ""
@@ -186,7 +188,13 @@ echo -e "${YELLOW}Checking FreeRADIUS configuration...${NC}"
 
 # Copy updated module configurations (preserve clients.conf)
 if [ -d "$INSTALL_DIR/mods-available" ]; then
-    cp -r "$INSTALL_DIR/mods-available"/* "$FREERADIUS_DIR/mods-available/" 2>/dev/null || true
+    for module in "$INSTALL_DIR/mods-available"/*; do
+        # radtik_authorize contains the API token, keep an existing copy
+        if [ "$(basename "$module")" = "radtik_authorize" ] && [ -f "$FREERADIUS_DIR/mods-available/radtik_authorize" ]; then
+            continue
+        fi
+        cp -r "$module" "$FREERADIUS_DIR/mods-available/" 2>/dev/null || true
+    done
     print_info "Module configurations updated"
 fi
 
@@ -202,6 +210,82 @@ fi
 
 # Preserve clients.conf (contains user's secrets)
 print_warning "Preserving existing clients.conf (not overwriting)"
+
+# Refresh API service unit (e.g. RuntimeDirectory for the writer socket)
+if [ -f "$INSTALL_DIR/radtik-radius-api.service" ]; then
+    cp "$INSTALL_DIR/radtik-radius-api.service" /etc/systemd/system/radtik-radius-api.service
+    systemctl daemon-reload
+    print_info "API service unit updated"
+fi
+
+# Activation sync moved from cron (every 5 minutes) to a daemon
+if [ -f "$INSTALL_DIR/radtik-activation-sync.service" ]; then
+    cp "$INSTALL_DIR/radtik-activation-sync.service" /etc/systemd/system/radtik-activation-sync.service
+    touch /var/log/radtik-activation-sync.log
+    chown freerad:freerad /var/log/radtik-activation-sync.log
+    if [ -f /etc/cron.d/radtik-sync ]; then
+        sed -i '/activation-sync.py/d' /etc/cron.d/radtik-sync
+    fi
+    systemctl daemon-reload
+    systemctl enable radtik-activation-sync > /dev/null 2>&1
+    print_info "Activation sync service unit updated (cron entry removed)"
+fi
+
+# Replication follower (enabled manually on follower servers only)
+if [ -f "$INSTALL_DIR/radtik-replication-follower.service" ]; then
+    cp "$INSTALL_DIR/radtik-replication-follower.service" /etc/systemd/system/radtik-replication-follower.service
+    touch /var/log/radtik-replication-follower.log
+    chown freerad:freerad /var/log/radtik-replication-follower.log
+    systemctl daemon-reload
+    print_info "Replication follower service unit updated"
+fi
+
+# Orphan cleanup moved from every 6 hours to every minute (tombstone feed)
+if [ -f /etc/cron.d/radtik-sync ] && grep -q '^15 \*/6 .*cleanup-orphaned.py' /etc/cron.d/radtik-sync; then
+    sed -i 's|^15 \*/6 \* \* \* root /usr/bin/python3 |* * * * * root /usr/bin/flock -n /run/radtik-cleanup-orphaned.lock /usr/bin/python3 |' /etc/cron.d/radtik-sync
+    print_info "Cleanup cron job now runs every minute"
+fi
+
+# radpostauth retention (archive-postauth.py, [archive] in config.ini)
+if [ -f /etc/cron.d/radtik-sync ] && ! grep -q 'archive-postauth.py' /etc/cron.d/radtik-sync; then
+    touch /var/log/radtik-archive-postauth.log
+    chown freerad:freerad /var/log/radtik-archive-postauth.log
+    install -d -o freerad -g freerad -m 0750 /var/lib/radtik-radius
+    cat >> /etc/cron.d/radtik-sync << 'EOF'
+
+# Move radpostauth rows older than [archive] retention_hours to the archive
+# database every 5 minutes (runs as freerad, which also owns the archive)
+*/5 * * * * freerad /usr/bin/flock -n /var/lib/radtik-radius/archive-postauth.lock /usr/bin/python3 /opt/radtik-radius/scripts/archive-postauth.py > /dev/null 2>&1
+EOF
+    print_info "Post-auth archive cron job installed (every 5 minutes)"
+fi
+
+# radacct daily usage rollups (rollup-usage.py, [usage] in config.ini)
+if [ -f /etc/cron.d/radtik-sync ] && ! grep -q 'rollup-usage.py' /etc/cron.d/radtik-sync; then
+    touch /var/log/radtik-rollup-usage.log
+    chown freerad:freerad /var/log/radtik-rollup-usage.log
+    install -d -o freerad -g freerad -m 0750 /var/lib/radtik-radius
+    cat >> /etc/cron.d/radtik-sync << 'EOF'
+
+# Roll up closed radacct sessions into daily usage every minute
+* * * * * freerad /usr/bin/flock -n /var/lib/radtik-radius/rollup-usage.lock /usr/bin/python3 /opt/radtik-radius/scripts/rollup-usage.py > /dev/null 2>&1
+EOF
+    print_info "Usage rollup cron job installed (every minute)"
+fi
+echo ""
+
+###############################################################################
+# PHASE 5b: Apply Database Schema Migrations
+###############################################################################
+
+print_header "PHASE 5b: Applying Database Migrations"
+
+echo -e "${YELLOW}Migrating RADIUS database schema...${NC}"
+if python3 "$INSTALL_DIR/scripts/migrate.py" --db "$FREERADIUS_DIR/sqlite/radius.db"; then
+    print_info "Database schema up to date"
+else
+    print_error "Database migration failed - services will start on the previous schema"
+fi
 echo ""
 
 ###############################################################################
@@ -213,6 +297,10 @@ print_header "PHASE 6: Starting Services"
 echo -e "${YELLOW}Starting services...${NC}"
 systemctl start radtik-radius-api
 systemctl start freeradius
+systemctl start radtik-activation-sync || true
+if systemctl is-enabled --quiet radtik-replication-follower 2>/dev/null; then
+    systemctl start radtik-replication-follower || true
+fi
 print_info "Services started"
 echo ""
 
@@ -6,6 +6,7 @@
 use App\Http\Controllers\PaymentCallbackController;
 use App\Http\Controllers\Voucher\SingleVoucherPrintController;
 use App\Http\Controllers\Voucher\VoucherPrintController;
+use App\Http\Middleware\DecompressRequestBody;
 use Illuminate\Foundation\Http\Middleware\VerifyCsrfToken;
 use Illuminate\Http\Request;
 // use request
@@ -190,13 +191,27 @@
 // Receive voucher activation data from RADIUS server
 Route::post('/api/radius/activations', [RadiusActivationController::class, 'store'])
     ->withoutMiddleware([VerifyCsrfToken::class])
+    ->middleware(DecompressRequestBody::class)
     ->name('radius.activations.store');
 
 // Verify voucher existence for orphan cleanup
 Route::post('/api/radius/verify-vouchers', [RadiusVoucherVerificationController::class, 'verify'])
     ->withoutMiddleware([VerifyCsrfToken::class])
+    ->middleware(DecompressRequestBody::class)
     ->name('radius.vouchers.verify');
 
+// Per-bucket voucher digests for digest-based orphan reconciliation
+Route::post('/api/radius/voucher-digests', [RadiusVoucherVerificationController::class, 'digests'])
+    ->withoutMiddleware([VerifyCsrfToken::class])
+    ->middleware(DecompressRequestBody::class)
+    ->name('radius.vouchers.digests');
+
+// Cursor feed of vouchers deleted in RADTik (delta cleanup on the RADIUS server)
+Route::post('/api/radius/voucher-tombstones', [RadiusVoucherVerificationController::class, 'tombstones'])
+    ->withoutMiddleware([VerifyCsrfToken::class])
+    ->middleware(DecompressRequestBody::class)
+    ->name('radius.vouchers.tombstones');
+
 /* Payment Gateway Callbacks (without CSRF) */
 Route::post('/payment/cryptomus/callback', [App\Http\Controllers\PaymentCallbackController::class, 'cryptomus'])
     ->withoutMiddleware([VerifyCsrfToken::class])->name('payment.cryptomus.callback');
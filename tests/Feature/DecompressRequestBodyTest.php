@@ -0,0 +1,59 @@
+<?php
+
+use App\Http\Middleware\DecompressRequestBody;
+use Illuminate\Http\Request;
+use Illuminate\Support\Facades\Route;
+
+use function Pest\Laravel\call;
+
+beforeEach(function () {
+    Route::post('/_test/decompress', fn (Request $request) => response()->json($request->all()))
+        ->middleware(DecompressRequestBody::class);
+
+    Route::post('/_test/decompress-validate', function (Request $request) {
+        $request->validate(['since' => 'required|integer']);
+
+        return response()->json(['ok' => true]);
+    })->middleware(DecompressRequestBody::class);
+});
+
+test('gzip compressed json body is inflated', function () {
+    $payload = ['usernames' => ['abc123', 'def456']];
+
+    call('POST', '/_test/decompress', [], [], [], [
+        'CONTENT_TYPE' => 'application/json',
+        'HTTP_CONTENT_ENCODING' => 'gzip',
+    ], gzencode(json_encode($payload)))
+        ->assertOk()
+        ->assertExactJson($payload)
+        ->assertHeader(DecompressRequestBody::INFLATED_HEADER, 'gzip');
+});
+
+test('validation errors for a gzip body are marked as inflated', function () {
+    call('POST', '/_test/decompress-validate', [], [], [], [
+        'CONTENT_TYPE' => 'application/json',
+        'HTTP_ACCEPT' => 'application/json',
+        'HTTP_CONTENT_ENCODING' => 'gzip',
+    ], gzencode(json_encode(['since' => 'not a number'])))
+        ->assertStatus(422)
+        ->assertHeader(DecompressRequestBody::INFLATED_HEADER, 'gzip');
+});
+
+test('plain json body is passed through', function () {
+    $payload = ['usernames' => ['abc123']];
+
+    call('POST', '/_test/decompress', [], [], [], [
+        'CONTENT_TYPE' => 'application/json',
+    ], json_encode($payload))
+        ->assertOk()
+        ->assertExactJson($payload)
+        ->assertHeaderMissing(DecompressRequestBody::INFLATED_HEADER);
+});
+
+test('invalid gzip body is rejected', function () {
+    call('POST', '/_test/decompress', [], [], [], [
+        'CONTENT_TYPE' => 'application/json',
+        'HTTP_CONTENT_ENCODING' => 'gzip',
+    ], 'not gzip')
+        ->assertStatus(400);
+});
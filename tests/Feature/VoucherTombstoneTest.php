@@ -0,0 +1,171 @@
+<?php
+
+use App\Models\RadiusServer;
+use App\Models\Router;
+use App\Models\User;
+use App\Models\UserProfile;
+use App\Models\Voucher;
+use App\Models\VoucherTombstone;
+use Illuminate\Foundation\Testing\RefreshDatabase;
+use Illuminate\Support\Facades\Artisan;
+
+use function Pest\Laravel\postJson;
+
+uses(RefreshDatabase::class);
+
+beforeEach(function () {
+    $this->user = User::factory()->create();
+
+    $this->server = RadiusServer::create([
+        'name' => 'Test RADIUS',
+        'secret' => 'testing123',
+        'auth_token' => 'radius-test-token',
+        'is_active' => true,
+    ]);
+
+    $this->router = Router::factory()->create([
+        'user_id' => $this->user->id,
+        'radius_server_id' => $this->server->id,
+    ]);
+
+    $this->profile = new UserProfile;
+    $this->profile->name = '1 Day Package';
+    $this->profile->rate_limit = '1M/1M';
+    $this->profile->validity = 1;
+    $this->profile->price = 50.00;
+    $this->profile->user_id = $this->user->id;
+    $this->profile->save();
+
+    $this->makeVoucher = function (string $username, ?Router $router = null): Voucher {
+        return Voucher::create([
+            'username' => $username,
+            'password' => $username,
+            'user_profile_id' => $this->profile->id,
+            'user_id' => $this->user->id,
+            'router_id' => ($router ?? $this->router)->id,
+            'created_by' => $this->user->id,
+            'batch' => 'BATCH001',
+        ]);
+    };
+});
+
+function postTombstones(array $data)
+{
+    return postJson('/api/radius/voucher-tombstones', $data, [
+        'Authorization' => 'Bearer radius-test-token',
+    ]);
+}
+
+function pruneTombstonesOlderThan30Days(): void
+{
+    VoucherTombstone::query()->update(['created_at' => now()->subDays(40)]);
+
+    Artisan::call('model:prune', ['--model' => [VoucherTombstone::class]]);
+}
+
+test('deleting a voucher records a tombstone for its radius server', function () {
+    ($this->makeVoucher)('abc123')->delete();
+
+    expect(VoucherTombstone::where('radius_server_id', $this->server->id)->pluck('username')->all())
+        ->toBe(['abc123']);
+});
+
+test('vouchers of routers without a radius server leave no tombstone', function () {
+    $router = Router::factory()->create(['user_id' => $this->user->id]);
+
+    ($this->makeVoucher)('local1', $router)->delete();
+
+    expect(VoucherTombstone::count())->toBe(0);
+});
+
+test('feed returns usernames after the cursor in pages', function () {
+    foreach (['u1', 'u2', 'u3'] as $username) {
+        ($this->makeVoucher)($username)->delete();
+    }
+
+    $first = postTombstones(['since' => 0, 'limit' => 2])
+        ->assertOk()
+        ->assertJson(['usernames' => ['u1', 'u2'], 'has_more' => true, 'reset' => false]);
+
+    postTombstones(['since' => $first->json('cursor'), 'limit' => 2])
+        ->assertOk()
+        ->assertJson(['usernames' => ['u3'], 'has_more' => false]);
+});
+
+test('re-created vouchers are left out of the feed', function () {
+    ($this->makeVoucher)('again')->delete();
+    ($this->makeVoucher)('again');
+
+    postTombstones(['since' => 0])
+        ->assertOk()
+        ->assertJsonPath('usernames', []);
+});
+
+test('feed requires a valid server token', function () {
+    postJson('/api/radius/voucher-tombstones', ['since' => 0], [
+        'Authorization' => 'Bearer wrong-token',
+    ])->assertStatus(401);
+});
+
+test('feed reports a reset once when tombstones after the cursor were pruned', function () {
+    ($this->makeVoucher)('old1')->delete();
+    ($this->makeVoucher)('old2')->delete();
+    pruneTombstonesOlderThan30Days();
+    ($this->makeVoucher)('new1')->delete();
+
+    $first = postTombstones(['since' => 0])
+        ->assertOk()
+        ->assertJson(['usernames' => ['new1'], 'has_more' => false, 'reset' => true]);
+
+    postTombstones(['since' => $first->json('cursor')])
+        ->assertOk()
+        ->assertJson(['usernames' => [], 'reset' => false]);
+});
+
+test('an empty page after a reset moves the cursor past the pruned tombstones', function () {
+    ($this->makeVoucher)('old1')->delete();
+    $cursor = postTombstones(['since' => 0])->json('cursor');
+    ($this->makeVoucher)('old2')->delete();
+    pruneTombstonesOlderThan30Days();
+
+    $reset = postTombstones(['since' => $cursor])
+        ->assertOk()
+        ->assertJson(['usernames' => [], 'reset' => true]);
+
+    expect($reset->json('cursor'))->toBe($this->server->fresh()->tombstones_pruned_id);
+
+    postTombstones(['since' => $reset->json('cursor')])
+        ->assertOk()
+        ->assertJson(['usernames' => [], 'reset' => false]);
+});
+
+test('pruning another server\'s tombstones does not reset this server', function () {
+    $otherServer = RadiusServer::create([
+        'name' => 'Other RADIUS',
+        'secret' => 'testing456',
+        'auth_token' => 'other-radius-token',
+        'is_active' => true,
+    ]);
+    $otherRouter = Router::factory()->create([
+        'user_id' => $this->user->id,
+        'radius_server_id' => $otherServer->id,
+    ]);
+
+    ($this->makeVoucher)('other1', $otherRouter)->delete();
+    ($this->makeVoucher)('mine1')->delete();
+
+    $cursor = postTombstones(['since' => 0])
+        ->assertOk()
+        ->assertJson(['usernames' => ['mine1'], 'reset' => false])
+        ->json('cursor');
+
+    // Only the other server's tombstone is old enough to be pruned
+    VoucherTombstone::where('radius_server_id', $otherServer->id)->update(['created_at' => now()->subDays(40)]);
+    Artisan::call('model:prune', ['--model' => [VoucherTombstone::class]]);
+
+    expect(VoucherTombstone::where('radius_server_id', $otherServer->id)->count())->toBe(0);
+
+    postTombstones(['since' => $cursor])
+        ->assertOk()
+        ->assertJson(['usernames' => [], 'reset' => false, 'cursor' => $cursor]);
+});